@@ -1,16 +1,127 @@
 #!/usr/bin/env python
 
 import argparse
+from os.path import join
+import re
+import sys
 
-from mvlib.minorVariants import MinorVariantInfo
+from pysam import AlignmentFile
+
+from mvlib.functions import readFilterFlags, readGroupSamples
+from mvlib.minorVariants import (JSON_VERSION, JSON_VERSIONS,
+                                 MinorVariantInfo, readGroupInfos)
+
+# The suffixes of the json files written with --readGroups.
+SUFFIXES = {'gzip': '.json.gz', 'zstd': '.json.zst'}
+
+
+def sampleFilenames(samples, outDir, suffix):
+    """
+    Get the names of the json files to write samples to, exiting with an
+    error if two samples would be written to the same file.
+
+    @param samples: An iterable of C{str} sample names.
+    @param outDir: The C{str} directory to write the files to.
+    @param suffix: The C{str} suffix of the files.
+    @return: A C{dict} mapping each sample name to its C{str} file name.
+    """
+    # Sample names are made safe for use as file names, without dots (the
+    # name of a saved sample is its file name up to the first dot).
+    filenames = {sample: join(outDir,
+                              re.sub(r'[^\w-]+', '_', sample) + suffix)
+                 for sample in samples}
+    samplesByFilename = {}
+    for sample, filename in filenames.items():
+        samplesByFilename.setdefault(filename, []).append(sample)
+    clashes = [samples for samples in samplesByFilename.values()
+               if len(samples) > 1]
+    if clashes:
+        for samples in clashes:
+            print('Samples %s would be written to the same file, %s.' % (
+                ', '.join(map(repr, samples)), filenames[samples[0]]),
+                file=sys.stderr)
+        sys.exit(1)
+    return filenames
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description=('Take a bamFile and write MinorVariantInfo.countsPerBase '
-                     'json to stdout.'))
+                     'json to stdout or a (compressed) file.'))
+
+    parser.add_argument(
+        'bamFile',
+        help='A BAM or CRAM file to be analysed. With --stream, this can be '
+             '- to read SAM or BAM from standard input.')
+
+    parser.add_argument(
+        '--stream', default=False, action='store_true',
+        help='Read the alignments once, in the order they are given, instead '
+             'of making a pileup. The input then need not be sorted or '
+             'indexed, e.g., it can be piped from an aligner. The counts are '
+             'the same, as neither way detects overlapping mates (the bases '
+             'of both are counted).')
+
+    parser.add_argument(
+        '--out', default=None, metavar='FILE',
+        help='The file to write the json to, instead of standard output. If '
+             'the name ends in .gz or .zst, the output is compressed with '
+             'gzip or zstd.')
+
+    parser.add_argument(
+        '--readGroups', default=False, action='store_true',
+        help='The input holds the reads of several samples, told apart by '
+             'their read group. Count each sample (the SM of its read groups '
+             'in the input header) in the same pass and write its json to a '
+             'file named after it in the --outDir directory. Characters '
+             'other than letters, digits, _ and - are replaced by _, and it '
+             'is an error if two samples then get the same file name.')
+
+    parser.add_argument(
+        '--outDir', default='.', metavar='DIR',
+        help='The directory to write the json files to when using '
+             '--readGroups.')
+
+    parser.add_argument(
+        '--compression', default=None, choices=('gzip', 'zstd', 'none'),
+        help='The compression to use, instead of the one implied by the '
+             'name of the --out file. zstd needs the zstandard package.')
+
+    parser.add_argument(
+        '--jsonVersion', default=JSON_VERSION, type=int, choices=JSON_VERSIONS,
+        help='The version of the json to write. Version 1 (with the base '
+             'counts of each position) can be read by older code, version 2 '
+             '(with the counts of each base over all positions) is faster to '
+             'read.')
+
+    parser.add_argument(
+        '--reference', default=None,
+        help='The reference needed to decode a CRAM file. Either a FASTA '
+             'file or one of SARS2, WNV or YFV to use the built-in genome '
+             '(which cannot be used when reading standard input).')
 
-    parser.add_argument('bamFile', help='A bam file to be analysed.')
+    parser.add_argument(
+        '--region', action='append', dest='regions', metavar='REGION',
+        help='Only count the bases in this region, given as 1-based '
+             'inclusive coordinates (e.g., 23567-23626) or as a gene name '
+             '(see --virus). Only the parts of the (indexed) input covering '
+             'the regions are read. May be repeated.')
+
+    parser.add_argument(
+        '--virus', default=None, choices=('SARS2', 'WNV', 'YFV'),
+        help='The virus whose gene offsets are used to find regions given '
+             'as gene names.')
+
+    parser.add_argument(
+        '--threads', default=1, type=int,
+        help='The number of threads to use for decompressing the input.')
+
+    parser.add_argument(
+        '--pipeline', default=False, action='store_true',
+        help='Read and decode the input in a separate thread from the one '
+             'that counts the bases, so reading and counting overlap. This '
+             'only speeds up --stream: a pileup is no faster, and can be '
+             'slower, as its columns are converted holding the GIL.')
 
     parser.add_argument(
         '--sequencingTech', default=None,
@@ -26,11 +137,84 @@ if __name__ == '__main__':
         '--minMappingQuality', default=None, type=int,
         help='Only use reads above a minimum mapping quality.')
 
+    parser.add_argument(
+        '--minReadLength', default=None, type=int,
+        help='Only use reads of at least this length.')
+
+    parser.add_argument(
+        '--keepSecondary', default=False, action='store_true',
+        help='Use secondary alignments.')
+
+    parser.add_argument(
+        '--dropSupplementary', default=False, action='store_true',
+        help='Do not use supplementary alignments.')
+
+    parser.add_argument(
+        '--keepDuplicates', default=False, action='store_true',
+        help='Use reads marked as PCR or optical duplicates.')
+
+    parser.add_argument(
+        '--keepQCFailures', default=False, action='store_true',
+        help='Use reads that failed vendor quality checks.')
+
+    parser.add_argument(
+        '--qualityBins', default=None, type=int, nargs='+',
+        metavar='QUALITY',
+        help='Also save the base counts in base quality bins with these '
+             'lower edges (e.g., 0 10 20 30), so the counts for a higher '
+             'minimum base quality can be derived from the output.')
+
+    parser.add_argument(
+        '--strand', default=False, action='store_true',
+        help='Also save the base counts separately for reads on the forward '
+             'and on the reverse strand.')
+
+    parser.add_argument(
+        '--insertionSequences', default=False, action='store_true',
+        help='Also save the inserted sequences found after each position.')
+
+    parser.add_argument(
+        '--sparse', default=False, action='store_true',
+        help='Save the counts compactly, as the most common base and the '
+             'depth at each position plus the counts of any other bases, '
+             'instead of as all base counts per position.')
+
     args = parser.parse_args()
 
-    mvi = MinorVariantInfo(bamFile=args.bamFile,
-                           minBaseQuality=args.minBaseQuality,
-                           minMappingQuality=args.minMappingQuality,
-                           sequencingTech=args.sequencingTech)
+    flagFilter = readFilterFlags(dropSecondary=not args.keepSecondary,
+                                 dropSupplementary=args.dropSupplementary,
+                                 dropDuplicates=not args.keepDuplicates,
+                                 keepQCFailures=args.keepQCFailures)
+
+    kwargs = dict(minBaseQuality=args.minBaseQuality,
+                  minMappingQuality=args.minMappingQuality,
+                  sequencingTech=args.sequencingTech,
+                  flagFilter=flagFilter,
+                  minReadLength=args.minReadLength,
+                  threads=args.threads,
+                  reference=args.reference,
+                  qualityBins=args.qualityBins,
+                  strand=args.strand,
+                  insertionSequences=args.insertionSequences,
+                  regions=args.regions, virus=args.virus,
+                  stream=args.stream, pipeline=args.pipeline)
 
-    mvi.save()
+    if args.readGroups:
+        suffix = SUFFIXES.get(args.compression, '.json')
+        if args.bamFile != '-':
+            # Check the file names before taking a pass over the input.
+            # Standard input can only be read once, so its samples are only
+            # checked once they are counted.
+            with AlignmentFile(args.bamFile) as sam:
+                sampleFilenames(readGroupSamples(sam.header)[0], args.outDir,
+                                suffix)
+        infos = readGroupInfos(args.bamFile, **kwargs)
+        filenames = sampleFilenames(infos, args.outDir, suffix)
+        for sample, mvi in infos.items():
+            mvi.save(filenames[sample], sparse=args.sparse,
+                     compression=args.compression, version=args.jsonVersion)
+            print(filenames[sample])
+    else:
+        mvi = MinorVariantInfo(bamFile=args.bamFile, **kwargs)
+        mvi.save(args.out, sparse=args.sparse, compression=args.compression,
+                 version=args.jsonVersion)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+
+from mvlib.functions import readFilterFlags
+from mvlib.pipeline import DEFAULT_PLOT_POSITIONS, STAGES, runPipeline
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=('Take BAM files through base counting, statistics and '
+                     'frequency plots, only redoing the outputs that are '
+                     'missing or out of date.'))
+
+    parser.add_argument(
+        'bamFiles', nargs='+', metavar='bamFile',
+        help='The BAM or CRAM files to be analysed, one per sample. The '
+             'sample name is the file name up to the first dot.')
+
+    parser.add_argument(
+        '--outDir', required=True, metavar='DIR',
+        help='The directory to write the outputs and the manifest of how '
+             'they were made to. Running again with the same directory only '
+             'makes the outputs whose inputs or parameters have changed.')
+
+    parser.add_argument(
+        '--workers', default=None, type=int,
+        help='The number of samples to run at once. The default is the '
+             'number of CPUs.')
+
+    parser.add_argument(
+        '--force', default=False, action='store_true',
+        help='Make all outputs again, even if they are up to date.')
+
+    parser.add_argument(
+        '--minCoverage', default=50, type=int,
+        help='The minimum coverage of a minor variant, for the statistics.')
+
+    parser.add_argument(
+        '--minFrequency', default=0.03, type=float,
+        help='The minimum frequency of a minor variant, for the statistics.')
+
+    parser.add_argument(
+        '--plotPositions', default=None, type=int, nargs='+',
+        metavar='POSITION',
+        help='The 1-based positions to plot. The default is the SARS2 furin '
+             'cleavage site.')
+
+    parser.add_argument(
+        '--plotFormat', default='png',
+        help='The file format of the plots.')
+
+    parser.add_argument(
+        '--reference', default=None,
+        help='The reference needed to decode a CRAM file. Either a FASTA '
+             'file or one of SARS2, WNV or YFV to use the built-in genome.')
+
+    parser.add_argument(
+        '--threads', default=1, type=int,
+        help='The number of threads to use for decompressing each input.')
+
+    parser.add_argument(
+        '--pipeline', default=False, action='store_true',
+        help='Read and decode each input in a separate thread from the one '
+             'that counts its bases. As the inputs are piled up, this is no '
+             'faster and can be slower, since the pileup columns are '
+             'converted holding the GIL.')
+
+    parser.add_argument(
+        '--sequencingTech', default=None,
+        help='The sequencing technology used to create the reads in the bam '
+             'files.')
+
+    parser.add_argument(
+        '--minBaseQuality', default=None, type=int,
+        help='Minimum base quality. Bases below the minimum quality will not '
+             'be counted.')
+
+    parser.add_argument(
+        '--minMappingQuality', default=None, type=int,
+        help='Only use reads above a minimum mapping quality.')
+
+    parser.add_argument(
+        '--minReadLength', default=None, type=int,
+        help='Only use reads of at least this length.')
+
+    parser.add_argument(
+        '--keepSecondary', default=False, action='store_true',
+        help='Use secondary alignments.')
+
+    parser.add_argument(
+        '--dropSupplementary', default=False, action='store_true',
+        help='Do not use supplementary alignments.')
+
+    parser.add_argument(
+        '--keepDuplicates', default=False, action='store_true',
+        help='Use reads marked as PCR or optical duplicates.')
+
+    parser.add_argument(
+        '--keepQCFailures', default=False, action='store_true',
+        help='Use reads that failed vendor quality checks.')
+
+    args = parser.parse_args()
+
+    flagFilter = readFilterFlags(dropSecondary=not args.keepSecondary,
+                                 dropSupplementary=args.dropSupplementary,
+                                 dropDuplicates=not args.keepDuplicates,
+                                 keepQCFailures=args.keepQCFailures)
+
+    countParams = dict(minBaseQuality=args.minBaseQuality,
+                       minMappingQuality=args.minMappingQuality,
+                       sequencingTech=args.sequencingTech,
+                       flagFilter=flagFilter,
+                       minReadLength=args.minReadLength,
+                       reference=args.reference)
+
+    results = runPipeline(
+        args.bamFiles, args.outDir, countParams=countParams,
+        minCoverage=args.minCoverage, minFrequency=args.minFrequency,
+        plotPositions=args.plotPositions or DEFAULT_PLOT_POSITIONS,
+        plotFormat=args.plotFormat, threads=args.threads,
+        pipeline=args.pipeline, workers=args.workers, force=args.force)
+
+    failed = False
+    for name, result in results.items():
+        fields = [name] + ['%s=%s' % (stage, result[stage])
+                           for stage in STAGES if stage in result]
+        if result['error']:
+            failed = True
+            fields.append('FAILED: %s' % result['error'])
+            print(' '.join(fields), file=sys.stderr)
+        else:
+            print(' '.join(fields))
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import argparse
+
+from mvlib.load import load
+from mvlib.minorVariants import MinorVariantInfo
+from mvlib.service import CohortService
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=('Load a cohort of saved samples once and answer queries '
+                     'about them over a Unix socket or a localhost TCP '
+                     'port, one JSON request per line.'))
+
+    parser.add_argument(
+        'jsonFiles', nargs='*',
+        help='The json files (as written by generate-data.py) of the '
+             'samples. If none are given, all json files in the data '
+             'directory are used.')
+
+    group = parser.add_mutually_exclusive_group(required=True)
+
+    group.add_argument(
+        '--socket', default=None,
+        help='The path of the Unix socket to listen on.')
+
+    group.add_argument(
+        '--port', default=None, type=int,
+        help='The localhost TCP port to listen on.')
+
+    parser.add_argument(
+        '--cacheSize', default=1024, type=int,
+        help='The maximum number of query answers to cache.')
+
+    args = parser.parse_args()
+
+    if args.jsonFiles:
+        samples = (MinorVariantInfo(jsonFile=jsonFile)
+                   for jsonFile in args.jsonFiles)
+    else:
+        samples = load()
+
+    service = CohortService(samples, cacheSize=args.cacheSize)
+    service.serveForever(socketPath=args.socket, port=args.port)
@@ -0,0 +1,361 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import numpy as np
+import os
+
+from mvlib.common import BASES
+from mvlib.functions import BASE_INDEX
+
+# Minor alleles are bases (or deletions) other than the most common base at
+# a position. N is not an allele.
+_ALLELE_INDICES = np.array([index for base, index in BASE_INDEX.items()
+                            if base != 'N'])
+
+# The number of alleles in each block of the dense sample x allele matrices
+# used to count shared alleles.
+SHARED_ALLELES_BLOCK_SIZE = 4096
+
+# The number of positions in each chunk of the cohort that is handed to a
+# worker when computing pairwise distances.
+PAIRWISE_CHUNK_SIZE = 2048
+
+# The maximum number of values in the samples x samples x positions x alleles
+# array broadcast for a block of rows when computing L1 distances.
+_L1_BROADCAST_SIZE = 1 << 24
+
+PAIRWISE_METRICS = ('l1', 'fst')
+
+
+def minorAlleles(counts, minCoverage=50, minFrequency=0.03):
+    """
+    Find the minor alleles in a sample.
+
+    @param counts: An C{int} array of shape (length, len(BASES)) with the
+        count of each base at each position.
+    @param minCoverage: The C{int} coverage needed at a position for its
+        minor alleles to be found.
+    @param minFrequency: A C{float} frequency a base (other than the most
+        common one) must be above to be a minor allele.
+    @return: A 3-C{tuple} of C{int} arrays of 0-based positions and base
+        indices (into C{BASES}) and a C{float} array of frequencies, one for
+        each minor allele, ordered by position.
+    """
+    coverage = counts.sum(axis=1)
+    frequencies = counts / np.maximum(coverage, 1)[:, np.newaxis]
+    minor = np.zeros(counts.shape, dtype=bool)
+    minor[:, _ALLELE_INDICES] = frequencies[:, _ALLELE_INDICES] > minFrequency
+    minor[np.arange(len(counts)), counts.argmax(axis=1)] = False
+    minor[(coverage == 0) | (coverage < minCoverage)] = False
+
+    positions, bases = np.nonzero(minor)
+    return positions, bases, frequencies[positions, bases]
+
+
+class MinorAlleleIndex():
+    """
+    An inverted index from each minor allele, i.e., a (position, base) pair,
+    to the samples of a cohort that carry it, and with what frequency.
+
+    @param samples: An iterable of C{MinorVariantInfo} instances to index.
+        They are only looked at one at a time, so this can be a generator,
+        e.g., as returned by C{mvlib.load.load}.
+    @param indexFile: If not C{None}, a C{str} filename of an index saved by
+        C{save}, to load instead of indexing C{samples}.
+    @param minCoverage: The C{int} coverage needed at a position for its
+        minor alleles to be indexed.
+    @param minFrequency: A C{float} frequency a base (other than the most
+        common one) must be above to be indexed as a minor allele.
+    """
+    def __init__(self, samples=None, indexFile=None, minCoverage=50,
+                 minFrequency=0.03):
+        if indexFile:
+            with np.load(indexFile, allow_pickle=False) as saved:
+                if tuple(saved['bases']) != BASES:
+                    raise ValueError(
+                        'Index file %r has bases %r, not %r.' % (
+                            indexFile, tuple(saved['bases']), BASES))
+                self.names = saved['names'].tolist()
+                self.minCoverage = int(saved['minCoverage'])
+                self.minFrequency = float(saved['minFrequency'])
+                self.alleles = saved['alleles']
+                self.offsets = saved['offsets']
+                self.samples = saved['samples']
+                self.frequencies = saved['frequencies']
+            return
+
+        if samples is None:
+            raise ValueError('Either samples or indexFile must be given.')
+
+        self.names = []
+        self.minCoverage = minCoverage
+        self.minFrequency = minFrequency
+        alleles = []
+        sampleIndices = []
+        frequencies = []
+
+        for sampleIndex, sample in enumerate(samples):
+            positions, bases, sampleFrequencies = minorAlleles(
+                sample.counts, minCoverage, minFrequency)
+            self.names.append(sample.name)
+            alleles.append(positions * len(BASES) + bases)
+            sampleIndices.append(np.full(len(positions), sampleIndex,
+                                         dtype=np.int32))
+            frequencies.append(sampleFrequencies.astype(np.float32))
+
+        alleles = np.concatenate(alleles or [np.empty(0, dtype=int)])
+        order = np.argsort(alleles, kind='stable')
+
+        # The samples carrying allele self.alleles[i] are
+        # self.samples[self.offsets[i]:self.offsets[i + 1]].
+        self.alleles, starts = np.unique(alleles[order], return_index=True)
+        self.offsets = np.append(starts, len(alleles))
+        self.samples = np.concatenate(
+            sampleIndices or [np.empty(0, dtype=np.int32)])[order]
+        self.frequencies = np.concatenate(
+            frequencies or [np.empty(0, dtype=np.float32)])[order]
+
+    def __len__(self):
+        """
+        Get the number of minor alleles in the index.
+
+        @return: The C{int} number of distinct minor alleles.
+        """
+        return len(self.alleles)
+
+    def save(self, outFilename):
+        """
+        Save the index.
+
+        @param outFilename: A C{str} filename to save the index to, in
+            NumPy's compressed C{.npz} format.
+        """
+        np.savez_compressed(
+            outFilename, bases=np.array(BASES), names=np.array(self.names),
+            minCoverage=self.minCoverage, minFrequency=self.minFrequency,
+            alleles=self.alleles, offsets=self.offsets, samples=self.samples,
+            frequencies=self.frequencies)
+
+    def carriers(self, position, base):
+        """
+        Find the samples carrying a minor allele.
+
+        @param position: The C{int} 0-based position of the allele.
+        @param base: The C{str} base of the allele ('-' for a deletion).
+        @return: A C{list} of (sample name, frequency) C{tuple}s.
+        """
+        allele = position * len(BASES) + BASES.index(base)
+        index = np.searchsorted(self.alleles, allele)
+
+        if index == len(self.alleles) or self.alleles[index] != allele:
+            return []
+
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return [(self.names[sampleIndex], frequency) for
+                sampleIndex, frequency in
+                zip(self.samples[start:end].tolist(),
+                    self.frequencies[start:end].tolist())]
+
+    def sampleAlleles(self, name):
+        """
+        Get the minor alleles of one sample.
+
+        @param name: The C{str} name of a sample.
+        @return: A C{set} of (0-based position, base) C{tuple}s.
+        """
+        sampleIndex = self.names.index(name)
+        entries = np.flatnonzero(self.samples == sampleIndex)
+        alleleIndices = np.searchsorted(self.offsets, entries,
+                                        side='right') - 1
+        alleles = self.alleles[alleleIndices]
+        return {(position, BASES[base]) for position, base in
+                zip((alleles // len(BASES)).tolist(),
+                    (alleles % len(BASES)).tolist())}
+
+    def sharedAlleleCounts(self):
+        """
+        Count the minor alleles shared by each pair of samples.
+
+        Alleles carried by a single sample only add to the diagonal. The
+        others are counted with matrix products over blocks of
+        C{SHARED_ALLELES_BLOCK_SIZE} alleles, so memory use is bounded by
+        the number of samples times the block size.
+
+        @return: A square C{int} array with a row and column for each sample
+            (in the order of C{self.names}) giving the number of minor
+            alleles the two samples share. The diagonal holds the number of
+            minor alleles of each sample.
+        """
+        nSamples = len(self.names)
+        shared = np.zeros((nSamples, nSamples), dtype=np.float64)
+
+        sizes = np.diff(self.offsets)
+        multiple = np.flatnonzero(sizes > 1)
+
+        for blockStart in range(0, len(multiple), SHARED_ALLELES_BLOCK_SIZE):
+            block = multiple[blockStart:blockStart +
+                             SHARED_ALLELES_BLOCK_SIZE]
+            blockSizes = sizes[block]
+            entries = np.concatenate([
+                np.arange(self.offsets[index], self.offsets[index + 1])
+                for index in block.tolist()])
+            incidence = np.zeros((nSamples, len(block)), dtype=np.float32)
+            incidence[self.samples[entries],
+                      np.repeat(np.arange(len(block)), blockSizes)] = 1.0
+            shared += incidence @ incidence.T
+
+        shared = np.rint(shared).astype(int)
+        np.fill_diagonal(shared, np.bincount(self.samples,
+                                             minlength=nSamples))
+
+        return shared
+
+
+def _pairwiseSums(counts, metric, minCoverage):
+    """
+    Compute the numerators and denominators of a pairwise distance for a
+    chunk of positions.
+
+    @param counts: An C{int} array of shape (samples, positions, len(BASES))
+        with the base counts of each sample in the chunk.
+    @param metric: One of the C{str} names in C{PAIRWISE_METRICS}.
+    @param minCoverage: The C{int} coverage needed at a position for it to be
+        used.
+    @return: A 2-C{tuple} of square C{float} arrays, the numerator and
+        denominator sums of the distance between each pair of samples over
+        the positions the two samples both cover.
+    """
+    nSamples = len(counts)
+    alleleCounts = counts[:, :, _ALLELE_INDICES].astype(float)
+    coverage = alleleCounts.sum(axis=2)
+    covered = (coverage > 0) & (coverage >= minCoverage)
+    frequencies = alleleCounts / np.maximum(coverage, 1)[:, :, np.newaxis]
+    frequencies[~covered] = 0.0
+    coveredFloat = covered.astype(float)
+
+    # The number of positions covered by both samples of each pair.
+    joint = coveredFloat @ coveredFloat.T
+
+    if metric == 'l1':
+        # At a position covered by both samples the L1 distance between
+        # their frequencies is 2 - 2 * sum(min(f1, f2)), and the sum of the
+        # minimums is zero at positions either sample does not cover.
+        minimums = np.zeros((nSamples, nSamples))
+        rows = max(1, _L1_BROADCAST_SIZE // max(frequencies.size, 1))
+        single = frequencies.astype(np.float32)
+        for start in range(0, nSamples, rows):
+            end = min(start + rows, nSamples)
+            minimums[start:end, start:] = np.minimum(
+                single[start:end, np.newaxis],
+                single[np.newaxis, start:]).sum(axis=(2, 3), dtype=float)
+        upper = np.triu(minimums, 1)
+        minimums = upper + upper.T + np.diag(np.diag(minimums))
+        return 2.0 * (joint - minimums), joint
+
+    # Hudson's Fst, as in allel.hudson_fst: the mean number of pairwise
+    # differences between the two samples and within each of them.
+    flat = frequencies.reshape(nSamples, -1)
+    between = joint - flat @ flat.T
+    within = np.divide(coverage ** 2 - (alleleCounts ** 2).sum(axis=2),
+                       coverage * (coverage - 1),
+                       out=np.zeros_like(coverage),
+                       where=covered & (coverage > 1))
+    withinSum = (within @ coveredFloat.T + coveredFloat @ within.T) / 2.0
+    return between - withinSum, between
+
+
+def _chunkCounts(samples, start, end):
+    """
+    Stack the base counts of a chunk of positions of all samples.
+
+    @param samples: A C{list} of C{MinorVariantInfo} instances.
+    @param start: The C{int} 0-based start position of the chunk.
+    @param end: The C{int} 0-based end position (exclusive) of the chunk.
+    @return: An C{int} array of shape (samples, end - start, len(BASES)).
+    """
+    return np.stack([sample.counts[start:end] for sample in samples])
+
+
+def pairwiseDistances(samples, metric='l1', minCoverage=50,
+                      chunkSize=PAIRWISE_CHUNK_SIZE, workers=None):
+    """
+    Compute the distance or differentiation between all pairs of samples
+    from their base frequencies, over the positions both samples cover.
+
+    The cohort is processed in chunks of positions, in parallel worker
+    processes, and each chunk is reduced to sums over all pairs of samples
+    at once with matrix operations. Only as many chunks as there are workers
+    (times two) are in memory at any time.
+
+    @param samples: An iterable of C{MinorVariantInfo} instances, all of the
+        same length.
+    @param metric: The C{str} distance to compute. 'l1' is the mean, over the
+        positions both samples cover, of the L1 distance between the two
+        samples' frequencies of A, C, G, T and deletions (between 0 and 2).
+        'fst' is Hudson's Fst, taking each sample as a population and the
+        reads of a sample as its individuals, combined over positions as a
+        ratio of sums, as with C{allel.hudson_fst}.
+    @param minCoverage: The C{int} coverage (of A, C, G, T and deletions)
+        needed at a position for it to be used.
+    @param chunkSize: The C{int} number of positions in each chunk.
+    @param workers: The C{int} number of worker processes, or C{None} to use
+        one per CPU. With 1, everything is computed in this process.
+    @raise ValueError: If C{metric} is unknown or the samples do not all have
+        the same length.
+    @return: A square C{float} array with the distance between each pair of
+        samples (in the order of C{samples}), NaN where it is undefined
+        (e.g., for pairs that cover no position in common), and zeros on the
+        diagonal.
+    """
+    if metric not in PAIRWISE_METRICS:
+        raise ValueError('Unknown metric %r. Use one of %s.' % (
+            metric, ', '.join(map(repr, PAIRWISE_METRICS))))
+
+    samples = list(samples)
+    nSamples = len(samples)
+    numerators = np.zeros((nSamples, nSamples))
+    denominators = np.zeros((nSamples, nSamples))
+
+    if samples:
+        length = len(samples[0].counts)
+        for sample in samples:
+            if len(sample.counts) != length:
+                raise ValueError(
+                    'All samples must have the same length (%d), not %d.' %
+                    (length, len(sample.counts)))
+
+        starts = range(0, length, chunkSize)
+
+        if workers == 1:
+            for start in starts:
+                numerator, denominator = _pairwiseSums(
+                    _chunkCounts(samples, start, start + chunkSize),
+                    metric, minCoverage)
+                numerators += numerator
+                denominators += denominator
+        else:
+            workers = workers or os.cpu_count()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = set()
+                starts = iter(starts)
+                while True:
+                    for start in starts:
+                        pending.add(executor.submit(
+                            _pairwiseSums,
+                            _chunkCounts(samples, start, start + chunkSize),
+                            metric, minCoverage))
+                        if len(pending) >= 2 * workers:
+                            break
+                    if not pending:
+                        break
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        numerator, denominator = future.result()
+                        numerators += numerator
+                        denominators += denominator
+
+    distances = np.divide(numerators, denominators,
+                          out=np.full((nSamples, nSamples), np.nan),
+                          where=denominators > 0)
+    np.fill_diagonal(distances, 0.0)
+
+    return distances
@@ -6,6 +6,9 @@ import mvlib
 TOPDIR = dirname(dirname(mvlib.__file__))
 DATADIR = join(TOPDIR, 'data')
 
+# The order of the bases in count arrays. '-' is a deletion.
+BASES = ('A', 'C', 'G', 'T', 'N', '-')
+
 NTCOLORS = {
     'A': '#1f76b4',  # blue
     'T': '#ff7e0e',  # orange
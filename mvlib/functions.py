@@ -1,7 +1,65 @@
 from collections import defaultdict, Counter
+from contextlib import closing, contextmanager
+import gzip
+import io
+from itertools import chain
+from os.path import join
+from queue import Full, Queue
+import re
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
 
-from dark.reads import Reads
-from dark.sam import SAMFilter, samfile
+import numpy as np
+from pysam import (AlignmentFile, CDEL, CDIFF, CEQUAL, CINS, CMATCH,
+                   CREF_SKIP, CSOFT_CLIP, FDUP, FQCFAIL, FSECONDARY,
+                   FSUPPLEMENTARY, FUNMAP)
+
+from mvlib.common import BASES
+from mvlib.sars2features import VI
+
+BASE_INDEX = {base: index for index, base in enumerate(BASES)}
+_N_INDEX = BASE_INDEX['N']
+
+# Map the first character of a pysam pileup entry to its index in BASES.
+# Reference skips map to None.
+_PILEUP_BASE_INDEX = dict(BASE_INDEX)
+_PILEUP_BASE_INDEX.update(
+    {base.lower(): index for base, index in BASE_INDEX.items()})
+_PILEUP_BASE_INDEX.update({'*': BASE_INDEX['-'], '#': BASE_INDEX['-'],
+                           '>': None, '<': None})
+
+# Map the bytes of read sequences to their indices in BASES.
+_READ_BASE_INDEX = np.full(256, _N_INDEX, dtype=np.uint8)
+for _base, _index in BASE_INDEX.items():
+    if _base != '-':
+        _READ_BASE_INDEX[ord(_base)] = _READ_BASE_INDEX[ord(_base.lower())] = (
+            _index)
+
+# The CIGAR operations that align read bases to reference positions.
+_CIGAR_ALIGNED = {CMATCH, CEQUAL, CDIFF}
+
+# The number of entries collected from streamed reads before they are added
+# to the counts.
+STREAM_BATCH_SIZE = 1 << 20
+
+# The number of items passed at a time from the reading to the counting
+# thread by pipelined, and the number of such batches that may wait.
+PIPELINE_BATCH_SIZE = 256
+PIPELINE_QUEUE_SIZE = 16
+
+# Lower edges of the base quality bins: Phred <10, 10-19, 20-29 and 30+.
+DEFAULT_QUALITY_BINS = (0, 10, 20, 30)
+
+# The flags pysam (and samtools mpileup) filter on by default.
+DEFAULT_FLAG_FILTER = FUNMAP | FSECONDARY | FQCFAIL | FDUP
+
+# The compression used for files with these suffixes, and the magic bytes
+# that compressed files start with.
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+_COMPRESSION_MAGIC = {'gzip': b'\x1f\x8b', 'zstd': b'\x28\xb5\x2f\xfd'}
+
+# A region given as 1-based inclusive coordinates, e.g. '23567-23626'.
+_REGION_RE = re.compile(r'^(\d+)-(\d+)$')
 
 
 def isMinorVariantPosition(bases, minDepth, minFrequency):
@@ -38,62 +96,1093 @@ def isMinorVariantPosition(bases, minDepth, minFrequency):
         return False
 
 
-def getBaseFrequencies(bamFile, minBaseQuality=0, minMappingQuality=0,
-                       referenceId=False):
+def readFilterFlags(dropSecondary=True, dropSupplementary=False,
+                    dropDuplicates=True, keepQCFailures=False):
     """
-    Takes a bam file and returns a dictionary where the key maps to a position
-    and the values map to a Counter with the number of each base at that
-    position.
+    Make a SAM flag bitmask for filtering reads. Reads that have any of the
+    returned flags set are skipped by htslib during the pileup, so they never
+    reach Python. Unmapped reads are always skipped. (A minimum read length,
+    in contrast, is applied in Python, as htslib has no filter for it.)
+
+    @param dropSecondary: If C{True}, skip secondary alignments.
+    @param dropSupplementary: If C{True}, skip supplementary alignments.
+    @param dropDuplicates: If C{True}, skip reads marked as PCR or optical
+        duplicates.
+    @param keepQCFailures: If C{True}, keep reads that failed vendor quality
+        checks.
+    @return: An C{int} SAM flag bitmask.
+    """
+    flags = FUNMAP
+
+    if dropSecondary:
+        flags |= FSECONDARY
+    if dropSupplementary:
+        flags |= FSUPPLEMENTARY
+    if dropDuplicates:
+        flags |= FDUP
+    if not keepQCFailures:
+        flags |= FQCFAIL
+
+    return flags
+
+
+def writeReferenceFasta(virus, referenceLengths, filename):
+    """
+    Write the genome of a virus to a FASTA file, once under each of the given
+    reference ids that has the length of the genome. This makes a reference
+    file for decoding a CRAM file that was made with a differently named copy
+    of the genome.
+
+    @param virus: One of 'SARS2', 'WNV' or 'YFV'.
+    @param referenceLengths: A C{dict} mapping C{str} reference ids to their
+        C{int} lengths, as found in the header of a SAM/BAM/CRAM file.
+    @param filename: The C{str} name of the FASTA file to write.
+    @raise ValueError: If none of the references has the length of the virus
+        genome.
+    """
+    genome = VI[virus]['g'].sequence
+    referenceIds = [referenceId for referenceId, length in
+                    referenceLengths.items() if length == len(genome)]
+
+    if not referenceIds:
+        raise ValueError(
+            'No reference (%s) has the length (%d) of the %s genome.' % (
+                ', '.join(sorted(referenceLengths)), len(genome), virus))
+
+    with open(filename, 'w') as fp:
+        for referenceId in referenceIds:
+            print('>%s\n%s' % (referenceId, genome), file=fp)
+
+
+@contextmanager
+def alignmentFile(filename, threads=1, reference=None):
+    """
+    A context manager to open and close a SAM, BAM or CRAM file.
+
+    @param filename: A C{str} file name to open.
+    @param threads: The C{int} number of threads htslib should use to
+        decompress the file.
+    @param reference: The reference needed to decode a CRAM file. Either a
+        C{str} FASTA file name or one of 'SARS2', 'WNV' or 'YFV' to use the
+        genomes in C{mvlib.common}. Not needed for SAM or BAM files.
+    @raise ValueError: If C{reference} is a built-in genome and C{filename}
+        is '-', as the header it is matched against would have to be read
+        before the file is opened to be counted.
+    """
+    if reference in VI:
+        if filename == '-':
+            raise ValueError(
+                'The built-in %s genome cannot be used as the reference when '
+                'reading standard input. Give a FASTA file instead.' %
+                reference)
+        with AlignmentFile(filename) as sam:
+            referenceLengths = dict(zip(sam.references, sam.lengths))
+
+        with TemporaryDirectory() as tempdir:
+            fastaFile = join(tempdir, '%s.fasta' % reference)
+            writeReferenceFasta(reference, referenceLengths, fastaFile)
+            with AlignmentFile(filename, threads=threads,
+                               reference_filename=fastaFile) as sam:
+                yield sam
+    else:
+        with AlignmentFile(filename, threads=threads,
+                           reference_filename=reference) as sam:
+            yield sam
+
+
+def compressionFromFilename(filename):
+    """
+    Get the compression to use for a file from its suffix.
+
+    @param filename: A C{str} file name.
+    @return: 'gzip' or 'zstd' if C{filename} has one of the suffixes in
+        C{COMPRESSION_SUFFIXES}, else C{None}.
+    """
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if filename.endswith(suffix):
+            return compression
+
+
+def _zstandard():
+    """
+    Import the optional zstandard package.
+
+    @raise ValueError: If zstandard is not installed.
+    @return: The C{zstandard} module.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError('The zstandard package must be installed to read or '
+                         'write zstd compressed files.')
+    return zstandard
+
+
+@contextmanager
+def dataFile(file, mode='r', compression=None):
+    """
+    A context manager to open a text file that may be compressed. When
+    reading, gzip and zstd compressed files are recognized from their first
+    bytes. When writing, the compression is taken from the suffix of the file
+    name unless C{compression} is given.
+
+    @param file: A C{str} file name, or a binary file object (e.g.,
+        C{sys.stdout.buffer}), which is not closed.
+    @param mode: Either 'r' to read or 'w' to write.
+    @param compression: When writing, C{None} to use the file name's suffix,
+        or one of 'gzip', 'zstd' or 'none'.
+    @raise ValueError: If C{mode} or C{compression} is unknown, or zstd
+        compression is used and the zstandard package is not installed.
+    """
+    if mode not in ('r', 'w'):
+        raise ValueError('Unknown mode %r. Use either \'r\' or \'w\'.' %
+                         mode)
+
+    if isinstance(file, str):
+        raw = open(file, mode + 'b')
+        if mode == 'w' and compression is None:
+            compression = compressionFromFilename(file)
+    else:
+        raw = file
+
+    try:
+        if mode == 'r':
+            magic = raw.peek(4)[:4]
+            compression = None
+            for name, prefix in _COMPRESSION_MAGIC.items():
+                if magic.startswith(prefix):
+                    compression = name
+        elif compression not in (None, 'none', 'gzip', 'zstd'):
+            raise ValueError('Unknown compression %r. Use one of \'gzip\', '
+                             '\'zstd\' or \'none\'.' % compression)
+
+        if compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=raw, mode=mode + 'b')
+        elif compression == 'zstd':
+            zstandard = _zstandard()
+            if mode == 'r':
+                stream = zstandard.ZstdDecompressor().stream_reader(
+                    raw, closefd=False)
+            else:
+                stream = zstandard.ZstdCompressor().stream_writer(
+                    raw, closefd=False)
+        else:
+            stream = raw
+
+        fp = io.TextIOWrapper(stream, encoding='utf-8')
+        try:
+            yield fp
+        finally:
+            if mode == 'w':
+                fp.flush()
+            # Detach so that closing the text wrapper does not close the
+            # caller's file object.
+            fp.detach()
+            if stream is not raw:
+                stream.close()
+    finally:
+        if raw is not file:
+            raw.close()
+
+
+def compressBytes(data, compression):
+    """
+    Compress bytes.
+
+    @param data: The C{bytes} to compress.
+    @param compression: One of 'gzip', 'zstd' or 'none'.
+    @raise ValueError: If C{compression} is unknown, or is 'zstd' and the
+        zstandard package is not installed.
+    @return: The compressed C{bytes}.
+    """
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    elif compression == 'zstd':
+        return _zstandard().ZstdCompressor().compress(data)
+    elif compression == 'none':
+        return data
+    else:
+        raise ValueError('Unknown compression %r. Use one of \'gzip\', '
+                         '\'zstd\' or \'none\'.' % compression)
+
+
+def decompressBytes(data, compression):
+    """
+    Decompress bytes compressed with C{compressBytes}.
+
+    @param data: The compressed C{bytes}.
+    @param compression: One of 'gzip', 'zstd' or 'none'.
+    @raise ValueError: If C{compression} is unknown, or is 'zstd' and the
+        zstandard package is not installed.
+    @return: The decompressed C{bytes}.
+    """
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    elif compression == 'zstd':
+        return _zstandard().ZstdDecompressor().decompress(data)
+    elif compression == 'none':
+        return data
+    else:
+        raise ValueError('Unknown compression %r. Use one of \'gzip\', '
+                         '\'zstd\' or \'none\'.' % compression)
+
+
+def pileupBaseIndex(entry):
+    """
+    Get the index in C{BASES} of the base in a pileup entry, as returned by
+    C{PileupColumn.get_query_sequences(mark_matches=True, add_indels=True)}.
+
+    @param entry: A C{str} pileup entry. Its first character is the base
+        (lower case on the reverse strand), '*' or '#' for a deletion or '>'
+        or '<' for a reference skip. Any indel that follows is ignored.
+    @return: The C{int} index of the base in C{BASES} (unknown bases are
+        counted as 'N'), or C{None} for a reference skip.
+    """
+    return _PILEUP_BASE_INDEX.get(entry[0], _N_INDEX)
+
+
+def pileupInsertion(entry):
+    """
+    Get the inserted sequence in a pileup entry, as returned by
+    C{PileupColumn.get_query_sequences(mark_matches=True, add_indels=True)}.
+    An insertion is shown after the base that precedes it, e.g., 'T+2ac'.
+
+    @param entry: A C{str} pileup entry.
+    @return: The C{str} upper case inserted sequence, or C{None} if there is
+        no insertion after the entry's base.
+    """
+    start = entry.find('+')
+
+    if start == -1:
+        return None
+
+    end = start + 1
+    while entry[end].isdigit():
+        end += 1
+
+    return entry[end:end + int(entry[start + 1:end])].upper()
+
+
+def readEntries(read):
+    """
+    Find the pileup entries of an aligned read, i.e., the base or deletion
+    it has at each reference position it covers, and its insertions.
+
+    @param read: A C{pysam.AlignedSegment} with a sequence.
+    @return: A 4-C{tuple} with an C{int} array of the 0-based reference
+        positions covered by the read, a C{numpy.uint8} array of the indices
+        (in C{BASES}) of the read's base at each of them, a C{numpy.uint8}
+        array of their base qualities (for a deletion, that of the base
+        following it, as in a pileup), and a C{list} of (position, quality,
+        sequence) C{tuple}s for the insertions of the read, with the position
+        and quality of the entry before the insertion and the upper case
+        inserted sequence.
+    """
+    sequence = read.query_sequence
+    bases = _READ_BASE_INDEX[np.frombuffer(sequence.encode('ascii'),
+                                           dtype=np.uint8)]
+    readQualities = read.query_qualities
+    if readQualities is None:
+        # Missing qualities are 0xff in BAM, as in a pileup.
+        qualities = np.full(len(sequence), 255, dtype=np.uint8)
+    else:
+        qualities = np.frombuffer(readQualities, dtype=np.uint8)
+
+    positions = []
+    baseIndices = []
+    entryQualities = []
+    insertions = []
+    referencePosition = read.reference_start
+    queryPosition = 0
+    # The quality of the read's entry at the previous reference position,
+    # if it has one.
+    previousQuality = None
+
+    for operation, length in read.cigartuples:
+        if operation in _CIGAR_ALIGNED:
+            end = queryPosition + length
+            positions.append(np.arange(referencePosition,
+                                       referencePosition + length))
+            baseIndices.append(bases[queryPosition:end])
+            entryQualities.append(qualities[queryPosition:end])
+            previousQuality = int(qualities[end - 1])
+            referencePosition += length
+            queryPosition = end
+        elif operation == CDEL:
+            quality = (int(qualities[queryPosition])
+                       if queryPosition < len(qualities) else 0)
+            positions.append(np.arange(referencePosition,
+                                       referencePosition + length))
+            baseIndices.append(np.full(length, BASE_INDEX['-'],
+                                       dtype=np.uint8))
+            entryQualities.append(np.full(length, quality, dtype=np.uint8))
+            previousQuality = quality
+            referencePosition += length
+        elif operation == CREF_SKIP:
+            previousQuality = None
+            referencePosition += length
+        elif operation == CINS:
+            if previousQuality is not None:
+                insertions.append(
+                    (referencePosition - 1, previousQuality,
+                     sequence[queryPosition:queryPosition + length].upper()))
+            queryPosition += length
+        elif operation == CSOFT_CLIP:
+            queryPosition += length
+
+    if positions:
+        return (np.concatenate(positions), np.concatenate(baseIndices),
+                np.concatenate(entryQualities), insertions)
+    else:
+        return (np.empty(0, dtype=int), np.empty(0, dtype=np.uint8),
+                np.empty(0, dtype=np.uint8), insertions)
+
+
+def readGroupSamples(header):
+    """
+    Find the samples of the read groups in the header of a SAM/BAM/CRAM file.
+
+    @param header: A C{pysam.AlignmentHeader}.
+    @return: A 2-C{tuple} with a C{list} of the C{str} sample names, in the
+        order they first appear in the header, and a C{dict} mapping each
+        C{str} read group id to the index of its sample in that C{list}. The
+        sample of a read group is its SM field or, if it has none, its id.
+        Read groups with the same sample name share an index.
+    """
+    samples = []
+    groupIndex = {}
+    sampleIndex = {}
+
+    for readGroup in header.to_dict().get('RG', []):
+        sample = readGroup.get('SM', readGroup['ID'])
+        if sample not in sampleIndex:
+            sampleIndex[sample] = len(samples)
+            samples.append(sample)
+        groupIndex[readGroup['ID']] = sampleIndex[sample]
+
+    return samples, groupIndex
+
+
+def _readGroupIndex(read, groupIndex, default):
+    """
+    Get the index of the sample of a read's read group.
+
+    @param read: A C{pysam.AlignedSegment}.
+    @param groupIndex: A C{dict} mapping C{str} read group ids to C{int}
+        sample indices, as returned by C{readGroupSamples}.
+    @param default: The C{int} index to use for a read without a read group
+        or with one that is not in C{groupIndex}.
+    @return: An C{int} sample index.
+    """
+    try:
+        return groupIndex.get(read.get_tag('RG'), default)
+    except KeyError:
+        return default
+
+
+def pipelined(iterable, batchSize=PIPELINE_BATCH_SIZE,
+              queueSize=PIPELINE_QUEUE_SIZE):
+    """
+    Produce the items of an iterable in another thread, so that producing
+    them (e.g., reading and decoding alignments, which htslib does without
+    holding the GIL) overlaps with consuming them.
+
+    The items are passed in batches through a bounded queue, so the
+    producing thread waits when the consumer falls behind. The items must
+    not depend on the state of the iterable after they are produced (e.g.,
+    a pysam pileup column does).
+
+    @param iterable: An iterable.
+    @param batchSize: The C{int} number of items to pass at a time.
+    @param queueSize: The C{int} maximum number of batches waiting to be
+        consumed.
+    @raise Exception: Whatever exception iterating C{iterable} raises.
+    @return: A generator of the items of C{iterable}.
+    """
+    batches = Queue(maxsize=queueSize)
+    stop = Event()
+
+    def put(batch, error=None):
+        # Give up if the consumer has stopped, so the thread can end.
+        while not stop.is_set():
+            try:
+                batches.put((batch, error), timeout=0.1)
+            except Full:
+                pass
+            else:
+                return True
+        return False
+
+    def produce():
+        batch = []
+        try:
+            for item in iterable:
+                batch.append(item)
+                if len(batch) == batchSize:
+                    if not put(batch):
+                        return
+                    batch = []
+        except Exception as e:
+            put(None, e)
+        else:
+            if not batch or put(batch):
+                put(None)
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            batch, error = batches.get()
+            if error is not None:
+                raise error
+            if batch is None:
+                break
+            yield from batch
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _streamReads(sam, referenceId, minMappingQuality, flagFilter,
+                 minReadLength, strand, groupIndex, otherGroup):
+    """
+    Read and decode the alignments of a SAM/BAM/CRAM file, in the order they
+    are in the file. See C{getBaseCounts} for the parameters.
+
+    @param sam: An open C{pysam.AlignmentFile}.
+    @param groupIndex: A C{dict} mapping C{str} read group ids to sample
+        indices.
+    @param otherGroup: The C{int} sample index of reads in no sample of
+        C{groupIndex}.
+    @return: A generator of (sample index, strand index, entries) C{tuple}s
+        for the reads that pass the filters, where entries is as returned by
+        C{readEntries}.
+    """
+    referenceIndex = sam.get_tid(referenceId)
+
+    for read in sam.fetch(until_eof=True):
+        if (read.flag & flagFilter or read.is_unmapped or
+                read.reference_id != referenceIndex or
+                read.mapping_quality < minMappingQuality or
+                read.query_sequence is None or
+                (minReadLength and read.query_length < minReadLength)):
+            continue
 
-    @param bamFile: A C{str} filename of a bam file.
+        group = (_readGroupIndex(read, groupIndex, otherGroup) if groupIndex
+                 else otherGroup)
+        yield (group, int(read.is_reverse) if strand else 0,
+               readEntries(read))
+
+
+def _streamCounts(sam, referenceId, allCounts, insertionCounts, insertions,
+                  minBaseQuality, minMappingQuality, flagFilter,
+                  minReadLength, qualityBins, strand, insertionSequences,
+                  inRegions, groupIndex, pipeline):
+    """
+    Add the bases of the reads in a SAM/BAM/CRAM file, in the order they are
+    read, to counts arrays. See C{getBaseCounts} for the parameters.
+
+    @param sam: An open C{pysam.AlignmentFile}.
+    @param allCounts: An C{int} array of shape (samples, quality bins,
+        strands, reference length, len(BASES)) to add the base counts to.
+    @param insertionCounts: An C{int} array of shape (samples, reference
+        length) to add the number of reads with an insertion after each
+        position to.
+    @param insertions: A C{list} with a C{dict} for each sample to add the
+        C{Counter}s of the inserted sequences after each position to.
+    @param inRegions: A C{bool} array that is C{True} at the reference
+        positions to count.
+    @param groupIndex: A C{dict} mapping C{str} read group ids to the index
+        of their sample in C{allCounts}. Other reads are counted in the last
+        sample.
+    @param pipeline: If C{True}, read and decode the alignments in another
+        thread.
+    """
+    nGroups, nBins, nStrands, referenceLength, nBases = allCounts.shape
+    otherGroup = nGroups - 1
+    flatCounts = allCounts.reshape(-1)
+    batch = []
+    batchSize = 0
+
+    def addBatch():
+        flatCounts[:] += np.bincount(np.concatenate(batch),
+                                     minlength=len(flatCounts))
+
+    reads = _streamReads(sam, referenceId, minMappingQuality, flagFilter,
+                         minReadLength, strand, groupIndex, otherGroup)
+    if pipeline:
+        reads = pipelined(reads)
+
+    # Close the reads before the file is, so a reading thread has stopped.
+    with closing(reads):
+        for group, strandIndex, entries in reads:
+            positions, baseIndices, qualities, readInsertions = entries
+            keep = (qualities >= minBaseQuality) & inRegions[positions]
+            positions = positions[keep]
+
+            if qualityBins:
+                bins = np.searchsorted(qualityBins, qualities[keep],
+                                       side='right') - 1
+            else:
+                bins = 0
+
+            batch.append(
+                (((group * nBins + bins) * nStrands + strandIndex) *
+                 referenceLength + positions) * nBases + baseIndices[keep])
+            batchSize += len(positions)
+
+            for position, quality, inserted in readInsertions:
+                if quality >= minBaseQuality and inRegions[position]:
+                    insertionCounts[group, position] += 1
+                    if insertionSequences:
+                        insertions[group].setdefault(position, Counter())[
+                            inserted] += 1
+
+            if batchSize >= STREAM_BATCH_SIZE:
+                addBatch()
+                batch = []
+                batchSize = 0
+
+    if batch:
+        addBatch()
+
+
+def parseRegions(regions, virus=None):
+    """
+    Convert regions of a genome to 0-based offsets.
+
+    @param regions: An iterable of regions. Each is either a C{str} gene name
+        (see the offsets in C{mvlib.common}), a C{str} of 1-based inclusive
+        coordinates, e.g. '23567-23626', or a C{tuple} of 0-based start and
+        (exclusive) end offsets.
+    @param virus: One of 'SARS2', 'WNV' or 'YFV', whose gene offsets are used
+        to find the regions given as gene names.
+    @raise ValueError: If a region is empty, or is a gene name and C{virus}
+        is not given or does not have that gene.
+    @return: A sorted C{list} of (start, end) C{tuple}s of 0-based offsets,
+        with overlapping and adjacent regions merged.
+    """
+    offsets = []
+    for region in regions:
+        if isinstance(region, str):
+            match = _REGION_RE.match(region)
+            if match:
+                start, end = int(match.group(1)) - 1, int(match.group(2))
+            elif virus is None:
+                raise ValueError('The virus must be given to find the '
+                                 'offsets of gene %r.' % region)
+            elif region in VI[virus]['o']:
+                start, end = VI[virus]['o'][region]
+            else:
+                raise ValueError('Unknown %s gene %r. Known genes are %s.' % (
+                    virus, region, ', '.join(VI[virus]['o'])))
+        else:
+            start, end = region
+
+        if start < 0 or start >= end:
+            raise ValueError('Region %r is empty or starts before the '
+                             'genome.' % (region,))
+
+        offsets.append((start, end))
+
+    merged = []
+    for start, end in sorted(offsets):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return merged
+
+
+def checkQualityBins(qualityBins):
+    """
+    Check that base quality bins are usable.
+
+    @param qualityBins: A C{list} of C{int} lower bin edges.
+    @raise ValueError: If C{qualityBins} does not start at zero or is not
+        strictly increasing.
+    """
+    if (not qualityBins or qualityBins[0] != 0 or
+            any(a >= b for a, b in zip(qualityBins, qualityBins[1:]))):
+        raise ValueError('Quality bins %r must start at 0 and be strictly '
+                         'increasing.' % (qualityBins,))
+
+
+def getBaseCounts(bamFile, minBaseQuality=0, minMappingQuality=0,
+                  referenceId=False, flagFilter=DEFAULT_FLAG_FILTER,
+                  minReadLength=None, threads=1, reference=None,
+                  qualityBins=None, strand=False, insertionSequences=False,
+                  regions=None, virus=None, stream=False, readGroups=False,
+                  pipeline=False):
+    """
+    Count the bases at each position of a reference in a single pass over a
+    BAM or CRAM file.
+
+    @param bamFile: A C{str} filename of a BAM or CRAM file.
     @param minBaseQuality: Minimum base quality. Bases below the minimum
         quality will not be output.
     @param minMappingQuality: Only use reads above a minimum mapping quality.
     @param referenceId: The Id of the reference sequence to use. In case a BAM
         file contains multiple references.
+    @param flagFilter: An C{int} SAM flag bitmask (see C{readFilterFlags}).
+        Reads with any of these flags set are not used.
+    @param minReadLength: If not C{None}, an C{int} minimum read length. Reads
+        that are shorter are not used. Unlike the other filters, this is not
+        applied by htslib, but in Python to the reads of each pileup column.
+    @param threads: The C{int} number of threads htslib should use to
+        decompress the file.
+    @param reference: The reference needed to decode a CRAM file, as accepted
+        by C{alignmentFile}.
+    @param qualityBins: If not C{None}, a C{list} of C{int} lower base quality
+        bin edges, starting at 0 (e.g., C{DEFAULT_QUALITY_BINS}). Bases are
+        then also counted per quality bin. The quality of a deletion is that
+        of the base following it.
+    @param strand: If C{True}, also count the bases separately for reads
+        aligned to the forward and to the reverse strand.
+    @param insertionSequences: If C{True}, also count the inserted sequences
+        after each position.
+    @param regions: If not C{None}, an iterable of regions, as accepted by
+        C{parseRegions}, to count the bases in. Only the parts of the BAM or
+        CRAM file (which must be indexed) that cover them are read. Positions
+        outside the regions get zero counts.
+    @param virus: One of 'SARS2', 'WNV' or 'YFV', needed to find C{regions}
+        given as gene names.
+    @param stream: If C{True}, read the alignments once, in the order they
+        are in the file, and add each read's bases to the counts, instead of
+        making a pileup. The file then does not need to be sorted or
+        indexed, and can be '-' to read SAM or BAM from standard input.
+        As in the pileup, the bases of both mates are counted where they
+        overlap, so the counts are the same.
+    @param readGroups: If C{True}, also count the reads of each sample (see
+        C{readGroupSamples}) in the read groups of the file header
+        separately, in the same pass.
+    @param pipeline: If C{True}, read and decode the alignments (or pileup
+        columns) in a separate thread from the one that counts them, passing
+        them through a bounded queue (see C{pipelined}), so reading and
+        counting overlap. This only speeds up a stream: the columns of a
+        pileup are converted in Python, holding the GIL, so counting them
+        in another thread is no faster and can be slower.
+    @raise ValueError: If C{referenceId} is not in the BAM file, or if it is
+        not given and the BAM file has more than one reference, or if
+        C{qualityBins} or C{regions} are not usable, or if C{readGroups} is
+        C{True} and the file header has no read groups, or if C{reference}
+        is a built-in genome and C{bamFile} is '-'.
+    @return: A C{dict} with keys 'referenceId' (the C{str} reference used),
+        'regions' (a C{list} of the (start, end) 0-based offsets of the
+        regions counted, or C{None} if the whole reference was counted),
+        'counts' (an C{int} array of shape (reference length, len(BASES))
+        with the count of each base at each position of the reference)
+        and, if
+        C{qualityBins} was given, 'qualityBinCounts' (an C{int} array of
+        shape (len(qualityBins), reference length, len(BASES))) and, if
+        C{strand} is C{True}, 'strandCounts' (an C{int} array of shape
+        (2, reference length, len(BASES)) with the forward strand counts
+        first). The 'insertionCounts' key holds an C{int} array with the
+        number of reads that have an insertion after each position and, if
+        C{insertionSequences} is C{True}, 'insertionSequences' holds a
+        C{dict} mapping positions with insertions after them to a
+        C{Counter} of the inserted sequences. If C{readGroups} is C{True},
+        'samples' holds a C{dict} mapping each sample name to a C{dict} with
+        the same count keys for the reads of that sample alone. Reads
+        without a read group from the header are only in the overall counts.
     """
-    reads = Reads().filter()
+    if qualityBins:
+        checkQualityBins(qualityBins)
 
-    samFilter = SAMFilter(bamFile, filterRead=reads.filterRead)
+    with alignmentFile(bamFile, threads=threads, reference=reference) as sam:
+        referenceLengths = dict(zip(sam.references, sam.lengths))
 
-    referenceLengths = samFilter.referenceLengths()
+        if referenceId:
+            if referenceId not in referenceLengths:
+                raise ValueError('Reference %r not present in SAM file %r.' %
+                                 (referenceId, bamFile))
+        elif len(referenceLengths) == 1:
+            referenceId = sam.references[0]
+        else:
+            raise ValueError(
+                'SAM file %r contains %d references (%s). Only one '
+                'reference id can be analyzed at a time.' % (
+                    bamFile, len(referenceLengths),
+                    ', '.join(sorted(referenceLengths))))
 
-    result = {}
+        referenceLength = referenceLengths[referenceId]
 
-    with samfile(bamFile) as sam:
-        if not referenceId:
-            if samFilter.referenceIds:
-                # No need to check if the given reference id is in
-                # referenceLengths because the samFilter.referenceLengths call
-                # above caught that.
-                referenceId = samFilter.referenceIds.pop()
+        if readGroups:
+            samples, groupIndex = readGroupSamples(sam.header)
+            if not samples:
+                raise ValueError('SAM file %r has no read groups.' % bamFile)
+        else:
+            samples, groupIndex = [], {}
+
+        if regions is None:
+            pileupRegions = [(None, None)]
+        else:
+            regions = parseRegions(regions, virus)
+            for start, end in regions:
+                if end > referenceLength:
+                    raise ValueError(
+                        'Region %d-%d extends beyond the end of reference %r '
+                        '(length %d).' % (start + 1, end, referenceId,
+                                          referenceLength))
+            pileupRegions = regions
+
+        # The counts of each sample, with those of reads not in any of them
+        # last.
+        nGroups = len(samples) + 1
+        otherGroup = nGroups - 1
+        nBins = len(qualityBins) if qualityBins else 1
+        nStrands = 2 if strand else 1
+        allCounts = np.zeros(
+            (nGroups, nBins, nStrands, referenceLength, len(BASES)),
+            dtype=int)
+        insertionCounts = np.zeros((nGroups, referenceLength), dtype=int)
+        insertions = [{} for _ in range(nGroups)]
+
+        if stream:
+            if regions is None:
+                inRegions = np.ones(referenceLength, dtype=bool)
             else:
-                if len(referenceLengths) == 1:
-                    referenceId = list(referenceLengths)[0]
-                else:
-                    print('SAM file %r contains %d references (%s). Only one '
-                          'reference id can be analyzed at a time.' % (
-                              bamFile, len(referenceLengths),
-                              ', '.join(sorted(referenceLengths))))
-
-        for i, column in enumerate(sam.pileup(
-                                   reference=referenceId,
-                                   min_base_quality=minBaseQuality,
-                                   min_mapping_quality=minMappingQuality,
-                                   ignore_overlap=False,
-                                   max_depth=1000000)):
-            bases = Counter()
-            for read in column.pileups:
-                if (not read.is_del and not read.is_refskip):
-                    base = read.alignment.query_sequence[read.query_position]
-                    bases[base] += 1
-                elif read.is_del:
-                    bases['-'] += 1
-
-            result[column.reference_pos] = bases
-
-        for position in range(referenceLengths[referenceId]):
-            if position not in result:
-                result[position] = Counter({'A': 0, 'T': 0, 'G': 0, 'C': 0})
+                inRegions = np.zeros(referenceLength, dtype=bool)
+                for start, end in regions:
+                    inRegions[start:end] = True
+            _streamCounts(sam, referenceId, allCounts, insertionCounts,
+                          insertions, minBaseQuality, minMappingQuality,
+                          flagFilter, minReadLength, qualityBins, strand,
+                          insertionSequences, inRegions, groupIndex,
+                          pipeline)
+            # There is then nothing to pile up.
+            pileupRegions = ()
+
+        # The pileup of each region is only started once the previous one is
+        # used up, as they share a single iterator.
+        columns = chain.from_iterable(
+            sam.pileup(reference=referenceId, start=start, stop=end,
+                       truncate=regions is not None,
+                       min_base_quality=minBaseQuality,
+                       min_mapping_quality=minMappingQuality,
+                       flag_filter=flagFilter,
+                       ignore_overlaps=False,
+                       max_depth=1000000,
+                       multiple_iterators=False)
+            for start, end in pileupRegions)
+
+        columnKeys = _pileupKeys(columns, minReadLength, qualityBins, strand,
+                                 groupIndex, otherGroup)
+        if pipeline:
+            columnKeys = pipelined(columnKeys)
+
+        # Stop a reading thread before the file is closed, even on an error.
+        with closing(columnKeys):
+            for position, keys in columnKeys:
+                counts = allCounts[:, :, :, position]
+                for (entry, bin_, strand_, group), count in Counter(
+                        keys).items():
+                    index = pileupBaseIndex(entry)
+                    if index is not None:
+                        counts[group, bin_, strand_, index] += count
+                    if '+' in entry:
+                        insertionCounts[group, position] += count
+                        if insertionSequences:
+                            insertions[group].setdefault(position, Counter())[
+                                pileupInsertion(entry)] += count
+
+    allInsertions = {}
+    for groupInsertions in insertions:
+        for position, counter in groupInsertions.items():
+            allInsertions.setdefault(position, Counter()).update(counter)
+
+    result = _countsResult(allCounts.sum(axis=0), insertionCounts.sum(axis=0),
+                           allInsertions, qualityBins, strand,
+                           insertionSequences)
+    result['referenceId'] = referenceId
+    result['regions'] = regions
+
+    if readGroups:
+        result['samples'] = {
+            sample: _countsResult(allCounts[index], insertionCounts[index],
+                                  insertions[index], qualityBins, strand,
+                                  insertionSequences)
+            for index, sample in enumerate(samples)}
 
     return result
+
+
+def _pileupKeys(columns, minReadLength, qualityBins, strand, groupIndex,
+                otherGroup):
+    """
+    Decode pileup columns into what is counted at each position. See
+    C{getBaseCounts} for the parameters.
+
+    @param columns: An iterable of C{pysam.PileupColumn}s.
+    @param groupIndex: A C{dict} mapping C{str} read group ids to sample
+        indices, or an empty C{dict} if read groups are not counted.
+    @param otherGroup: The C{int} sample index of reads in no sample of
+        C{groupIndex}.
+    @return: A generator of (position, keys) C{tuple}s, where keys is a
+        C{list} with an (entry, quality bin, strand, sample) C{tuple} for
+        each read at the 0-based reference position, the entry being as
+        returned by C{pysam.PileupColumn.get_query_sequences}.
+    """
+    for column in columns:
+        entries = column.get_query_sequences(mark_matches=True,
+                                             add_indels=True)
+        nReads = len(entries)
+
+        if qualityBins:
+            bins = (np.searchsorted(qualityBins,
+                                    column.get_query_qualities(),
+                                    side='right') - 1).tolist()
+        else:
+            bins = [0] * nReads
+
+        if strand or minReadLength or groupIndex:
+            alignments = [read.alignment for read in column.pileups]
+
+        if strand:
+            strands = [int(alignment.is_reverse) for alignment in alignments]
+        else:
+            strands = [0] * nReads
+
+        if groupIndex:
+            groups = [_readGroupIndex(alignment, groupIndex, otherGroup)
+                      for alignment in alignments]
+        else:
+            groups = [otherGroup] * nReads
+
+        keys = zip(entries, bins, strands, groups)
+
+        if minReadLength:
+            keys = [key for key, alignment in zip(keys, alignments)
+                    if alignment.query_length >= minReadLength]
+        else:
+            keys = list(keys)
+
+        yield column.reference_pos, keys
+
+
+def _countsResult(allCounts, insertionCounts, insertions, qualityBins, strand,
+                  insertionSequences):
+    """
+    Make the counts part of the result of C{getBaseCounts}.
+
+    @param allCounts: An C{int} array of shape (quality bins, strands,
+        reference length, len(BASES)) with the base counts.
+    @param insertionCounts: An C{int} array with the number of reads with an
+        insertion after each position.
+    @param insertions: A C{dict} mapping positions to C{Counter}s of the
+        sequences inserted after them.
+    @param qualityBins: The quality bins, as given to C{getBaseCounts}.
+    @param strand: C{True} if strands were counted separately.
+    @param insertionSequences: C{True} if inserted sequences were counted.
+    @return: A C{dict} with the 'counts' and 'insertionCounts' keys, and the
+        'qualityBinCounts', 'strandCounts' and 'insertionSequences' keys if
+        they were asked for.
+    """
+    result = {
+        'counts': allCounts.sum(axis=(0, 1)),
+        'insertionCounts': insertionCounts,
+    }
+
+    if qualityBins:
+        result['qualityBinCounts'] = allCounts.sum(axis=1)
+
+    if strand:
+        result['strandCounts'] = allCounts.sum(axis=0)
+
+    if insertionSequences:
+        result['insertionSequences'] = insertions
+
+    return result
+
+
+def countsToCounters(counts, offset=0):
+    """
+    Convert an array of base counts to a C{dict} of C{Counter}s, as returned
+    by C{getBaseFrequencies}.
+
+    @param counts: An C{int} array of shape (length, len(BASES)).
+    @param offset: The C{int} position of the first row of C{counts}.
+    @return: A C{dict} mapping each C{int} position to a C{Counter} of the
+        bases with a non-zero count there. Positions without any bases get a
+        C{Counter} with zero counts for A, T, G and C.
+    """
+    result = {}
+    for position, row in enumerate(counts.tolist(), offset):
+        bases = Counter({base: count for base, count in zip(BASES, row)
+                         if count})
+        result[position] = bases or Counter({'A': 0, 'T': 0, 'G': 0, 'C': 0})
+
+    return result
+
+
+def countersToCounts(countsPerBase):
+    """
+    Convert a C{dict} of base counts per position, as returned by
+    C{getBaseFrequencies}, to an array.
+
+    @param countsPerBase: A C{dict} mapping each C{int} position to a C{dict}
+        of base counts.
+    @return: An C{int} array of shape (len(countsPerBase), len(BASES)). Bases
+        not in C{BASES} are counted as 'N'.
+    """
+    counts = np.zeros((len(countsPerBase), len(BASES)), dtype=int)
+    for position, bases in countsPerBase.items():
+        for base, count in bases.items():
+            counts[position, BASE_INDEX.get(base, _N_INDEX)] += count
+
+    return counts
+
+
+def _baseIndices(bases):
+    """
+    Convert a string of bases to their indices in C{BASES}.
+
+    @param bases: A C{str} of bases. Bases not in C{BASES} are taken as 'N'.
+    @return: A C{numpy.uint8} array of indices into C{BASES}.
+    """
+    lookup = np.full(256, _N_INDEX, dtype=np.uint8)
+    for base, index in BASE_INDEX.items():
+        lookup[ord(base)] = index
+
+    return lookup[np.frombuffer(bases.encode('ascii'), dtype=np.uint8)]
+
+
+class SparseCounts():
+    """
+    A compact form of an array of base counts, for samples where most
+    positions show a single base. Every position has its major (most common)
+    base and its depth, and only the counts of the other bases (including
+    deletions) that are present are stored, as sparse entries.
+
+    @param counts: An C{int} array of shape (length, len(BASES)), or C{None}
+        to make an empty instance (see C{fromJson}).
+    """
+    def __init__(self, counts=None):
+        if counts is None:
+            return
+
+        counts = np.asarray(counts)
+        # The major base of an uncovered position is A, with a depth of 0.
+        self.majorBases = counts.argmax(axis=1).astype(np.uint8)
+        self.depths = counts.sum(axis=1).astype(np.int32)
+
+        others = counts.copy()
+        others[np.arange(len(counts)), self.majorBases] = 0
+        positions, bases = np.nonzero(others)
+        self.positions = positions.astype(np.int32)
+        self.bases = bases.astype(np.uint8)
+        self.minorCounts = others[positions, bases].astype(np.int32)
+
+    def __len__(self):
+        """
+        Get the number of positions.
+
+        @return: The C{int} number of positions.
+        """
+        return len(self.depths)
+
+    @property
+    def nbytes(self):
+        """
+        Get the memory used by the arrays.
+
+        @return: The C{int} number of bytes of the arrays.
+        """
+        return (self.majorBases.nbytes + self.depths.nbytes +
+                self.positions.nbytes + self.bases.nbytes +
+                self.minorCounts.nbytes)
+
+    def toCounts(self):
+        """
+        Convert to a dense array of base counts.
+
+        @return: An C{int} array of shape (length, len(BASES)).
+        """
+        counts = np.zeros((len(self), len(BASES)), dtype=int)
+        counts[self.positions, self.bases] = self.minorCounts
+        counts[np.arange(len(self)), self.majorBases] = (
+            self.depths - counts.sum(axis=1))
+
+        return counts
+
+    def toJson(self):
+        """
+        Convert to a C{dict} that can be saved as json.
+
+        @return: A C{dict} with the major bases (as a C{str} with one base per
+            position), the depths, and the positions, bases (as a C{str}) and
+            counts of the sparse entries.
+        """
+        bases = np.array(BASES)
+        return {
+            'majorBases': ''.join(bases[self.majorBases].tolist()),
+            'depths': self.depths.tolist(),
+            'positions': self.positions.tolist(),
+            'bases': ''.join(bases[self.bases].tolist()),
+            'counts': self.minorCounts.tolist(),
+        }
+
+    @classmethod
+    def fromJson(cls, data):
+        """
+        Make an instance from a C{dict} made by C{toJson}.
+
+        @param data: A C{dict}, as returned by C{toJson}.
+        @return: A C{SparseCounts} instance.
+        """
+        sparse = cls()
+        sparse.majorBases = _baseIndices(data['majorBases'])
+        sparse.depths = np.array(data['depths'], dtype=np.int32)
+        sparse.positions = np.array(data['positions'], dtype=np.int32)
+        sparse.bases = _baseIndices(data['bases'])
+        sparse.minorCounts = np.array(data['counts'], dtype=np.int32)
+
+        return sparse
+
+
+def getBaseFrequencies(bamFile, minBaseQuality=0, minMappingQuality=0,
+                       referenceId=False, flagFilter=DEFAULT_FLAG_FILTER,
+                       minReadLength=None, threads=1, reference=None,
+                       regions=None, virus=None, pipeline=False):
+    """
+    Takes a bam file and returns a dictionary where the key maps to a position
+    and the values map to a Counter with the number of each base at that
+    position.
+
+    @param bamFile: A C{str} filename of a BAM or CRAM file.
+    @param minBaseQuality: Minimum base quality. Bases below the minimum
+        quality will not be output.
+    @param minMappingQuality: Only use reads above a minimum mapping quality.
+    @param referenceId: The Id of the reference sequence to use. In case a BAM
+        file contains multiple references.
+    @param flagFilter: An C{int} SAM flag bitmask (see C{readFilterFlags}).
+        Reads with any of these flags set are not used.
+    @param minReadLength: If not C{None}, an C{int} minimum read length. Reads
+        that are shorter are not used. Unlike the other filters, this is not
+        applied by htslib, but in Python to the reads of each pileup column.
+    @param threads: The C{int} number of threads htslib should use to
+        decompress the file.
+    @param reference: The reference needed to decode a CRAM file, as accepted
+        by C{alignmentFile}.
+    @param regions: If not C{None}, an iterable of regions, as accepted by
+        C{parseRegions}. Only the positions in these regions are counted.
+        All positions of the reference are still returned (with no counts
+        outside the regions), so the result can be given to
+        C{MinorVariantInfo} as C{frequenciesDict}.
+    @param virus: One of 'SARS2', 'WNV' or 'YFV', needed to find C{regions}
+        given as gene names.
+    @param pipeline: If C{True}, read the pileup in a separate thread from
+        the one that counts it (see C{getBaseCounts}).
+    @raise ValueError: If C{referenceId} is not in the BAM file, or if it is
+        not given and the BAM file has more than one reference, or if
+        C{regions} are not usable.
+    """
+    baseCounts = getBaseCounts(
+        bamFile, minBaseQuality=minBaseQuality,
+        minMappingQuality=minMappingQuality, referenceId=referenceId,
+        flagFilter=flagFilter, minReadLength=minReadLength, threads=threads,
+        reference=reference, regions=regions, virus=virus, pipeline=pipeline)
+
+    return countsToCounters(baseCounts['counts'])
@@ -1,28 +1,225 @@
-from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 import os
+from os.path import join
 import numpy as np
 
-from mvlib.common import NTCOLORS
+from mvlib.common import BASES, NTCOLORS
+from mvlib.minorVariants import MinorVariantInfo
+from mvlib.sars2features import VI
 
 import matplotlib
 if not os.environ.get('DISPLAY'):
     # Use non-interactive Agg backend
     matplotlib.use('Agg')
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba
 import matplotlib.pyplot as plt
 
+# The SARS2 furin cleavage site, at 1-based positions 23567-23626.
+FURINSEQ = 'GGTATATGCGCTAGTTATCAGACTCAGACTAATTCTCCTCGGCGGGCACGTAGTGTAGCT'
+FURINPOSITIONS = list(range(23567, 23627))
 
-def plotCoverage(minorVariantInfo):
+
+def _binStarts(length, nBins):
+    """
+    Split a track into bins of (nearly) equal size.
+
+    @param length: The C{int} length of the track.
+    @param nBins: The C{int} number of bins. If this is not less than
+        C{length}, every position is its own bin.
+    @return: An C{int} array with the 0-based start of each bin.
+    """
+    nBins = max(1, min(int(nBins), length))
+    return np.linspace(0, length, nBins + 1).astype(int)[:-1]
+
+
+def decimate(values, nBins):
     """
-    Plot the coverage of a MinorVariantInfo instance.
+    Reduce tracks (e.g., of coverage) to bins, keeping the minimum, mean and
+    maximum of each bin, so that plotting takes time proportional to the
+    number of bins instead of to the track length.
+
+    @param values: A 1-d array of values, or a 2-d array with one track per
+        row.
+    @param nBins: The C{int} number of bins. If this is not less than the
+        track length, every position is its own bin.
+    @return: A 4-C{tuple} of the C{int} 0-based start of each bin and 2-d
+        C{float} arrays (one row per track) with the minimum, mean and
+        maximum of each bin.
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    length = values.shape[1]
+    starts = _binStarts(length, nBins)
+    sizes = np.diff(np.append(starts, length))
+
+    return (starts,
+            np.minimum.reduceat(values, starts, axis=1),
+            np.add.reduceat(values, starts, axis=1) / sizes,
+            np.maximum.reduceat(values, starts, axis=1))
+
+
+def _coverageArray(samples):
     """
-    fig, ax = plt.subplot(1, 1, figsize=(15, 5))
+    Make an array of coverage tracks.
 
-    ax.plot(list(range(len(minorVariantInfo.coveragePerBase))),
-            minorVariantInfo.coveragePerBase, '-')
+    @param samples: A 2-d array with one coverage track per row, or an
+        iterable of C{MinorVariantInfo} instances.
+    @return: A 2-C{tuple} with a 2-d C{float} array of coverage (one row per
+        sample) and a C{list} of sample names (C{None} for an array).
+    """
+    if isinstance(samples, np.ndarray):
+        return np.atleast_2d(samples), None
+
+    samples = list(samples)
+    return (np.array([sample.counts.sum(axis=1) for sample in samples]),
+            [sample.name for sample in samples])
+
+
+def _plotDecimatedTrack(ax, starts, length, mins, means, maxs,
+                        linewidth=None):
+    """
+    Plot one decimated track as a band from its minimum to its maximum, with
+    a line for its mean.
+
+    @param ax: The matplotlib subplot to plot on.
+    @param starts: The C{int} 0-based starts of the bins, as returned by
+        C{decimate}.
+    @param length: The C{int} length of the track.
+    @param mins: The C{float} minimum of each bin.
+    @param means: The C{float} mean of each bin.
+    @param maxs: The C{float} maximum of each bin.
+    @param linewidth: The C{float} width of the mean line, or C{None} for
+        the default.
+    """
+    # Repeat the last bin's values so the steps reach the end of the track.
+    x = np.append(starts, length)
+    mins, means, maxs = (np.append(values, values[-1]) for values in
+                         (mins, means, maxs))
+    ax.fill_between(x, mins, maxs, step='post', alpha=0.3, linewidth=0)
+    ax.step(x, means, '-', where='post', linewidth=linewidth)
+
+
+def _axisPixelWidth(ax):
+    """
+    Get the width of a subplot in pixels.
+
+    @param ax: A matplotlib subplot.
+    @return: The C{int} width of C{ax} in pixels.
+    """
+    return max(1, int(ax.get_window_extent().width))
+
+
+def plotCoverage(minorVariantInfo, ax=None, nBins=None, outFilename=None,
+                 outFormat='png', logScale=False):
+    """
+    Plot the coverage of a MinorVariantInfo instance. The coverage is reduced
+    to one bin per pixel, drawn as a band from the bin's minimum to its
+    maximum, with a line for its mean.
+
+    @param minorVariantInfo: A C{MinorVariantInfo} instance.
+    @param ax: If not C{None}, use this as the subplot for plotting.
+    @param nBins: The C{int} number of bins, or C{None} to use the width of
+        the subplot in pixels.
+    @param outFilename: If not C{None}, a C{str} filename where the plot is
+        saved to.
+    @param outFormat: A C{str} of the file format of the figure.
+    @param logScale: If C{True}, use a logarithmic y-axis.
+    """
+    if not ax:
+        fig, ax = plt.subplots(1, 1, figsize=(15, 5))
+
+    starts, mins, means, maxs = decimate(
+        minorVariantInfo.counts.sum(axis=1), nBins or _axisPixelWidth(ax))
+
+    _plotDecimatedTrack(ax, starts, minorVariantInfo.length, mins[0],
+                        means[0], maxs[0])
 
     ax.set_title(minorVariantInfo.name)
     ax.set_xlabel('Position')
     ax.set_ylabel('Coverage')
+    ax.set_xlim(0, minorVariantInfo.length)
+    if logScale:
+        ax.set_yscale('symlog')
+
+    if outFilename:
+        ax.figure.savefig(outFilename, format=outFormat, bbox_inches='tight')
+
+
+def plotCohortCoverage(samples, names=None, smallMultiples=False, ncols=4,
+                       nBins=None, outFilename=None, outFormat='png',
+                       logScale=False, title=None):
+    """
+    Plot the coverage of many samples, either overlaid on one subplot or as
+    small multiples. Each track is reduced to one bin per pixel first, so the
+    time taken depends on the size of the figure rather than on the genome
+    length and the number of samples.
+
+    @param samples: A 2-d array with one coverage track per row (all of the
+        same length), or an iterable of C{MinorVariantInfo} instances.
+    @param names: If not C{None}, a C{list} of C{str} sample names to use
+        as subplot titles. Defaults to the names of the C{MinorVariantInfo}
+        instances.
+    @param smallMultiples: If C{True}, plot each sample in its own subplot.
+        Otherwise, overlay the mean coverage of all samples in one subplot,
+        over a band showing the minimum and maximum coverage of the cohort.
+    @param ncols: The C{int} number of columns of small multiples.
+    @param nBins: The C{int} number of bins, or C{None} to use the width of
+        a subplot in pixels.
+    @param outFilename: If not C{None}, a C{str} filename where the plot is
+        saved to.
+    @param outFormat: A C{str} of the file format of the figure.
+    @param logScale: If C{True}, use a logarithmic y-axis.
+    @param title: If not C{None}, a C{str} title for the figure.
+    @return: The matplotlib figure.
+    """
+    coverage, sampleNames = _coverageArray(samples)
+    names = names or sampleNames
+    nSamples, length = coverage.shape
+
+    if smallMultiples:
+        nrows = -(-nSamples // ncols)
+        fig, axes = plt.subplots(nrows, ncols, squeeze=False, sharex=True,
+                                 sharey=True,
+                                 figsize=(4 * ncols, 1.5 * nrows))
+        axes = axes.flatten()
+        starts, mins, means, maxs = decimate(
+            coverage, nBins or _axisPixelWidth(axes[0]))
+        for index, ax in enumerate(axes):
+            if index >= nSamples:
+                ax.set_visible(False)
+                continue
+            _plotDecimatedTrack(ax, starts, length, mins[index],
+                                means[index], maxs[index], linewidth=0.5)
+            if names:
+                ax.set_title(names[index], fontsize=8)
+            if logScale:
+                ax.set_yscale('symlog')
+        axes[0].set_xlim(0, length)
+    else:
+        fig, ax = plt.subplots(1, 1, figsize=(15, 5))
+        starts, mins, means, maxs = decimate(
+            coverage, nBins or _axisPixelWidth(ax))
+        ax.fill_between(starts, mins.min(axis=0), maxs.max(axis=0),
+                        step='post', color='lightgrey', linewidth=0)
+        segments = np.stack(
+            (np.broadcast_to(starts, means.shape), means), axis=2)
+        ax.add_collection(LineCollection(segments, linewidths=0.5,
+                                         alpha=max(0.05, 1.0 / nSamples)))
+        ax.set_xlim(0, length)
+        ax.set_ylim(0, max(1.0, maxs.max()) * 1.05)
+        ax.set_xlabel('Position')
+        ax.set_ylabel('Coverage')
+        if logScale:
+            ax.set_yscale('symlog')
+
+    if title:
+        fig.suptitle(title)
+
+    if outFilename:
+        fig.savefig(outFilename, format=outFormat, bbox_inches='tight')
+
+    return fig
 
 
 def plotFrequencies(minorVariantInfo, positions, outFilename=None, ax=None,
@@ -46,60 +243,27 @@ def plotFrequencies(minorVariantInfo, positions, outFilename=None, ax=None,
     """
     width = 0.5
 
-    furinSeq = 'GGTATATGCGCTAGTTATCAGACTCAGACTAATTCTCCTCGGCGGGCACGTAGTGTAGCT'
-
     if not ax:
         fig, ax = plt.subplots(1, 1, figsize=(16, 3.75))
 
-    coverage = []
-
-    for i, position in enumerate(sorted(positions)):
-        baseInfo = Counter(minorVariantInfo.countsPerBase[position - 1])
-        total = sum(list(baseInfo.values()))
-        coverage.append(total)
-        aFreqs = []
-        tFreqs = []
-        cFreqs = []
-        gFreqs = []
-        originalBase = furinSeq[i]
-        aAlpha = 1.0
-        tAlpha = 1.0
-        cAlpha = 1.0
-        gAlpha = 1.0
-        if originalBase == 'A':
-            aAlpha = 0.3
-        if originalBase == 'T':
-            tAlpha = 0.3
-        if originalBase == 'C':
-            cAlpha = 0.3
-        if originalBase == 'G':
-            gAlpha = 0.3
-        try:
-            aFreqs.append(baseInfo['A'] / total)
-        except ZeroDivisionError:
-            aFreqs.append(0)
-        try:
-            tFreqs.append(baseInfo['T'] / total)
-        except ZeroDivisionError:
-            tFreqs.append(0)
-        try:
-            cFreqs.append(baseInfo['C'] / total)
-        except ZeroDivisionError:
-            cFreqs.append(0)
-        try:
-            gFreqs.append(baseInfo['G'] / total)
-        except ZeroDivisionError:
-            gFreqs.append(0)
-        ax.bar(i, aFreqs, width, facecolor=NTCOLORS['A'],
-               edgecolor=NTCOLORS['A'], alpha=aAlpha)
-        ax.bar(i, tFreqs, width, bottom=aFreqs,
-               facecolor=NTCOLORS['T'], edgecolor=NTCOLORS['T'], alpha=tAlpha)
-        ax.bar(i, cFreqs, width,
-               bottom=[i + j for i, j in zip(aFreqs, tFreqs)],
-               facecolor=NTCOLORS['C'], edgecolor=NTCOLORS['C'], alpha=cAlpha)
-        ax.bar(i, gFreqs, width,
-               bottom=[i + j + k for i, j, k in zip(aFreqs, tFreqs, cFreqs)],
-               facecolor=NTCOLORS['G'], edgecolor=NTCOLORS['G'], alpha=gAlpha)
+    positions = sorted(positions)
+    counts = minorVariantInfo.counts[np.array(positions, dtype=int) - 1]
+    coverage = counts.sum(axis=1)
+    frequencies = counts / np.maximum(coverage, 1)[:, np.newaxis]
+
+    # The bases of the furin site are drawn faded.
+    originalBases = np.array(list(FURINSEQ[:len(positions)].ljust(
+        len(positions))))
+    x = np.arange(len(positions))
+    bottom = np.zeros(len(positions))
+
+    for base in 'ATCG':
+        baseFrequencies = frequencies[:, BASES.index(base)]
+        colors = [to_rgba(NTCOLORS[base], alpha) for alpha in
+                  np.where(originalBases == base, 0.3, 1.0)]
+        ax.bar(x, baseFrequencies, width, bottom=bottom, color=colors,
+               edgecolor=colors)
+        bottom += baseFrequencies
 
     ax.hlines(y=0.5, xmin=-0.5, xmax=len(positions), linestyle=':')
 
@@ -110,23 +274,189 @@ def plotFrequencies(minorVariantInfo, positions, outFilename=None, ax=None,
     titleAddition = '' if not title else ', %s' % title
     ax.set_title('%s%s' % (minorVariantInfo.name, titleAddition), fontsize=16)
 
-    ax.xaxis.set_ticks(
-        [i + 0.2 for i in range(len(positions))])
+    ax.xaxis.set_ticks(x + 0.2)
 
-    xLabels = []
-    for i, pos in enumerate(positions):
-        xLabels.append('%d (%d)' % (pos, coverage[i]))
-    ax.set_xticklabels(xLabels, fontsize=13, rotation=90)
+    ax.set_xticklabels(['%d (%d)' % (pos, depth) for pos, depth in
+                        zip(positions, coverage.tolist())],
+                       fontsize=13, rotation=90)
 
     if plotFurinAAs:
         secax = ax.secondary_xaxis('bottom')
         secax.set_xlim(-0.5, len(positions) - 0.5)
         secax.tick_params(axis='both', which='major', pad=100, bottom=False)
         secax.xaxis.set_ticks([1, 4, 7, 10, 13, 16, 19, 22, 25, 28, 31, 34, 37,
-                               40, 43, 46, 49, 52, 55, 58, 61])
+                               40, 43, 46, 49, 52, 55, 58])
         secax.set_xticklabels(['G', 'I', 'C', 'A', 'S', 'Y', 'Q', 'T', 'Q',
                                'T', 'N', 'S', 'P', 'R/W', 'R', 'A', 'R', 'S',
                                'V', 'A'], fontsize=13)
 
     if outFilename:
-        plt.savefig(outFilename, format=outFormat, bbox_inches='tight')
+        ax.figure.savefig(outFilename, format=outFormat, bbox_inches='tight')
+
+
+def _plotFrequenciesToFile(jsonFile, positions, outDir, outFormat, kwargs):
+    """
+    Plot the base frequencies of one saved sample to a file, for use by
+    C{plotFrequenciesBatch} in a worker process.
+
+    @param jsonFile: The C{str} name of a json file saved by
+        C{MinorVariantInfo.save}.
+    @param positions: a C{list} of 1-based positions that should be plotted.
+    @param outDir: The C{str} directory to write the plot to.
+    @param outFormat: A C{str} of the file format of the figure.
+    @param kwargs: A C{dict} of further keyword arguments for
+        C{plotFrequencies}.
+    @return: The C{str} name of the file written.
+    """
+    mvi = MinorVariantInfo(jsonFile=jsonFile)
+    outFilename = join(outDir, '%s.%s' % (mvi.name, outFormat))
+    fig, ax = plt.subplots(1, 1, figsize=(16, 3.75))
+    try:
+        plotFrequencies(mvi, positions, outFilename=outFilename, ax=ax,
+                        outFormat=outFormat, **kwargs)
+    finally:
+        plt.close(fig)
+
+    return outFilename
+
+
+def plotFrequenciesBatch(jsonFiles, positions, outDir, outFormat='png',
+                         workers=None, **kwargs):
+    """
+    Plot the base frequencies of many saved samples to files, in parallel
+    worker processes that use the non-interactive Agg backend.
+
+    @param jsonFiles: An iterable of C{str} names of json files saved by
+        C{MinorVariantInfo.save}.
+    @param positions: a C{list} of 1-based positions that should be plotted.
+    @param outDir: The C{str} directory to write the plots to. Each plot is
+        named after its sample.
+    @param outFormat: A C{str} of the file format of the figures.
+    @param workers: The C{int} number of worker processes, or C{None} to use
+        one per CPU.
+    @param kwargs: Further keyword arguments for C{plotFrequencies}.
+    @return: A C{list} of the C{str} names of the files written, in the order
+        of C{jsonFiles}.
+    """
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=plt.switch_backend,
+                             initargs=('Agg',)) as executor:
+        futures = [executor.submit(_plotFrequenciesToFile, jsonFile,
+                                   positions, outDir, outFormat, kwargs)
+                   for jsonFile in jsonFiles]
+        return [future.result() for future in futures]
+
+
+def plotMinorVariantHeatmap(samples, mask=False, minCoverage=50,
+                            minFrequency=0.03, virus='SARS2', names=None,
+                            nBins=None, ax=None, cmap='viridis',
+                            outFilename=None, outFormat='png', title=None):
+    """
+    Plot a samples x positions heatmap of minor allele frequencies, or of the
+    minor variant mask, as a single raster image with the gene boundaries of
+    a virus marked.
+
+    Positions are reduced to one bin per pixel, keeping the highest value of
+    each bin so that single minor variants stay visible, and samples are
+    reduced one at a time, so memory use is proportional to the number of
+    samples times the image width rather than to the genome length.
+
+    @param samples: An iterable of C{MinorVariantInfo} instances, or a 2-d
+        array of values to plot with one row per sample.
+    @param mask: If C{True}, plot the minor variant mask (see
+        C{MinorVariantInfo.minorVariantMask}) instead of the minor allele
+        frequencies.
+    @param minCoverage: The C{int} coverage needed at a position for it to be
+        plotted (or to be a minor variant, if C{mask} is C{True}).
+    @param minFrequency: A C{float} minimum frequency, passed to
+        C{minorVariantMask} if C{mask} is C{True}.
+    @param virus: One of 'SARS2', 'WNV' or 'YFV' whose gene boundaries are
+        marked, or C{None} to not mark genes.
+    @param names: If not C{None}, a C{list} of C{str} sample names to label
+        the rows with. Defaults to the names of the C{MinorVariantInfo}
+        instances when there are at most 50 samples.
+    @param nBins: The C{int} number of position bins, or C{None} to use the
+        width of the subplot in pixels.
+    @param ax: If not C{None}, use this as the subplot for plotting.
+    @param cmap: The C{str} name of the matplotlib colour map.
+    @param outFilename: If not C{None}, a C{str} filename where the plot is
+        saved to.
+    @param outFormat: A C{str} of the file format of the figure.
+    @param title: If not C{None}, a C{str} title for the plot.
+    @raise ValueError: If there are no samples, or they differ in length.
+    @return: The matplotlib C{AxesImage}.
+    """
+    # Look at the first sample before making a figure, putting it back so
+    # that any iterable can be given.
+    samples = iter(samples)
+    first = next(samples, None)
+    if first is None:
+        raise ValueError('No samples were given.')
+    samples = chain([first], samples)
+
+    if not ax:
+        fig, ax = plt.subplots(1, 1, figsize=(15, 8))
+
+    nBins = nBins or _axisPixelWidth(ax)
+    rows = []
+    sampleNames = []
+    length = None
+
+    for sample in samples:
+        if isinstance(sample, MinorVariantInfo):
+            if mask:
+                values = sample.minorVariantMask(
+                    minCoverage, minFrequency).astype(np.float32)
+            else:
+                values = sample.minorFrequencies().astype(np.float32)
+                values[sample.counts.sum(axis=1) < minCoverage] = np.nan
+            sampleNames.append(sample.name)
+        else:
+            values = np.asarray(sample, dtype=np.float32)
+
+        if length is None:
+            length = len(values)
+            starts = _binStarts(length, nBins)
+        elif len(values) != length:
+            raise ValueError('All samples must have the same length (%d), '
+                             'not %d.' % (length, len(values)))
+
+        with np.errstate(invalid='ignore'):
+            rows.append(np.fmax.reduceat(values, starts))
+
+    image = np.array(rows)
+    nSamples = len(rows)
+
+    axesImage = ax.imshow(
+        np.ma.masked_invalid(image), aspect='auto', interpolation='nearest',
+        cmap=cmap, vmin=0.0, vmax=1.0 if mask else 0.5,
+        extent=(0, length, nSamples, 0))
+
+    ax.set_xlabel('Position')
+    ax.set_ylabel('Sample')
+
+    names = names or (sampleNames if nSamples <= 50 else None)
+    if names:
+        ax.set_yticks(np.arange(nSamples) + 0.5)
+        ax.set_yticklabels(names, fontsize=8)
+
+    if virus:
+        offsets = VI[virus]['o']
+        boundaries = sorted({offset for start, stop in offsets.values()
+                             for offset in (start, stop)})
+        ax.vlines(boundaries, 0, nSamples, colors='white', linewidth=0.5)
+        geneAxis = ax.secondary_xaxis('top')
+        geneAxis.set_xticks([(start + stop) / 2 for start, stop in
+                             offsets.values()])
+        geneAxis.set_xticklabels(list(offsets), fontsize=8, rotation=90)
+
+    ax.figure.colorbar(axesImage, ax=ax, label=(
+        'Minor variant' if mask else 'Minor allele frequency'))
+
+    if title:
+        ax.set_title(title)
+
+    if outFilename:
+        ax.figure.savefig(outFilename, format=outFormat, bbox_inches='tight')
+
+    return axesImage
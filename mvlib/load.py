@@ -1,23 +1,29 @@
 import glob
+from os.path import join
 
 from mvlib.common import DATADIR
 from mvlib.minorVariants import MinorVariantInfo
 
+# The patterns of the names of saved json files, possibly compressed.
+JSON_PATTERNS = ('*.json', '*.json.gz', '*.json.zst', '*.json.zstd')
+
 
 def load(minMeanCoverage=None):
     """
     Return a generator of MinorVariantInfo instances of all available json
-    files in data, provided they pass the filtering.
+    files (which may be compressed) in data, provided they pass the
+    filtering.
 
     @param minMeanCoverage: If not C{None} a C{float} minimum mean coverage
         that an alignment needs to have to be returned.
     """
-    files = glob.glob(DATADIR + '*.json')
+    files = sorted(file for pattern in JSON_PATTERNS
+                   for file in glob.glob(join(DATADIR, pattern)))
 
     for file in files:
         mvi = MinorVariantInfo(jsonFile=file)
         if minMeanCoverage:
-            if mvi.meanCoverage > minMeanCoverage:
+            if mvi.meanCoverage() > minMeanCoverage:
                 yield mvi
         else:
             yield mvi
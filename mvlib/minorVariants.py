@@ -1,18 +1,385 @@
 import json
 import numpy as np
 import sys
+from collections import Counter
 
 import allel
 
-from mvlib.functions import getBaseFrequencies, isMinorVariantPosition
+from mvlib.common import BASES
+from mvlib.functions import (BASE_INDEX, DEFAULT_FLAG_FILTER, SparseCounts,
+                             countersToCounts, countsToCounters, dataFile,
+                             getBaseCounts)
+from mvlib.sars2features import (DEFAULT_CACHE_DIR, NON_SYNONYMOUS, VI,
+                                 SUBSTITUTION_BASES, SYNONYMOUS, baseIndices,
+                                 substitutionTables)
+
+
+# The dtype of the rows of the table returned by
+# MinorVariantInfo.variantTable.
+VARIANT_TABLE_DTYPE = np.dtype([
+    ('position', np.int64),
+    ('depth', np.int64),
+    ('majorBase', 'U1'),
+    ('majorFrequency', np.float64),
+    ('minorBase', 'U1'),
+    ('minorFrequency', np.float64),
+    ('entropy', np.float64),
+])
+
+# The dtype of the rows of the table returned by
+# MinorVariantInfo.geneStatistics.
+GENE_STATISTICS_DTYPE = np.dtype([
+    ('gene', 'U32'),
+    ('start', np.int64),
+    ('stop', np.int64),
+    ('meanCoverage', np.float64),
+    ('richness', np.int64),
+    ('complexity', np.float64),
+    ('distance', np.float64),
+    ('pi', np.float64),
+])
+
+# The dtype of the rows of the table returned by MinorVariantInfo.pnps.
+PNPS_DTYPE = np.dtype([
+    ('gene', 'U32'),
+    ('nonSynonymousSites', np.float64),
+    ('synonymousSites', np.float64),
+    ('nonSynonymous', np.float64),
+    ('synonymous', np.float64),
+    ('pN', np.float64),
+    ('pS', np.float64),
+    ('pNpS', np.float64),
+])
+
+# The dtype of the rows of the table returned by
+# MinorVariantInfo.referenceDifferences.
+REFERENCE_DIFFERENCE_DTYPE = np.dtype([
+    ('position', np.int64),
+    ('depth', np.int64),
+    ('referenceBase', 'U1'),
+    ('majorBase', 'U1'),
+    ('majorFrequency', np.float64),
+])
+
+# The indices in BASES of the nucleotides, in the order of
+# SUBSTITUTION_BASES.
+_NUCLEOTIDE_INDICES = [BASES.index(base) for base in SUBSTITUTION_BASES]
+
+# The indices in BASES of the alleles a consensus is called from: the
+# nucleotides (in the order of SUBSTITUTION_BASES) and then deletions.
+_CONSENSUS_INDICES = _NUCLEOTIDE_INDICES + [BASES.index('-')]
+
+# The IUPAC codes of sets of nucleotides, indexed by a bit mask with bit i
+# set for the nucleotide at index i of SUBSTITUTION_BASES ('ACGT').
+AMBIGUITY_CODES = 'NACMGRSVTWYHKDBN'
+_AMBIGUITY_BYTES = np.frombuffer(AMBIGUITY_CODES.encode('ascii'),
+                                 dtype=np.uint8)
+
+
+def shannonEntropies(counts):
+    """
+    Calculate the Shannon entropy of the base frequencies at positions.
+
+    @param counts: An C{int} array of shape (..., len(BASES)), e.g.,
+        (positions, len(BASES)).
+    @return: A C{float} array with the entropy at each position (0.0 where a
+        position is not covered).
+    """
+    frequencies = counts / np.maximum(counts.sum(axis=-1, keepdims=True), 1)
+    logFrequencies = np.log(frequencies, out=np.zeros(frequencies.shape),
+                            where=frequencies > 0)
+    return -(frequencies * logFrequencies).sum(axis=-1)
+
+
+def minorVariantMask(counts, minCoverage=50, minFrequency=0.03,
+                     baseMask=None):
+    """
+    Find the positions with minor variants, as C{isMinorVariantPosition}
+    does, for all positions (of one or more samples) at once.
+
+    @param counts: An C{int} array of shape (..., len(BASES)), e.g.,
+        (positions, len(BASES)) for one sample or (samples, positions,
+        len(BASES)) for several.
+    @param minCoverage: The C{int} number of read coverage that needs to be
+        present at a position for it to be considered a minor variant.
+    @param minFrequency: A C{float} minimum frequency with which at least
+        two nucleotides need to be present at a position for it to be
+        considered variable.
+    @param baseMask: If not C{None}, a C{bool} array of the shape of
+        C{counts} that is C{False} for bases that do not count towards the
+        two nucleotides.
+    @return: A C{bool} array of shape C{counts.shape[:-1]} with a C{True}
+        value for each position with a minor variant.
+    """
+    coverage = counts.sum(axis=-1)
+    above = counts / np.maximum(coverage, 1)[..., np.newaxis] > minFrequency
+
+    if baseMask is not None:
+        above &= baseMask
+
+    return ((coverage > 0) & (coverage >= minCoverage) &
+            (above.sum(axis=-1) >= 2))
+
+
+def segmentSums(values, starts, stops):
+    """
+    Sum values over (possibly overlapping) segments, as the differences of
+    their cumulative sums at the ends of the segments.
+
+    @param values: A numeric array of shape (..., length).
+    @param starts: An C{int} array of the 0-based segment starts.
+    @param stops: An C{int} array of the (excluded) segment stops.
+    @return: A C{float} array of shape (..., len(starts)) with the sum of
+        C{values} over each segment.
+    """
+    cumulative = np.zeros(values.shape[:-1] + (values.shape[-1] + 1,))
+    np.cumsum(values, axis=-1, out=cumulative[..., 1:])
+    return cumulative[..., stops] - cumulative[..., starts]
+
+
+def minorAllelePNPS(counts, virus, minCoverage=50, minFrequency=0.03,
+                    genes=None, cacheDir=DEFAULT_CACHE_DIR):
+    """
+    Calculate the within-host pN/pS of the genes of one or more samples,
+    from the frequencies of their minor alleles, using the substitution
+    tables of the virus (see C{mvlib.sars2features.substitutionTables}).
+
+    The minor alleles are the nucleotides, other than the most common base,
+    above C{minFrequency} at minor variant positions (see
+    C{minorVariantMask}). A minor allele is classified by the change from
+    the reference base to it or, if it is the reference base, from the
+    reference base to the most common base. The non-synonymous (synonymous)
+    value of a gene is the sum of the frequencies of its non-synonymous
+    (synonymous) minor alleles. pN (pS) is that divided by the number of
+    non-synonymous (synonymous) sites of the gene, where each position has
+    one third of a site for each of the three possible base changes that is
+    non-synonymous (synonymous).
+
+    @param counts: An C{int} array of shape (..., length, len(BASES)) of the
+        base counts of a sample (or e.g. (samples, length, len(BASES)) for
+        several) aligned to the reference of C{virus}.
+    @param virus: One of 'SARS2', 'WNV' or 'YFV'.
+    @param minCoverage: The C{int} number of read coverage that needs to be
+        present at a position for it to be considered a minor variant.
+    @param minFrequency: A C{float} minimum frequency with which at least
+        two nucleotides need to be present at a position for it to be
+        considered variable, and a minor allele needs to be present to be
+        counted.
+    @param genes: An iterable of C{str} gene names of C{virus}, or C{None}
+        for all its genes.
+    @param cacheDir: The C{str} directory the substitution tables are cached
+        in, or C{None} to not cache them on disk.
+    @raise ValueError: If C{virus} or a gene is unknown, or C{counts} does
+        not have the length of the genome of C{virus}.
+    @return: A NumPy structured array with dtype C{PNPS_DTYPE} of shape
+        (..., number of genes) (e.g., (samples, genes)), with pN/pS set to
+        NaN where pS is zero.
+    """
+    tables = substitutionTables(virus, cacheDir)
+    offsets = VI[virus]['o']
+    genome = VI[virus]['g'].sequence
+    genes = list(offsets) if genes is None else list(genes)
+
+    unknown = [gene for gene in genes if gene not in offsets]
+    if unknown:
+        raise ValueError('Unknown %s gene(s): %s. Known genes are %s.' % (
+            virus, ', '.join(map(repr, unknown)), ', '.join(offsets)))
+
+    if counts.shape[-2] != len(genome):
+        raise ValueError('The counts have length %d, but the %s genome has '
+                         'length %d.' % (counts.shape[-2], virus,
+                                         len(genome)))
+
+    # The positions of the genes one after the other, so that positions in
+    # overlapping genes appear once for each gene, read in its frame.
+    positions = np.concatenate([np.arange(*offsets[gene]) for gene in genes])
+    effects = np.concatenate([tables[gene] for gene in genes])
+    lengths = np.array([len(tables[gene]) for gene in genes])
+    stops = np.cumsum(lengths)
+    starts = stops - lengths
+
+    geneCounts = counts[..., positions, :]
+    mask = minorVariantMask(geneCounts, minCoverage, minFrequency)
+    frequencies = (geneCounts[..., _NUCLEOTIDE_INDICES] /
+                   np.maximum(geneCounts.sum(axis=-1), 1)[..., np.newaxis])
+
+    # The index in SUBSTITUTION_BASES of the most common base, or -1 if it
+    # is not a nucleotide.
+    toNucleotide = np.full(len(BASES), -1)
+    toNucleotide[_NUCLEOTIDE_INDICES] = np.arange(len(SUBSTITUTION_BASES))
+    major = toNucleotide[geneCounts.argmax(axis=-1)]
+
+    nucleotides = np.arange(len(SUBSTITUTION_BASES))
+    minor = ((frequencies > minFrequency) &
+             (nucleotides != major[..., np.newaxis]) &
+             mask[..., np.newaxis])
+
+    # The effect of a change from the reference base to the most common one,
+    # for minor alleles that are the reference base.
+    majorEffects = np.take_along_axis(
+        np.broadcast_to(effects, major.shape + effects.shape[-1:]),
+        np.maximum(major, 0)[..., np.newaxis], axis=-1)[..., 0]
+    reference = baseIndices(genome)[positions]
+    alleleEffects = np.where(
+        nucleotides == reference[:, np.newaxis],
+        np.where(major >= 0, majorEffects, -1)[..., np.newaxis], effects)
+
+    minorFrequencies = np.where(minor, frequencies, 0.0)
+    perPosition = np.stack([
+        (minorFrequencies * (alleleEffects == NON_SYNONYMOUS)).sum(axis=-1),
+        (minorFrequencies * (alleleEffects == SYNONYMOUS)).sum(axis=-1),
+    ])
+    nonSynonymous, synonymous = segmentSums(perPosition, starts, stops)
+    nonSynonymousSites, synonymousSites = segmentSums(
+        np.stack([(effects == NON_SYNONYMOUS).sum(axis=1),
+                  (effects == SYNONYMOUS).sum(axis=1)]), starts, stops) / 3
+
+    table = np.empty(nonSynonymous.shape, dtype=PNPS_DTYPE)
+    table['gene'] = genes
+    table['nonSynonymousSites'] = nonSynonymousSites
+    table['synonymousSites'] = synonymousSites
+    table['nonSynonymous'] = nonSynonymous
+    table['synonymous'] = synonymous
+    table['pN'] = nonSynonymous / nonSynonymousSites
+    table['pS'] = synonymous / synonymousSites
+    table['pNpS'] = np.divide(table['pN'], table['pS'],
+                              out=np.full(table.shape, np.nan),
+                              where=table['pS'] > 0)
+    return table
+
+
+def consensusCodes(counts, minDepth=10, ambiguityFrequency=None):
+    """
+    Call the consensus base at every position (of one or more samples) at
+    once.
+
+    The depth of a position is the number of nucleotides and deletions
+    covering it (Ns are not counted). A position with less than
+    C{minDepth} is called N. Otherwise, if deletions are the most common, it
+    is called '-'. If not, it is called as the most common nucleotide or,
+    with C{ambiguityFrequency}, as the IUPAC code (see C{AMBIGUITY_CODES})
+    of the most common nucleotide together with all nucleotides at or above
+    that frequency. Ties are broken in the order A, C, G, T, -.
+
+    @param counts: An C{int} array of shape (..., length, len(BASES)), e.g.,
+        (positions, len(BASES)) for one sample or (samples, positions,
+        len(BASES)) for several.
+    @param minDepth: The C{int} depth needed to call a base.
+    @param ambiguityFrequency: If not C{None}, a C{float} frequency (of the
+        depth) at or above which a nucleotide is part of an ambiguity code.
+    @return: A C{uint8} array of shape C{counts.shape[:-1]} with the ASCII
+        code of the consensus base at each position.
+    """
+    alleles = counts[..., _CONSENSUS_INDICES]
+    depth = alleles.sum(axis=-1)
+    major = alleles.argmax(axis=-1)
+    isNucleotide = major < len(_NUCLEOTIDE_INDICES)
+    masks = np.where(isNucleotide, 1 << np.minimum(major, 3), 0)
+
+    if ambiguityFrequency is not None:
+        above = (alleles[..., :len(_NUCLEOTIDE_INDICES)] >=
+                 ambiguityFrequency * depth[..., np.newaxis])
+        masks |= (above * (1 << np.arange(len(_NUCLEOTIDE_INDICES)))).sum(
+            axis=-1)
+
+    codes = _AMBIGUITY_BYTES[masks]
+    codes[~isNucleotide] = ord('-')
+    codes[depth < max(minDepth, 1)] = ord('N')
+
+    return codes
+
+
+def makeVariantTable(counts, positions):
+    """
+    Make a table of minor variant positions.
+
+    @param counts: An C{int} array of shape (len(positions), len(BASES)) with
+        the base counts at the positions. Every position must have some
+        coverage.
+    @param positions: An C{int} array of 0-based positions.
+    @return: A NumPy structured array with dtype C{VARIANT_TABLE_DTYPE}, as
+        returned by C{MinorVariantInfo.variantTable}.
+    """
+    depths = counts.sum(axis=1)
+
+    # Sort the bases at each position by decreasing count, keeping the
+    # order of BASES for ties.
+    order = np.argsort(-counts, axis=1, kind='stable')
+    sortedCounts = np.take_along_axis(counts, order, axis=1)
+    bases = np.array(BASES)
+
+    table = np.empty(len(positions), dtype=VARIANT_TABLE_DTYPE)
+    table['position'] = positions
+    table['depth'] = depths
+    table['majorBase'] = bases[order[:, 0]]
+    table['majorFrequency'] = sortedCounts[:, 0] / depths
+    table['minorBase'] = bases[order[:, 1]]
+    table['minorFrequency'] = sortedCounts[:, 1] / depths
+    table['entropy'] = shannonEntropies(counts)
+
+    return table
+
+
+# The versions of the json written by MinorVariantInfo.save. Version 1 has a
+# 'countsPerBase' object with an object of base counts for each position.
+# Version 2 has a 'version' and a 'counts' object with a list of counts over
+# all positions for each base (or, for sparse files, 'sparseCounts').
+JSON_VERSIONS = (1, 2)
+JSON_VERSION = 2
+
+# The number of rows of a 2-d array written at a time by _writeJson.
+_JSON_ROWS = 4096
+
+
+def _writeJson(fp, value):
+    """
+    Write a value as json, a piece at a time, with C{dict} keys sorted.
+    NumPy arrays (which may be nested in C{dict}s) are written as nested
+    lists, a block of rows at a time, so the whole document never needs to
+    be held in memory as Python lists or as one string.
+
+    @param fp: A text file object to write to.
+    @param value: The value to write.
+    """
+    if isinstance(value, np.ndarray):
+        if value.ndim < 2:
+            json.dump(value.tolist(), fp)
+        else:
+            fp.write('[')
+            if value.ndim == 2:
+                for start in range(0, len(value), _JSON_ROWS):
+                    if start:
+                        fp.write(', ')
+                    # Drop the brackets around each block of rows.
+                    fp.write(json.dumps(
+                        value[start:start + _JSON_ROWS].tolist())[1:-1])
+            else:
+                for index, item in enumerate(value):
+                    if index:
+                        fp.write(', ')
+                    _writeJson(fp, item)
+            fp.write(']')
+    elif (isinstance(value, dict) and
+          any(isinstance(item, (dict, np.ndarray))
+              for item in value.values()) and
+          all(isinstance(key, str) for key in value)):
+        fp.write('{')
+        for index, key in enumerate(sorted(value)):
+            if index:
+                fp.write(', ')
+            fp.write(json.dumps(key) + ': ')
+            _writeJson(fp, value[key])
+        fp.write('}')
+    else:
+        json.dump(value, fp, sort_keys=True)
 
 
 class MinorVariantInfo():
     """
     Hold information about the minor variants in one sample.
 
-    @param bamFile: The C{str} filename of the bam file with the reads aligned
-        to a reference.
+    @param bamFile: The C{str} filename of the BAM or CRAM file with the reads
+        aligned to a reference.
     @param name: A C{str} name of this instance.
     @param jsonFile: If not C{None}, a C{str} filename of a json file that
         contains the result of getBaseFrequencies().
@@ -25,81 +392,458 @@ class MinorVariantInfo():
         'NovaSeq'.
     @param referenceId: The Id of the reference sequence to use. In case a BAM
         file contains multiple references.
+    @param flagFilter: An C{int} SAM flag bitmask (see
+        C{mvlib.functions.readFilterFlags}). Reads with any of these flags set
+        are not used.
+    @param minReadLength: If not C{None}, an C{int} minimum read length. Reads
+        that are shorter are not used.
+    @param threads: The C{int} number of threads htslib should use to
+        decompress C{bamFile}.
+    @param reference: The reference needed to decode a CRAM file. Either a
+        C{str} FASTA file name or one of 'SARS2', 'WNV' or 'YFV'.
+    @param qualityBins: If not C{None}, a C{list} of C{int} lower base quality
+        bin edges, starting at 0 (e.g.,
+        C{mvlib.functions.DEFAULT_QUALITY_BINS}). Bases read from C{bamFile}
+        are then also counted per quality bin, so C{atMinBaseQuality} can
+        later re-derive the counts for a higher minimum base quality.
+    @param strand: If C{True}, bases read from C{bamFile} are also counted
+        separately for reads on the forward and on the reverse strand, for
+        use by C{strandBias}.
+    @param insertionSequences: If C{True}, the inserted sequences after each
+        position are also counted when reading C{bamFile}. The number of
+        reads with an insertion after each position is always counted.
+    @param regions: If not C{None}, an iterable of regions (gene names,
+        1-based coordinates such as '23567-23626', or 0-based (start, end)
+        offsets, see C{mvlib.functions.parseRegions}) to count the bases of
+        C{bamFile} in. Only the parts of the (indexed) file covering them are
+        read. Positions keep their genome coordinates, and those outside the
+        regions have no coverage.
+    @param virus: One of 'SARS2', 'WNV' or 'YFV', needed to find C{regions}
+        given as gene names.
+    @param stream: If C{True}, read the alignments of C{bamFile} once, in
+        any order, instead of making a pileup, so C{bamFile} need not be
+        sorted or indexed and can be '-' for standard input (see
+        C{mvlib.functions.getBaseCounts}).
+    @param pipeline: If C{True}, read C{bamFile} in a separate thread from
+        the one that counts its bases (see C{mvlib.functions.getBaseCounts}).
+    @param baseCounts: If not C{None}, a C{dict} of counts as returned by
+        C{mvlib.functions.getBaseCounts} (e.g., for one of its read group
+        samples) to use instead of reading C{bamFile}. The other arguments
+        must describe how the counts were made.
     """
     def __init__(self, bamFile=None, jsonFile=None, frequenciesDict=False,
                  minBaseQuality=None, minMappingQuality=None,
-                 sequencingTech=None, referenceId=False):
+                 sequencingTech=None, referenceId=False,
+                 flagFilter=DEFAULT_FLAG_FILTER, minReadLength=None,
+                 threads=1, reference=None, qualityBins=None, strand=False,
+                 insertionSequences=False, regions=None, virus=None,
+                 stream=False, pipeline=False, baseCounts=None):
 
         self.minBaseQuality = minBaseQuality if minBaseQuality else 0
         self.minMappingQuality = minMappingQuality if minMappingQuality else 0
+        self.flagFilter = flagFilter
+        self.minReadLength = minReadLength
+        self.qualityBins = None
+        self.qualityBinCounts = None
+        self.strandCounts = None
+        self.insertionCounts = None
+        self.insertionSequences = None
+        self.regions = None
+        self._countsPerBase = None
+        counts = None
 
         if frequenciesDict:
-            self.countsPerBase = frequenciesDict
+            self._countsPerBase = frequenciesDict
             self.name = None
             self.sequencingTech = sequencingTech
 
         elif jsonFile:
-            with open(jsonFile, 'r') as fp:
+            with dataFile(jsonFile) as fp:
                 openJson = json.load(fp)
-                self.countsPerBase = {int(k): v for k, v in
-                                      openJson['countsPerBase'].items()}
+                version = openJson.get('version', 1)
+                if version not in JSON_VERSIONS:
+                    raise ValueError(
+                        'Unknown json version %r in %r. Known versions are '
+                        '%s.' % (version, jsonFile,
+                                 ', '.join(map(str, JSON_VERSIONS))))
+                if 'sparseCounts' in openJson:
+                    counts = SparseCounts.fromJson(
+                        openJson['sparseCounts']).toCounts()
+                elif version == 2:
+                    counts = self._loadPerBaseCounts(openJson['counts'])
+                else:
+                    self._countsPerBase = {
+                        int(k): v for k, v in
+                        openJson['countsPerBase'].items()}
                 params = openJson['parameters']
                 self.sequencingTech = params['sequencingTech']
                 self.minBaseQuality = params['minBaseQuality']
                 self.minMappingQuality = params['minMappingQuality']
+                self.flagFilter = params.get('flagFilter',
+                                             DEFAULT_FLAG_FILTER)
+                self.minReadLength = params.get('minReadLength')
+                if params.get('regions') is not None:
+                    self.regions = [tuple(region)
+                                    for region in params['regions']]
+                if 'qualityBinCounts' in openJson:
+                    self.qualityBins = params['qualityBins']
+                    self.qualityBinCounts = self._loadBaseCountsArray(
+                        openJson, 'qualityBinCounts')
+                if 'strandCounts' in openJson:
+                    self.strandCounts = self._loadBaseCountsArray(
+                        openJson, 'strandCounts')
+                if 'insertionCounts' in openJson:
+                    self.insertionCounts = np.array(
+                        openJson['insertionCounts'], dtype=int)
+                if 'insertionSequences' in openJson:
+                    self.insertionSequences = {
+                        int(k): Counter(v) for k, v in
+                        openJson['insertionSequences'].items()}
             self.name = jsonFile.split('/')[-1].split('.')[0]
-        elif bamFile:
-            self.countsPerBase = getBaseFrequencies(
-                bamFile, self.minBaseQuality, self.minMappingQuality,
-                referenceId=referenceId)
-            self.name = bamFile.split('/')[-1].split('.')[0]
+        elif bamFile or baseCounts:
+            if baseCounts is None:
+                baseCounts = getBaseCounts(
+                    bamFile, self.minBaseQuality, self.minMappingQuality,
+                    referenceId=referenceId, flagFilter=self.flagFilter,
+                    minReadLength=self.minReadLength, threads=threads,
+                    reference=reference, qualityBins=qualityBins,
+                    strand=strand, insertionSequences=insertionSequences,
+                    regions=regions, virus=virus, stream=stream,
+                    pipeline=pipeline)
+            counts = baseCounts['counts']
+            self.regions = baseCounts.get('regions')
+            if qualityBins:
+                self.qualityBins = list(qualityBins)
+                self.qualityBinCounts = baseCounts['qualityBinCounts']
+            if strand:
+                self.strandCounts = baseCounts['strandCounts']
+            self.insertionCounts = baseCounts.get('insertionCounts')
+            if insertionSequences:
+                self.insertionSequences = baseCounts['insertionSequences']
+            self.name = (bamFile.split('/')[-1].split('.')[0] if bamFile
+                         else None)
             self.sequencingTech = sequencingTech
         else:
             raise ('At least one out of bamFile, jsonFile, or frequenciesDict '
                    'must be specified.')
 
-        self.coveragePerBase = []
-        for position in range(len(self.countsPerBase)):
-            self.coveragePerBase.append(self.countsPerBase[position])
-        self.coveragePerBase = [sum(self.countsPerBase[i].values()) for i in
-                                range(len(self.countsPerBase))]
+        # An array of shape (length, len(BASES)) with the count of each base
+        # at each position.
+        self.counts = (countersToCounts(self._countsPerBase) if counts is None
+                       else counts)
+
+        coverage = self.counts.sum(axis=1)
+        self.coveragePerBase = coverage.tolist()
 
         self.length = len(self.coveragePerBase)
 
-        self.maxFreqPerBase = {}
-        for position in self.countsPerBase:
-            bases = list(self.countsPerBase[position].values())
-            if bases:
-                try:
-                    frequency = max(bases) / sum(bases)
-                except ZeroDivisionError:
-                    frequency = 0.0
-            else:
-                frequency = 0.0
-            self.maxFreqPerBase[position] = frequency
+        maxFreqs = np.divide(self.counts.max(axis=1, initial=0), coverage,
+                             out=np.zeros(self.length), where=coverage > 0)
+        self.maxFreqPerBase = dict(enumerate(maxFreqs.tolist()))
+
+        assert (self._countsPerBase is None or
+                self.length == len(self._countsPerBase))
+
+    @property
+    def countsPerBase(self):
+        """
+        Get the base counts as a C{dict} of C{Counter}s, as returned by
+        C{getBaseFrequencies}. Unless given as C{frequenciesDict} or read from
+        a dense json file, this is only made (from C{self.counts}) when first
+        used.
+
+        @return: A C{dict} mapping each C{int} position to a C{Counter} of
+            base counts.
+        """
+        if self._countsPerBase is None:
+            self._countsPerBase = countsToCounters(self.counts)
+
+        return self._countsPerBase
+
+    @staticmethod
+    def _loadPerBaseCounts(perBaseCounts):
+        """
+        Make a base counts array from the per-base count lists of a version 2
+        json file.
+
+        @param perBaseCounts: A C{dict} mapping each C{str} base to a C{list}
+            of its C{int} counts at all positions. Bases not in C{BASES} are
+            counted as 'N'.
+        @return: An C{int} array of shape (length, len(BASES)).
+        """
+        length = len(next(iter(perBaseCounts.values()), []))
+        counts = np.zeros((length, len(BASES)), dtype=int)
+        for base, baseCounts in perBaseCounts.items():
+            counts[:, BASE_INDEX.get(base, BASE_INDEX['N'])] += baseCounts
 
-        assert self.length == len(self.countsPerBase)
+        return counts
 
-    def save(self, outFilename=False):
+    @staticmethod
+    def _loadBaseCountsArray(openJson, key):
         """
-        Save self.countsPerBase to a json file.
+        Make a base counts array (e.g., the quality bin or strand counts)
+        from a parsed json file.
+
+        @param openJson: A C{dict} as written by C{save}.
+        @param key: The C{str} key of the nested count lists in C{openJson}.
+            Their last dimension holds the counts of the bases in
+            C{openJson['bases']}.
+        @return: An C{int} array with the bases of its last dimension in the
+            order of C{BASES}.
+        """
+        savedCounts = np.array(openJson[key], dtype=int)
+        counts = np.zeros(savedCounts.shape[:-1] + (len(BASES),), dtype=int)
+        for savedIndex, base in enumerate(openJson['bases']):
+            counts[..., BASES.index(base)] = savedCounts[..., savedIndex]
+
+        return counts
+
+    def atMinBaseQuality(self, minBaseQuality):
+        """
+        Re-derive the counts for a higher minimum base quality from the
+        quality bin counts, without reading the BAM file again. Strand and
+        insertion counts are not kept, as they are not counted per quality
+        bin.
+
+        @param minBaseQuality: The C{int} minimum base quality. Must be one of
+            the lower bin edges in C{self.qualityBins} and not below
+            C{self.minBaseQuality}.
+        @raise ValueError: If there are no quality bin counts or
+            C{minBaseQuality} cannot be derived from them.
+        @return: A new C{MinorVariantInfo} instance.
+        """
+        if self.qualityBinCounts is None:
+            raise ValueError('No quality bin counts are available. Use the '
+                             'qualityBins argument when reading the BAM '
+                             'file.')
+
+        if (minBaseQuality not in self.qualityBins or
+                minBaseQuality < self.minBaseQuality):
+            raise ValueError(
+                'Minimum base quality %d must be one of the quality bins '
+                '(%s) and at least %d.' % (
+                    minBaseQuality,
+                    ', '.join(map(str, self.qualityBins)),
+                    self.minBaseQuality))
+
+        index = self.qualityBins.index(minBaseQuality)
+
+        # A reversed cumulative sum over the bins gives the counts at or
+        # above each bin's lower edge.
+        cumulative = np.cumsum(self.qualityBinCounts[::-1], axis=0)[::-1]
+
+        qualityBinCounts = self.qualityBinCounts.copy()
+        qualityBinCounts[:index] = 0
+
+        mvi = MinorVariantInfo(
+            baseCounts={'counts': cumulative[index], 'regions': self.regions,
+                        'qualityBinCounts': qualityBinCounts},
+            minBaseQuality=minBaseQuality,
+            minMappingQuality=self.minMappingQuality,
+            sequencingTech=self.sequencingTech, flagFilter=self.flagFilter,
+            minReadLength=self.minReadLength, qualityBins=self.qualityBins)
+        mvi.name = self.name
+
+        return mvi
+
+    def save(self, outFilename=False, sparse=False, compression=None,
+             version=JSON_VERSION):
+        """
+        Save self.countsPerBase to a json file. The json is written a piece
+        at a time, with sorted keys.
 
         @param outFilename: A C{str} filename of the json file where
-            self.countsPerBase should be written to.
+            self.countsPerBase should be written to. If the name ends in
+            '.gz' or '.zst', the file is compressed with gzip or zstd. If not
+            given, write to standard output.
+        @param sparse: If C{True}, save the counts in the compact form of
+            C{mvlib.functions.SparseCounts} instead of as a C{Counter} per
+            position.
+        @param compression: If not C{None}, one of 'gzip', 'zstd' or 'none'
+            to use instead of the compression implied by C{outFilename}.
+            zstd compression needs the zstandard package.
+        @param version: The C{int} version of the json to write (see
+            C{JSON_VERSIONS}). Version 1 can be read by older code.
+        @raise ValueError: If C{version} is unknown, or sparse counts are
+            asked for in version 1.
         """
+        if version not in JSON_VERSIONS:
+            raise ValueError('Unknown json version %r. Known versions are %s.'
+                             % (version, ', '.join(map(str, JSON_VERSIONS))))
+
+        if sparse and version == 1:
+            raise ValueError('Sparse counts need json version 2.')
+
         data = {}
+        if version > 1:
+            data['version'] = version
+            data['bases'] = BASES
+
         data['parameters'] = {
             'sequencingTech': self.sequencingTech,
             'minBaseQuality': self.minBaseQuality,
             'minMappingQuality': self.minMappingQuality,
+            'flagFilter': self.flagFilter,
+            'minReadLength': self.minReadLength,
         }
-        data['countsPerBase'] = self.countsPerBase
+        if self.regions is not None:
+            data['parameters']['regions'] = self.regions
+        if sparse:
+            data['sparseCounts'] = SparseCounts(self.counts).toJson()
+        elif version == 1:
+            data['countsPerBase'] = self.countsPerBase
+        else:
+            data['counts'] = dict(zip(BASES, self.counts.T))
+
+        if self.qualityBinCounts is not None:
+            data['parameters']['qualityBins'] = self.qualityBins
+            data['bases'] = BASES
+            data['qualityBinCounts'] = self.qualityBinCounts
+
+        if self.strandCounts is not None:
+            data['bases'] = BASES
+            data['strandCounts'] = self.strandCounts
+
+        if self.insertionCounts is not None:
+            data['insertionCounts'] = self.insertionCounts
+
+        if self.insertionSequences is not None:
+            data['insertionSequences'] = self.insertionSequences
 
         if outFilename:
-            with open(outFilename, 'w') as fp:
-                json.dump(data, fp)
+            with dataFile(outFilename, 'w', compression) as fp:
+                _writeJson(fp, data)
+        elif compression and compression != 'none':
+            with dataFile(sys.stdout.buffer, 'w', compression) as fp:
+                _writeJson(fp, data)
+        else:
+            _writeJson(sys.stdout, data)
+
+    def strandBias(self):
+        """
+        Calculate the strand bias of each base at each position, as the
+        absolute difference between its frequency among the reads on the
+        forward strand and among the reads on the reverse strand. This does
+        not depend on how the coverage is split between the strands.
+
+        @raise ValueError: If there are no strand counts.
+        @return: A C{float} array of shape (length, len(BASES)) with values
+            between 0.0 (no bias) and 1.0 (the base is only seen on one
+            strand, and is all that is seen there). Positions that are not
+            covered on both strands are C{nan}.
+        """
+        if self.strandCounts is None:
+            raise ValueError('No strand counts are available. Use the strand '
+                             'argument when reading the BAM file.')
+
+        strandCoverage = self.strandCounts.sum(axis=2, keepdims=True)
+        frequencies = np.divide(
+            self.strandCounts, strandCoverage,
+            out=np.full(self.strandCounts.shape, np.nan),
+            where=strandCoverage > 0)
+
+        return np.abs(frequencies[0] - frequencies[1])
+
+    def minorVariantMask(self, minCoverage=50, minFrequency=0.03,
+                         maxStrandBias=None):
+        """
+        Find the positions with minor variants, as C{isMinorVariantPosition}
+        does, for all positions at once.
+
+        @param minCoverage: The C{int} number of read coverage that needs to be
+            present at a position for it to be considered a minor variant.
+        @param minFrequency: A C{float} minimum frequency with which at least
+            two nucleotides need to be present at a position for it to be
+            considered variable.
+        @param maxStrandBias: If not C{None}, a C{float} maximum strand bias
+            (see C{strandBias}). Bases with a higher strand bias, or at
+            positions not covered on both strands, do not count towards the
+            two nucleotides.
+        @return: A C{bool} array with a C{True} value for each position with
+            a minor variant.
+        """
+        if maxStrandBias is None:
+            baseMask = None
         else:
-            json.dump(data, sys.stdout, indent=4, sort_keys=True)
+            with np.errstate(invalid='ignore'):
+                baseMask = self.strandBias() <= maxStrandBias
+
+        return minorVariantMask(self.counts, minCoverage, minFrequency,
+                                baseMask)
+
+    def insertionFrequencies(self):
+        """
+        Calculate the frequency of reads with an insertion after each
+        position.
+
+        @raise ValueError: If there are no insertion counts.
+        @return: A C{float} array with the fraction of the reads covering
+            each position that have an insertion after it.
+        """
+        if self.insertionCounts is None:
+            raise ValueError('No insertion counts are available. Read the '
+                             'BAM file again to count insertions.')
+
+        coverage = self.counts.sum(axis=1)
+        return self.insertionCounts / np.maximum(coverage, 1)
+
+    def indelMask(self, minCoverage=50, minFrequency=0.03):
+        """
+        Find the positions with indel minor variants. These have an
+        insertion after them that is found in more than C{minFrequency} but
+        not in more than 1 - C{minFrequency} of the reads, or a deletion with
+        a frequency above C{minFrequency} together with at least one base
+        above C{minFrequency}.
+
+        @param minCoverage: The C{int} number of read coverage that needs to be
+            present at a position for it to be considered a minor variant.
+        @param minFrequency: A C{float} minimum frequency with which both
+            alleles need to be present at a position for it to be
+            considered variable.
+        @raise ValueError: If there are no insertion counts.
+        @return: A C{bool} array with a C{True} value for each position with
+            an indel minor variant.
+        """
+        insertionFrequencies = self.insertionFrequencies()
+        insertion = ((insertionFrequencies > minFrequency) &
+                     (1.0 - insertionFrequencies > minFrequency))
+
+        coverage = self.counts.sum(axis=1)
+        above = (self.counts / np.maximum(coverage, 1)[:, np.newaxis] >
+                 minFrequency)
+        deletionIndex = BASES.index('-')
+        deletion = (above[:, deletionIndex] &
+                    np.delete(above, deletionIndex, axis=1).any(axis=1))
+
+        return ((coverage > 0) & (coverage >= minCoverage) &
+                (insertion | deletion))
+
+    def indelRichness(self, minCoverage=50, minFrequency=0.03):
+        """
+        Calculate the number of positions with indel minor variants (see
+        C{indelMask}).
+
+        @param minCoverage: The C{int} number of read coverage that needs to be
+            present at a position for it to be considered a minor variant.
+        @param minFrequency: A C{float} minimum frequency with which both
+            alleles need to be present at a position for it to be
+            considered variable.
+        @raise ValueError: If there are no insertion counts.
+        """
+        return int(self.indelMask(minCoverage, minFrequency).sum())
+
+    def minorFrequencies(self):
+        """
+        Get the frequency of the second most common base (or deletion) at
+        each position.
+
+        @return: A C{float} array with the minor allele frequency at each
+            position, 0.0 where a position is not covered.
+        """
+        coverage = self.counts.sum(axis=1)
+        secondCounts = np.sort(self.counts, axis=1)[:, -2]
+        return np.divide(secondCounts, coverage, out=np.zeros(self.length),
+                         where=coverage > 0)
 
     def meanCoverage(self):
         """
@@ -108,7 +852,7 @@ class MinorVariantInfo():
         return np.mean(self.coveragePerBase)
 
     def richness(self, minCoverage=50, minFrequency=0.03,
-                 printFrequencies=False):
+                 printFrequencies=False, maxStrandBias=None):
         """
         Calculate the richness.
 
@@ -119,18 +863,21 @@ class MinorVariantInfo():
             considered variable.
         @param printFrequencies: if C{True}, print the base frequencies for the
             position that is a minor variant.
+        @param maxStrandBias: If not C{None}, a C{float} maximum strand bias,
+            as used by C{minorVariantMask}.
         """
-        richnessCount = 0
-        for position in self.countsPerBase:
-            if isMinorVariantPosition(self.countsPerBase[position],
-                                      minCoverage, minFrequency):
-                richnessCount += 1
-                if printFrequencies:
-                    print('\t', position, self.countsPerBase[position],
-                          richnessCount)
-        return richnessCount
+        positions = np.flatnonzero(self.minorVariantMask(
+            minCoverage, minFrequency, maxStrandBias))
 
-    def complexity(self, minCoverage=50, minFrequency=0.03):
+        if printFrequencies:
+            for richnessCount, position in enumerate(positions.tolist(), 1):
+                print('\t', position, self.countsPerBase[position],
+                      richnessCount)
+
+        return len(positions)
+
+    def complexity(self, minCoverage=50, minFrequency=0.03,
+                   maxStrandBias=None):
         """
         Calculate the complexity.
 
@@ -139,20 +886,15 @@ class MinorVariantInfo():
         @param minFrequency: A C{float} minimum frequency with which at least
             two nucleotides need to be present at a position for it to be
             considered variable.
+        @param maxStrandBias: If not C{None}, a C{float} maximum strand bias,
+            as used by C{minorVariantMask}.
         """
-        shannonEntropies = []
-        for position in self.countsPerBase:
-            if isMinorVariantPosition(self.countsPerBase[position],
-                                      minCoverage, minFrequency):
-                totalBases = sum(self.countsPerBase[position].values())
-                shannonEntropy = 0
-                for base in self.countsPerBase[position]:
-                    freq = self.countsPerBase[position][base] / totalBases
-                    shannonEntropy += (-freq * np.log(freq))
-                shannonEntropies.append(shannonEntropy)
-        return np.mean(shannonEntropies)
+        counts = self.counts[self.minorVariantMask(minCoverage, minFrequency,
+                                                   maxStrandBias)]
+        return np.mean(shannonEntropies(counts))
 
-    def distance(self, minCoverage=50, minFrequency=0.03):
+    def distance(self, minCoverage=50, minFrequency=0.03,
+                 maxStrandBias=None):
         """
         Calculate the distance.
 
@@ -161,18 +903,46 @@ class MinorVariantInfo():
         @param minFrequency: A C{float} minimum frequency with which at least
             two nucleotides need to be present at a position for it to be
             considered variable.
+        @param maxStrandBias: If not C{None}, a C{float} maximum strand bias,
+            as used by C{minorVariantMask}.
         """
-        distance = 0
-        for p in self.countsPerBase:
-            if isMinorVariantPosition(self.countsPerBase[p],
-                                      minCoverage, minFrequency):
-                totalBases = sum(list(self.countsPerBase[p].values()))
-                frequencies = sorted([self.countsPerBase[p][b] / totalBases for
-                                      b in self.countsPerBase[p]],
-                                     reverse=True)
-                distance += frequencies[1]
+        counts = self.counts[self.minorVariantMask(minCoverage, minFrequency,
+                                                   maxStrandBias)]
+        frequencies = counts / counts.sum(axis=1, keepdims=True)
+        # The distance is the sum of the second highest frequencies.
+        return np.sort(frequencies, axis=1)[:, -2].sum()
 
-        return distance
+    def variantTable(self, minCoverage=50, minFrequency=0.03,
+                     maxStrandBias=None, dataFrame=False):
+        """
+        Make a table of all minor variant positions (see
+        C{minorVariantMask}).
+
+        @param minCoverage: The C{int} number of read coverage that needs to be
+            present at a position for it to be considered a minor variant.
+        @param minFrequency: A C{float} minimum frequency with which at least
+            two nucleotides need to be present at a position for it to be
+            considered variable.
+        @param maxStrandBias: If not C{None}, a C{float} maximum strand bias,
+            as used by C{minorVariantMask}.
+        @param dataFrame: If C{True}, return a C{pandas.DataFrame} (pandas
+            must be installed) instead of a NumPy structured array.
+        @return: A NumPy structured array with dtype C{VARIANT_TABLE_DTYPE}
+            (or a C{pandas.DataFrame} with the same columns) with a row for
+            each minor variant position, giving its 0-based position, depth,
+            most common and second most common bases ('-' is a deletion)
+            and their frequencies, and the Shannon entropy of its base
+            frequencies.
+        """
+        positions = np.flatnonzero(self.minorVariantMask(
+            minCoverage, minFrequency, maxStrandBias))
+        table = makeVariantTable(self.counts[positions], positions)
+
+        if dataFrame:
+            import pandas as pd
+            return pd.DataFrame(table)
+        else:
+            return table
 
     def allelArray(self, minCoverage):
         """
@@ -230,3 +1000,265 @@ class MinorVariantInfo():
                                                   stop=offsets[1])
 
             return result
+
+    def geneStatistics(self, genes, minCoverage=50, minFrequency=0.03,
+                       maxStrandBias=None, dataFrame=False):
+        """
+        Calculate the mean coverage, richness, complexity, distance and
+        nucleotide diversity of each gene at once. The values of each position
+        are computed once and summed over the genes using cumulative sums, so
+        genes may overlap.
+
+        @param genes: One of 'SARS2', 'WNV' or 'YFV' to use the offsets of its
+            genes (see C{mvlib.common}), or a C{dict} (or iterable of pairs)
+            mapping C{str} gene names to 0-based (start, stop) offsets, with
+            C{stop} excluded.
+        @param minCoverage: The C{int} number of read coverage that needs to be
+            present at a position for it to be considered a minor variant.
+        @param minFrequency: A C{float} minimum frequency with which at least
+            two nucleotides need to be present at a position for it to be
+            considered variable.
+        @param maxStrandBias: If not C{None}, a C{float} maximum strand bias,
+            as used by C{minorVariantMask}.
+        @param dataFrame: If C{True}, return a C{pandas.DataFrame} (pandas
+            must be installed) instead of a NumPy structured array.
+        @raise ValueError: If C{genes} is an unknown virus, or a gene's
+            offsets are empty or not within the genome.
+        @return: A NumPy structured array with dtype C{GENE_STATISTICS_DTYPE}
+            (or a C{pandas.DataFrame} with the same columns) with a row for
+            each gene, in the order of C{genes}. The richness, complexity and
+            distance are those of C{richness}, C{complexity} and C{distance}
+            for the positions of the gene (the complexity is NaN for a gene
+            without minor variants). The nucleotide diversity 'pi' is that of
+            C{nucleotideDiversity}, i.e., the mean pairwise difference of the
+            nucleotides (not deletions or Ns) at each position of the gene,
+            summed and divided by the length of the gene.
+        """
+        if isinstance(genes, str):
+            if genes not in VI:
+                raise ValueError('Unknown virus %r. Known viruses are %s.' %
+                                 (genes, ', '.join(VI)))
+            genes = VI[genes]['o']
+
+        genes = dict(genes)
+        offsets = np.array(list(genes.values()),
+                           dtype=np.int64).reshape(-1, 2)
+        for gene, (start, stop) in zip(genes, offsets.tolist()):
+            if start < 0 or start >= stop or stop > self.length:
+                raise ValueError(
+                    'Gene %r offsets (%d, %d) are empty or not within the '
+                    'genome of length %d.' % (gene, start, stop, self.length))
+
+        mask = self.minorVariantMask(minCoverage, minFrequency, maxStrandBias)
+        coverage = self.counts.sum(axis=1)
+        frequencies = self.counts / np.maximum(coverage, 1)[:, np.newaxis]
+
+        # The mean pairwise difference of the nucleotides at each position,
+        # 0.0 where fewer than two are counted.
+        nucleotides = self.counts[:, _NUCLEOTIDE_INDICES].astype(np.float64)
+        n = nucleotides.sum(axis=1)
+        pairs = n * (n - 1) / 2
+        samePairs = (nucleotides * (nucleotides - 1) / 2).sum(axis=1)
+        differences = np.divide(pairs - samePairs, pairs,
+                                out=np.zeros(self.length), where=pairs > 0)
+
+        perPosition = np.stack([
+            coverage,
+            mask,
+            np.where(mask, shannonEntropies(self.counts), 0.0),
+            np.where(mask, np.sort(frequencies, axis=1)[:, -2], 0.0),
+            differences,
+        ])
+
+        starts, stops = offsets[:, 0], offsets[:, 1]
+        sums = segmentSums(perPosition, starts, stops)
+        lengths = stops - starts
+        richness = np.rint(sums[1]).astype(np.int64)
+
+        table = np.empty(len(genes), dtype=GENE_STATISTICS_DTYPE)
+        table['gene'] = list(genes)
+        table['start'] = starts
+        table['stop'] = stops
+        table['meanCoverage'] = sums[0] / lengths
+        table['richness'] = richness
+        table['complexity'] = np.divide(
+            sums[2], richness, out=np.full(len(genes), np.nan),
+            where=richness > 0)
+        table['distance'] = sums[3]
+        table['pi'] = sums[4] / lengths
+
+        if dataFrame:
+            import pandas as pd
+            return pd.DataFrame(table)
+        else:
+            return table
+
+    def pnps(self, virus, minCoverage=50, minFrequency=0.03, genes=None,
+             dataFrame=False, cacheDir=DEFAULT_CACHE_DIR):
+        """
+        Calculate the within-host pN/pS of each gene from the frequencies of
+        the minor alleles (see C{minorAllelePNPS}).
+
+        @param virus: One of 'SARS2', 'WNV' or 'YFV'.
+        @param minCoverage: The C{int} number of read coverage that needs to be
+            present at a position for it to be considered a minor variant.
+        @param minFrequency: A C{float} minimum frequency with which at least
+            two nucleotides need to be present at a position for it to be
+            considered variable, and a minor allele needs to be present to be
+            counted.
+        @param genes: An iterable of C{str} gene names of C{virus}, or
+            C{None} for all its genes.
+        @param dataFrame: If C{True}, return a C{pandas.DataFrame} (pandas
+            must be installed) instead of a NumPy structured array.
+        @param cacheDir: The C{str} directory the substitution tables are
+            cached in, or C{None} to not cache them on disk.
+        @return: A NumPy structured array with dtype C{PNPS_DTYPE} (or a
+            C{pandas.DataFrame} with the same columns) with a row for each
+            gene.
+        """
+        table = minorAllelePNPS(self.counts, virus, minCoverage, minFrequency,
+                                genes, cacheDir)
+
+        if dataFrame:
+            import pandas as pd
+            return pd.DataFrame(table)
+        else:
+            return table
+
+    def consensus(self, minDepth=10, ambiguityFrequency=None,
+                  keepGaps=True):
+        """
+        Make the consensus sequence (see C{consensusCodes}).
+
+        @param minDepth: The C{int} depth needed to call a base, else N.
+        @param ambiguityFrequency: If not C{None}, a C{float} frequency at or
+            above which a nucleotide is part of an IUPAC ambiguity code.
+        @param keepGaps: If C{True}, positions where deletions are the most
+            common are '-', so the consensus is aligned to the reference.
+            Otherwise, they are left out.
+        @return: The C{str} consensus sequence.
+        """
+        sequence = consensusCodes(self.counts, minDepth,
+                                  ambiguityFrequency).tobytes().decode('ascii')
+        return sequence if keepGaps else sequence.replace('-', '')
+
+    def referenceDifferences(self, virus, minDepth=10, dataFrame=False):
+        """
+        Find the positions where the most common base differs from the
+        reference genome of a virus.
+
+        @param virus: One of 'SARS2', 'WNV' or 'YFV'.
+        @param minDepth: The C{int} depth (of nucleotides and deletions)
+            needed at a position to call its most common base.
+        @param dataFrame: If C{True}, return a C{pandas.DataFrame} (pandas
+            must be installed) instead of a NumPy structured array.
+        @raise ValueError: If C{virus} is unknown or its genome is not as
+            long as the counts.
+        @return: A NumPy structured array with dtype
+            C{REFERENCE_DIFFERENCE_DTYPE} (or a C{pandas.DataFrame} with the
+            same columns) with a row for each difference, giving its 0-based
+            position, depth, reference and most common bases ('-' is a
+            deletion) and the frequency of the most common base.
+        """
+        if virus not in VI:
+            raise ValueError('Unknown virus %r. Known viruses are %s.' %
+                             (virus, ', '.join(VI)))
+
+        genome = VI[virus]['g'].sequence
+        if len(genome) != self.length:
+            raise ValueError('The counts have length %d, but the %s genome '
+                             'has length %d.' % (self.length, virus,
+                                                 len(genome)))
+
+        codes = consensusCodes(self.counts, minDepth)
+        reference = np.frombuffer(genome.encode('ascii'), dtype=np.uint8)
+        positions = np.flatnonzero((codes != ord('N')) & (codes != reference))
+
+        alleles = self.counts[positions][:, _CONSENSUS_INDICES]
+        depths = alleles.sum(axis=1)
+        table = np.empty(len(positions), dtype=REFERENCE_DIFFERENCE_DTYPE)
+        table['position'] = positions
+        table['depth'] = depths
+        table['referenceBase'] = reference[positions].view('S1').astype('U1')
+        table['majorBase'] = codes[positions].view('S1').astype('U1')
+        table['majorFrequency'] = alleles.max(axis=1, initial=0) / depths
+
+        if dataFrame:
+            import pandas as pd
+            return pd.DataFrame(table)
+        else:
+            return table
+
+
+def readGroupInfos(bamFile, minBaseQuality=None, minMappingQuality=None,
+                   sequencingTech=None, referenceId=False,
+                   flagFilter=DEFAULT_FLAG_FILTER, minReadLength=None,
+                   threads=1, reference=None, qualityBins=None, strand=False,
+                   insertionSequences=False, regions=None, virus=None,
+                   stream=False, pipeline=False):
+    """
+    Make a C{MinorVariantInfo} for each sample in a BAM or CRAM file holding
+    the reads of several (e.g., barcoded) samples, told apart by their read
+    group, in a single pass over the file.
+
+    The samples are those of the read groups in the file header (see
+    C{mvlib.functions.readGroupSamples}). Reads without a read group from
+    the header are not used. The arguments are as for C{MinorVariantInfo}.
+
+    @raise ValueError: If the file header has no read groups.
+    @return: A C{dict} mapping each C{str} sample name to a
+        C{MinorVariantInfo} instance with that name.
+    """
+    minBaseQuality = minBaseQuality if minBaseQuality else 0
+    minMappingQuality = minMappingQuality if minMappingQuality else 0
+    result = getBaseCounts(
+        bamFile, minBaseQuality, minMappingQuality, referenceId=referenceId,
+        flagFilter=flagFilter, minReadLength=minReadLength, threads=threads,
+        reference=reference, qualityBins=qualityBins, strand=strand,
+        insertionSequences=insertionSequences, regions=regions, virus=virus,
+        stream=stream, readGroups=True, pipeline=pipeline)
+
+    infos = {}
+    for sample, baseCounts in result['samples'].items():
+        mvi = MinorVariantInfo(
+            minBaseQuality=minBaseQuality,
+            minMappingQuality=minMappingQuality,
+            sequencingTech=sequencingTech, flagFilter=flagFilter,
+            minReadLength=minReadLength, qualityBins=qualityBins,
+            strand=strand, insertionSequences=insertionSequences,
+            baseCounts=dict(baseCounts, regions=result['regions']))
+        mvi.name = sample
+        infos[sample] = mvi
+
+    return infos
+
+
+def writeConsensusFasta(samples, outFilename, minDepth=10,
+                        ambiguityFrequency=None, keepGaps=True,
+                        compression=None):
+    """
+    Write the consensus sequences of a cohort of samples to a FASTA file.
+
+    @param samples: An iterable of C{MinorVariantInfo} instances, e.g., as
+        returned by C{mvlib.load.load}. Each sequence is named after its
+        sample.
+    @param outFilename: The C{str} name of the FASTA file to write. If the
+        name ends in '.gz' or '.zst', the file is compressed with gzip or
+        zstd.
+    @param minDepth: The C{int} depth needed to call a base, else N.
+    @param ambiguityFrequency: If not C{None}, a C{float} frequency at or
+        above which a nucleotide is part of an IUPAC ambiguity code.
+    @param keepGaps: If C{True}, keep '-' for positions where deletions are
+        the most common.
+    @param compression: If not C{None}, one of 'gzip', 'zstd' or 'none' to
+        use instead of the compression implied by C{outFilename}.
+    @return: The C{int} number of sequences written.
+    """
+    count = 0
+    with dataFile(outFilename, 'w', compression) as fp:
+        for sample in samples:
+            fp.write('>%s\n%s\n' % (sample.name, sample.consensus(
+                minDepth, ambiguityFrequency, keepGaps)))
+            count += 1
+
+    return count
@@ -0,0 +1,316 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+import json
+import os
+from os.path import basename, dirname, exists, getmtime, join
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from mvlib.graphics import FURINPOSITIONS, plotFrequencies
+from mvlib.minorVariants import MinorVariantInfo
+
+# The stages run for each sample, in order, and the stage each reads the
+# output of (C{None} for the sample's BAM file).
+STAGES = ('counts', 'statistics', 'plot')
+STAGE_INPUTS = {'counts': None, 'statistics': 'counts', 'plot': 'counts'}
+
+# The name of the file, in the output directory, that records the outputs
+# made by the pipeline and the parameters they were made with.
+MANIFEST = 'manifest.json'
+
+# The positions plotted by default: the SARS2 furin cleavage site.
+DEFAULT_PLOT_POSITIONS = FURINPOSITIONS
+
+
+def sampleName(bamFile):
+    """
+    Get the name of the sample in a BAM file, as C{MinorVariantInfo} does.
+
+    @param bamFile: The C{str} name of a BAM or CRAM file.
+    @return: The C{str} sample name.
+    """
+    return basename(bamFile).split('.')[0]
+
+
+def stageOutputs(outDir, name, plotFormat='png'):
+    """
+    Get the names of the files the stages of the pipeline write for a sample.
+
+    @param outDir: The C{str} output directory of the pipeline.
+    @param name: The C{str} sample name.
+    @param plotFormat: The C{str} file format of the plot.
+    @return: A C{dict} mapping each stage in C{STAGES} to the C{str} name of
+        its output file.
+    """
+    return {
+        'counts': join(outDir, 'counts', name + '.json.gz'),
+        'statistics': join(outDir, 'statistics', name + '.json'),
+        'plot': join(outDir, 'plots', '%s.%s' % (name, plotFormat)),
+    }
+
+
+@contextmanager
+def atomicOutput(filename):
+    """
+    A context manager giving a temporary file name to write an output to.
+    The temporary file (in the same directory, with the same suffixes)
+    replaces C{filename} at once when the context exits without an error,
+    and is removed otherwise, so an interrupted run never leaves a partial
+    C{filename}.
+
+    @param filename: The C{str} name of the output file.
+    """
+    directory = dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tempFile = join(directory, '.tmp-%d-%s' % (os.getpid(),
+                                               basename(filename)))
+    try:
+        yield tempFile
+    except BaseException:
+        if exists(tempFile):
+            os.unlink(tempFile)
+        raise
+    else:
+        os.replace(tempFile, filename)
+
+
+def readManifest(outDir):
+    """
+    Read the manifest of a pipeline output directory.
+
+    @param outDir: The C{str} output directory of the pipeline.
+    @return: A C{dict} mapping output file names to C{dict}s with the
+        'sample', 'stage', 'inputs' and 'params' they were made from and the
+        C{float} 'time' they were finished, or an empty C{dict} if there is
+        no manifest yet.
+    """
+    manifestFile = join(outDir, MANIFEST)
+    if exists(manifestFile):
+        with open(manifestFile) as fp:
+            return json.load(fp)
+    else:
+        return {}
+
+
+def _writeManifest(outDir, manifest):
+    """
+    Write the manifest of a pipeline output directory.
+
+    @param outDir: The C{str} output directory of the pipeline.
+    @param manifest: A C{dict}, as returned by C{readManifest}.
+    """
+    with atomicOutput(join(outDir, MANIFEST)) as tempFile:
+        with open(tempFile, 'w') as fp:
+            json.dump(manifest, fp, indent=1, sort_keys=True)
+
+
+def isUpToDate(output, inputs, params, entry):
+    """
+    Check whether an output needs to be made again.
+
+    @param output: The C{str} name of the output file.
+    @param inputs: A C{list} of the C{str} names of the files it is made
+        from.
+    @param params: A C{dict} of the parameters it is made with (as it would
+        be read back from json).
+    @param entry: The manifest C{dict} entry of C{output}, or C{None}.
+    @return: C{True} if C{output} exists, was recorded in the manifest as
+        made with C{params}, and is not older than any of C{inputs}.
+    """
+    return (entry is not None and entry['params'] == params and
+            exists(output) and
+            all(getmtime(output) >= getmtime(input_) for input_ in inputs))
+
+
+def _runStage(stage, inputFile, outputFile, params, readOptions):
+    """
+    Make the output of a stage for a sample.
+
+    @param stage: One of C{STAGES}.
+    @param inputFile: The C{str} name of the file the stage reads.
+    @param outputFile: The C{str} name of the (temporary) file to write.
+    @param params: A C{dict} of the parameters of the stage.
+    @param readOptions: A C{dict} of further keyword arguments for
+        C{MinorVariantInfo} when reading a BAM file, that do not change the
+        counts.
+    """
+    if stage == 'counts':
+        mvi = MinorVariantInfo(bamFile=inputFile, **params, **readOptions)
+        mvi.save(outputFile, compression='gzip')
+    elif stage == 'statistics':
+        mvi = MinorVariantInfo(jsonFile=inputFile)
+        minCoverage = params['minCoverage']
+        minFrequency = params['minFrequency']
+        richness = mvi.richness(minCoverage, minFrequency)
+        statistics = {
+            'meanCoverage': float(mvi.meanCoverage()),
+            'richness': richness,
+            # Json has no NaN, for the complexity of no minor variants.
+            'complexity': (float(mvi.complexity(minCoverage, minFrequency))
+                           if richness else None),
+            'distance': float(mvi.distance(minCoverage, minFrequency)),
+        }
+        with open(outputFile, 'w') as fp:
+            json.dump(statistics, fp, indent=1, sort_keys=True)
+    else:
+        mvi = MinorVariantInfo(jsonFile=inputFile)
+        fig, ax = plt.subplots(1, 1, figsize=(16, 3.75))
+        try:
+            plotFrequencies(mvi, params['positions'], outFilename=outputFile,
+                            ax=ax, outFormat=params['format'])
+        finally:
+            plt.close(fig)
+
+
+def _runSample(bamFile, outDir, stageParams, readOptions, manifest, force):
+    """
+    Run the stages of the pipeline that are not up to date for one sample.
+
+    @param bamFile: The C{str} name of the sample's BAM or CRAM file.
+    @param outDir: The C{str} output directory of the pipeline.
+    @param stageParams: A C{dict} mapping each stage to a C{dict} of its
+        parameters.
+    @param readOptions: A C{dict} of keyword arguments for
+        C{MinorVariantInfo} that do not change the counts.
+    @param manifest: The C{dict} manifest (see C{readManifest}) of
+        C{outDir} when the run started.
+    @param force: If C{True}, run all stages.
+    @return: A 3-C{tuple} with a C{dict} mapping each stage that was
+        considered to 'done' or 'skipped', a C{dict} of the new manifest
+        entries, and the C{str} error that stopped the sample (or C{None}).
+    """
+    name = sampleName(bamFile)
+    outputs = stageOutputs(outDir, name, stageParams['plot']['format'])
+    statuses = {}
+    entries = {}
+
+    try:
+        for stage in STAGES:
+            inputStage = STAGE_INPUTS[stage]
+            inputFile = bamFile if inputStage is None else outputs[inputStage]
+            outputFile = outputs[stage]
+            params = stageParams[stage]
+            if not force and isUpToDate(outputFile, [inputFile], params,
+                                        manifest.get(outputFile)):
+                statuses[stage] = 'skipped'
+            else:
+                with atomicOutput(outputFile) as tempFile:
+                    _runStage(stage, inputFile, tempFile, params,
+                              readOptions)
+                entries[outputFile] = {
+                    'sample': name,
+                    'stage': stage,
+                    'inputs': [inputFile],
+                    'params': params,
+                    'time': time.time(),
+                }
+                statuses[stage] = 'done'
+    except Exception as e:
+        return statuses, entries, '%s: %s' % (e.__class__.__name__, e)
+
+    return statuses, entries, None
+
+
+def _initializeWorker():
+    """
+    Set up a worker process to plot without a display.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def runPipeline(bamFiles, outDir, countParams=None, minCoverage=50,
+                minFrequency=0.03, plotPositions=DEFAULT_PLOT_POSITIONS,
+                plotFormat='png', threads=1, pipeline=False, workers=None,
+                force=False):
+    """
+    Take BAM files through the stages of the pipeline: base counts (saved as
+    gzip compressed json), statistics (json) and a plot of the base
+    frequencies, in subdirectories of C{outDir}.
+
+    An output is only made again if it is missing, if one of its inputs is
+    newer, or if the parameters it was made with (as recorded in the
+    manifest in C{outDir}) differ. So a run that was interrupted can be
+    started again and carries on where it stopped. Outputs are written
+    atomically. Samples are run concurrently, and the manifest is updated as
+    each sample finishes. A sample whose stage fails does not stop the
+    others.
+
+    @param bamFiles: An iterable of C{str} names of BAM or CRAM files, each
+        with a different sample name (see C{sampleName}).
+    @param outDir: The C{str} output directory.
+    @param countParams: If not C{None}, a C{dict} of keyword arguments for
+        C{MinorVariantInfo} when reading the BAM files (e.g.,
+        'minBaseQuality', 'qualityBins' or 'reference'). Its values must be
+        json serializable.
+    @param minCoverage: The C{int} minimum coverage of a minor variant, for
+        the statistics.
+    @param minFrequency: The C{float} minimum frequency of a minor variant,
+        for the statistics.
+    @param plotPositions: A C{list} of 1-based positions to plot.
+    @param plotFormat: The C{str} file format of the plots.
+    @param threads: The C{int} number of threads to use for decompressing
+        each BAM file.
+    @param pipeline: If C{True}, read each BAM file in a separate thread
+        from the one that counts its bases (see C{getBaseCounts}). As the
+        BAM files are piled up, this is not faster and can be slower.
+    @param workers: The C{int} maximum number of samples to run at once, in
+        worker processes, or C{None} to use one per CPU. With 1, samples are
+        run one after the other in this process.
+    @param force: If C{True}, make all outputs again.
+    @raise ValueError: If two BAM files have the same sample name.
+    @return: A C{dict} mapping each sample name to a C{dict} with the
+        'done' or 'skipped' status of each stage that was considered and the
+        C{str} 'error' that stopped the sample, or C{None}.
+    """
+    bamFiles = list(bamFiles)
+    names = [sampleName(bamFile) for bamFile in bamFiles]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError('Several BAM files have the same sample name: %s.' %
+                         ', '.join(map(repr, duplicates)))
+
+    # Parameters are compared as they are read back from the manifest.
+    stageParams = json.loads(json.dumps({
+        'counts': countParams or {},
+        'statistics': {'minCoverage': minCoverage,
+                       'minFrequency': minFrequency},
+        'plot': {'positions': [int(position) for position in
+                               np.asarray(plotPositions).tolist()],
+                 'format': plotFormat},
+    }))
+
+    # These do not change the outputs, so are not recorded.
+    readOptions = {'threads': threads, 'pipeline': pipeline}
+
+    os.makedirs(outDir, exist_ok=True)
+    manifest = readManifest(outDir)
+    results = {}
+
+    def record(name, result):
+        statuses, entries, error = result
+        results[name] = dict(statuses, error=error)
+        if entries:
+            manifest.update(entries)
+            _writeManifest(outDir, manifest)
+
+    if workers == 1:
+        for name, bamFile in zip(names, bamFiles):
+            record(name, _runSample(bamFile, outDir, stageParams,
+                                    readOptions, manifest, force))
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_initializeWorker) as executor:
+            pending = {
+                executor.submit(_runSample, bamFile, outDir, stageParams,
+                                readOptions, manifest, force): name
+                for name, bamFile in zip(names, bamFiles)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record(pending.pop(future), future.result())
+
+    return {name: results[name] for name in names}
@@ -1,3 +1,7 @@
+import hashlib
+import numpy as np
+import os
+from os.path import exists, expanduser, join
 import sys
 from mvlib.common import (SARS2GENOME, SARS2OFFSETS, CODONSTOAA, YFVGENOME,
                           YFVOFFSETS, WNVGENOME, WNVOFFSETS)
@@ -171,3 +175,149 @@ def isNS(position, nt, virus):
         return [codons_to_aa[oldCodon], codons_to_aa[newCodon], position + 1]
     else:
         return [False, False, position + 1]
+
+
+# The order of the alternative bases in a substitution table.
+SUBSTITUTION_BASES = 'ACGT'
+
+# The values in a substitution table.
+NO_CHANGE = -1
+SYNONYMOUS = 0
+NON_SYNONYMOUS = 1
+
+# The directory substitution tables are cached in by default.
+DEFAULT_CACHE_DIR = os.environ.get(
+    'MVLIB_CACHE_DIR', join(expanduser('~'), '.cache', 'mvlib'))
+
+# The substitution tables computed in this process, keyed by virus.
+_SUBSTITUTION_TABLES = {}
+
+
+def _codonAminoAcids():
+    """
+    Number the amino acids (as in C{codons_to_aa}) of all codons.
+
+    @return: An C{int} array of length 64 with a number for the amino acid
+        of each codon, indexed by 16 * i + 4 * j + k for a codon made of the
+        bases at indices i, j and k of C{SUBSTITUTION_BASES}.
+    """
+    aminoAcids = sorted(set(codons_to_aa.values()))
+    result = np.empty(64, dtype=np.int64)
+    for codon, aminoAcid in codons_to_aa.items():
+        index = sum(SUBSTITUTION_BASES.index(base) * weight
+                    for base, weight in zip(codon, (16, 4, 1)))
+        result[index] = aminoAcids.index(aminoAcid)
+    return result
+
+
+def baseIndices(sequence):
+    """
+    Convert a nucleotide sequence to indices in C{SUBSTITUTION_BASES}.
+
+    @param sequence: A C{str} sequence of A, C, G and T.
+    @raise ValueError: If the sequence has another character.
+    @return: An C{int} array with the index of each base.
+    """
+    lookup = np.full(256, -1, dtype=np.int64)
+    for index, base in enumerate(SUBSTITUTION_BASES):
+        lookup[ord(base)] = index
+    indices = lookup[np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)]
+    if (indices == -1).any():
+        raise ValueError('Sequence has a base that is not one of %s.' %
+                         ', '.join(SUBSTITUTION_BASES))
+    return indices
+
+
+def geneSubstitutions(sequence):
+    """
+    Find out whether each possible single base change in a coding sequence
+    changes the amino acid (as C{isNS} does, with the codons of
+    C{codons_to_aa}).
+
+    @param sequence: The C{str} coding sequence of a gene, whose length is a
+        multiple of three.
+    @raise ValueError: If the length of C{sequence} is not a multiple of
+        three or it has a base that is not one of C{SUBSTITUTION_BASES}.
+    @return: An C{int8} array of shape (len(sequence),
+        len(SUBSTITUTION_BASES)) holding, for each position and base, either
+        C{NON_SYNONYMOUS}, C{SYNONYMOUS} or (for the base in C{sequence})
+        C{NO_CHANGE}.
+    """
+    if len(sequence) % 3:
+        raise ValueError('The length of a coding sequence (%d) must be a '
+                         'multiple of three.' % len(sequence))
+
+    aminoAcids = _codonAminoAcids()
+    weights = np.array([16, 4, 1])
+    indices = baseIndices(sequence)
+    codons = indices.reshape(-1, 3)
+    original = aminoAcids[codons @ weights]
+
+    result = np.empty((len(indices), len(SUBSTITUTION_BASES)),
+                      dtype=np.int8)
+    for codonPosition in range(3):
+        for base in range(len(SUBSTITUTION_BASES)):
+            # The codons with the base at this codon position.
+            changed = (codons @ weights +
+                       (base - codons[:, codonPosition]) *
+                       weights[codonPosition])
+            result[codonPosition::3, base] = np.where(
+                aminoAcids[changed] == original, SYNONYMOUS, NON_SYNONYMOUS)
+
+    result[np.arange(len(indices)), indices] = NO_CHANGE
+    return result
+
+
+def substitutionTables(virus, cacheDir=DEFAULT_CACHE_DIR):
+    """
+    Get the substitution table (see C{geneSubstitutions}) of each gene of a
+    virus. Each gene is read in its own frame, so positions in overlapping
+    genes have a table row for each.
+
+    The tables are computed once per process and cached in C{cacheDir}, in a
+    file named after a checksum of the genome, gene offsets and codons, so
+    a changed genome never uses an out of date cache.
+
+    @param virus: One of 'SARS2', 'WNV' or 'YFV'.
+    @param cacheDir: The C{str} directory to cache the tables in, or C{None}
+        to not cache them on disk. The default is the MVLIB_CACHE_DIR
+        environment variable or ~/.cache/mvlib.
+    @raise ValueError: If C{virus} is unknown.
+    @return: A C{dict} mapping each gene name of C{VI[virus]['o']} to its
+        C{int8} substitution table.
+    """
+    if virus not in VI:
+        raise ValueError('Unknown virus %r. Known viruses are %s.' %
+                         (virus, ', '.join(VI)))
+
+    if virus not in _SUBSTITUTION_TABLES:
+        genome = VI[virus]['g'].sequence
+        offsets = VI[virus]['o']
+        checksum = hashlib.sha256(repr(
+            (genome, sorted(offsets.items()),
+             sorted(codons_to_aa.items()))).encode()).hexdigest()[:16]
+        cacheFile = (join(cacheDir, '%s-substitutions-%s.npz' %
+                          (virus, checksum)) if cacheDir else None)
+
+        if cacheFile and exists(cacheFile):
+            with np.load(cacheFile) as data:
+                tables = {gene: data[gene] for gene in offsets}
+        else:
+            tables = {gene: geneSubstitutions(genome[start:stop])
+                      for gene, (start, stop) in offsets.items()}
+            if cacheFile:
+                try:
+                    os.makedirs(cacheDir, exist_ok=True)
+                    # Write to a temporary file, so other processes never
+                    # read a partial cache.
+                    tempFile = '%s.%d.tmp.npz' % (cacheFile[:-4],
+                                                  os.getpid())
+                    np.savez(tempFile, **tables)
+                    os.replace(tempFile, cacheFile)
+                except OSError:
+                    # The cache is only an optimization.
+                    pass
+
+        _SUBSTITUTION_TABLES[virus] = tables
+
+    return _SUBSTITUTION_TABLES[virus]
@@ -0,0 +1,248 @@
+import asyncio
+from functools import lru_cache
+import json
+import numpy as np
+import socket
+
+# The queries a CohortService answers. Except for 'samples', each is the
+# name of a MinorVariantInfo method that is called on every selected sample
+# with the query's parameters.
+QUERIES = ('samples', 'meanCoverage', 'richness', 'complexity', 'distance',
+           'indelRichness', 'nucleotideDiversity', 'variantTable',
+           'geneStatistics')
+
+# The default maximum length, in bytes, of a request line, big enough for
+# requests that list many thousands of samples.
+REQUEST_LIMIT = 2 ** 26
+
+
+def _freeze(value):
+    """
+    Make a value from a json request hashable, so it can be a cache key.
+
+    @param value: A value decoded from json.
+    @return: The value with lists turned into C{tuple}s and C{dict}s turned
+        into sorted C{tuple}s of (key, value) C{tuple}s.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item))
+                            for key, item in value.items()))
+    elif isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    else:
+        return value
+
+
+def _jsonable(value):
+    """
+    Convert a query result to something that can be written as json.
+
+    @param value: A query result, e.g., a NumPy scalar or (structured) array.
+    @raise TypeError: If C{value} holds something json cannot represent,
+        e.g., a C{pandas.DataFrame}.
+    @return: The result as Python built-in types.
+    """
+    if isinstance(value, np.ndarray):
+        if value.dtype.names:
+            return [dict(zip(value.dtype.names, row))
+                    for row in value.tolist()]
+        return value.tolist()
+    elif isinstance(value, np.generic):
+        return value.item()
+    elif isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    elif isinstance(value, dict):
+        return {key: _jsonable(item) for key, item in value.items()}
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    else:
+        raise TypeError('A query result of type %s cannot be sent as JSON.' %
+                        value.__class__.__name__)
+
+
+class CohortService():
+    """
+    Answer queries about a cohort of samples that is loaded once and kept in
+    memory, with the answers to repeated queries cached.
+
+    A request is a C{dict} with a 'query' (one of C{QUERIES}) and optionally
+    'samples' (a C{list} of sample names, default all samples),
+    'minMeanCoverage' (only use samples whose mean coverage is above this)
+    and 'params' (a C{dict} of keyword arguments for the query's
+    C{MinorVariantInfo} method). For example::
+
+        {"query": "richness", "samples": ["s1", "s2"],
+         "params": {"minCoverage": 100, "minFrequency": 0.01}}
+
+    The response is a C{dict} with a 'result' C{dict} of the answer for each
+    selected sample, keyed by sample name (or, for 'samples', a C{list} of
+    the selected sample names), or an 'error' C{str} giving the exception
+    that stopped the query, e.g. "ValueError: Unknown query 'save'."
+
+    @param samples: An iterable of C{MinorVariantInfo} instances, e.g., as
+        returned by C{mvlib.load.load}.
+    @param cacheSize: The C{int} maximum number of query answers to cache.
+    """
+    def __init__(self, samples, cacheSize=1024):
+        self.samples = {sample.name: sample for sample in samples}
+        self._cachedQuery = lru_cache(maxsize=cacheSize)(self._query)
+
+    def _query(self, query, names, minMeanCoverage, params):
+        """
+        Answer a query.
+
+        @param query: One of the C{str} names in C{QUERIES}.
+        @param names: A C{tuple} of C{str} sample names, or C{None} for all
+            samples.
+        @param minMeanCoverage: If not C{None}, a C{float} mean coverage that
+            a sample must be above to be used.
+        @param params: A frozen (see C{_freeze}) C{dict} of keyword arguments
+            for the query's C{MinorVariantInfo} method.
+        @raise ValueError: If C{query} or a sample name is unknown.
+        @return: The answer, as Python built-in types.
+        """
+        if query not in QUERIES:
+            raise ValueError('Unknown query %r.' % query)
+
+        if names is None:
+            names = tuple(self.samples)
+        else:
+            unknown = [name for name in names if name not in self.samples]
+            if unknown:
+                raise ValueError('Unknown sample(s): %s.' % ', '.join(
+                    map(repr, unknown)))
+
+        if minMeanCoverage is not None:
+            names = tuple(name for name in names if
+                          self.samples[name].meanCoverage() > minMeanCoverage)
+
+        if query == 'samples':
+            return list(names)
+
+        kwargs = {key: value for key, value in params}
+        return {name: _jsonable(getattr(self.samples[name], query)(**kwargs))
+                for name in names}
+
+    def cacheInfo(self):
+        """
+        Get statistics about the cache of query answers.
+
+        @return: The C{functools._CacheInfo} of the cache.
+        """
+        return self._cachedQuery.cache_info()
+
+    def handle(self, request):
+        """
+        Answer a request.
+
+        @param request: A request C{dict} (see the class docstring).
+        @return: A response C{dict} with a 'result' or an 'error'.
+        """
+        try:
+            if not isinstance(request, dict):
+                raise ValueError('A request must be a JSON object.')
+            names = request.get('samples')
+            minMeanCoverage = request.get('minMeanCoverage')
+            result = self._cachedQuery(
+                request.get('query'),
+                None if names is None else tuple(names),
+                minMeanCoverage,
+                _freeze(request.get('params', {})))
+        except Exception as e:
+            # Whatever goes wrong, the client gets a reply.
+            return {'error': '%s: %s' % (e.__class__.__name__, e)}
+        else:
+            return {'result': result}
+
+    async def _serveConnection(self, reader, writer):
+        """
+        Answer the requests of a client, one json request per line, each
+        answered with one json response line. Queries are computed in a
+        thread so that other clients are served meanwhile.
+
+        @param reader: The C{asyncio.StreamReader} of the connection.
+        @param writer: The C{asyncio.StreamWriter} of the connection.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ValueError, asyncio.LimitOverrunError) as e:
+                    # What is left of the request cannot be told apart from
+                    # the next one, so give up on the connection.
+                    response = {'error': 'Could not read request: %s' % e}
+                    writer.write(json.dumps(response).encode() + b'\n')
+                    await writer.drain()
+                    break
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    response = {'error': 'Could not parse request: %s' % e}
+                else:
+                    response = await loop.run_in_executor(
+                        None, self.handle, request)
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def start(self, socketPath=None, port=None, host='127.0.0.1',
+                    limit=REQUEST_LIMIT):
+        """
+        Start serving requests.
+
+        @param socketPath: If not C{None}, the C{str} path of a Unix socket
+            to listen on.
+        @param port: If C{socketPath} is C{None}, the C{int} TCP port to
+            listen on (0 picks a free port).
+        @param host: The C{str} host to listen on when using TCP.
+        @param limit: The C{int} maximum length, in bytes, of a request. A
+            longer request is answered with an error and its connection
+            closed.
+        @return: The started C{asyncio.Server}.
+        """
+        if socketPath:
+            return await asyncio.start_unix_server(
+                self._serveConnection, path=socketPath, limit=limit)
+        else:
+            return await asyncio.start_server(self._serveConnection, host,
+                                              port, limit=limit)
+
+    def serveForever(self, socketPath=None, port=None, host='127.0.0.1',
+                     limit=REQUEST_LIMIT):
+        """
+        Serve requests until interrupted. See C{start} for the parameters.
+        """
+        async def serve():
+            server = await self.start(socketPath, port, host, limit)
+            async with server:
+                await server.serve_forever()
+
+        asyncio.run(serve())
+
+
+def sendQuery(request, socketPath=None, port=None, host='127.0.0.1'):
+    """
+    Send a request to a running C{CohortService} and wait for its response.
+
+    @param request: A request C{dict} (see C{CohortService}).
+    @param socketPath: If not C{None}, the C{str} path of the Unix socket the
+        service listens on.
+    @param port: If C{socketPath} is C{None}, the C{int} TCP port the
+        service listens on.
+    @param host: The C{str} host the service listens on when using TCP.
+    @return: The response C{dict}.
+    """
+    if socketPath:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socketPath)
+    else:
+        connection = socket.create_connection((host, port))
+
+    with connection, connection.makefile('rwb') as fp:
+        fp.write(json.dumps(request).encode() + b'\n')
+        fp.flush()
+        return json.loads(fp.readline())
@@ -0,0 +1,228 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import os
+
+from mvlib.common import BASES
+from mvlib.minorVariants import MinorVariantInfo
+
+# The shared memory blocks and memory-mapped files a process has attached
+# to, keyed by name, so each is only attached once per worker process.
+_ATTACHED = {}
+
+
+def _attach(memoryName, filename, shape):
+    """
+    Get the counts array of a C{SharedCohort} in this process, without
+    copying it.
+
+    @param memoryName: The C{str} name of the shared memory block, or
+        C{None} if the counts are in C{filename}.
+    @param filename: The C{str} name of the memory-mapped .npy file, or
+        C{None} if the counts are in shared memory.
+    @param shape: The C{tuple} shape of the counts array.
+    @return: A read-only C{int32} array of shape C{shape}.
+    """
+    key = memoryName or filename
+    if key not in _ATTACHED:
+        if memoryName:
+            memory = SharedMemory(name=memoryName)
+            counts = np.ndarray(shape, dtype=np.int32, buffer=memory.buf)
+            # Keep the block open for as long as the array is in use.
+            _ATTACHED[key] = (memory, counts)
+        else:
+            _ATTACHED[key] = (None, np.load(filename, mmap_mode='r'))
+        _ATTACHED[key][1].setflags(write=False)
+
+    return _ATTACHED[key][1]
+
+
+def _callOnSample(cohort, index, function, args):
+    """
+    Call a function on one sample of a shared cohort, in a worker process.
+
+    @param cohort: A C{SharedCohort}, as unpickled in the worker.
+    @param index: The C{int} index of the sample.
+    @param function: A function that takes a C{MinorVariantInfo} and
+        C{args}, or the C{str} name of a C{MinorVariantInfo} method.
+    @param args: A C{tuple} of further arguments for C{function}.
+    @return: What C{function} returns.
+    """
+    sample = cohort.sample(index)
+    if isinstance(function, str):
+        return getattr(sample, function)(*args)
+    else:
+        return function(sample, *args)
+
+
+class SharedCohort():
+    """
+    Hold the base counts of a cohort of samples once, in shared memory or in
+    a memory-mapped file, so that worker processes can analyse the samples
+    without each loading or being sent a copy of them.
+
+    The counts of all samples are one C{int32} array of shape (samples,
+    length, len(BASES)). Pickling a C{SharedCohort} (e.g., to send it to a
+    worker process) only pickles the name of the shared memory block or
+    file, the shape and the sample names; it is attached to again, without
+    copying, when unpickled. The process that made the cohort owns it and
+    must C{close} it (or use it as a context manager) when done, which frees
+    the shared memory.
+
+    @param samples: An iterable of C{MinorVariantInfo} instances, all of the
+        same length.
+    @param filename: If not C{None}, the C{str} name of a .npy file to hold
+        the counts, memory-mapped instead of in shared memory (e.g., for a
+        cohort larger than memory). The file is kept when the cohort is
+        closed.
+    @raise ValueError: If the samples do not all have the same length.
+    """
+    def __init__(self, samples, filename=None):
+        samples = list(samples)
+        self.names = [sample.name for sample in samples]
+        self.length = len(samples[0].counts) if samples else 0
+        self.filename = filename
+        self._owner = True
+        shape = (len(samples), self.length, len(BASES))
+
+        for sample in samples:
+            if len(sample.counts) != self.length:
+                raise ValueError(
+                    'All samples must have the same length (%d), not %d.' %
+                    (self.length, len(sample.counts)))
+
+        if filename:
+            self._memory = None
+            self.counts = np.lib.format.open_memmap(
+                filename, mode='w+', dtype=np.int32, shape=shape)
+        else:
+            # A shared memory block cannot be empty.
+            self._memory = SharedMemory(
+                create=True,
+                size=max(1, int(np.prod(shape)) * np.dtype(np.int32).itemsize))
+            self.counts = np.ndarray(shape, dtype=np.int32,
+                                     buffer=self._memory.buf)
+
+        for index, sample in enumerate(samples):
+            self.counts[index] = sample.counts
+
+        if filename:
+            self.counts.flush()
+
+    def __len__(self):
+        """
+        Get the number of samples in the cohort.
+
+        @return: The C{int} number of samples.
+        """
+        return len(self.names)
+
+    def __enter__(self):
+        """
+        Use the cohort as a context manager that closes it on exit.
+
+        @return: This C{SharedCohort}.
+        """
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        """
+        Close the cohort (see C{close}) when leaving its context.
+
+        @param excType: The class of the exception raised in the context, or
+            C{None}.
+        @param excValue: The exception raised in the context, or C{None}.
+        @param traceback: The traceback of the exception, or C{None}.
+        """
+        self.close()
+
+    def __getstate__(self):
+        """
+        Get what is pickled of the cohort: where its counts are, not the
+        counts themselves.
+
+        @return: A C{dict} with the name of the shared memory block (or
+            C{None}), the C{str} file name (or C{None}), the shape of the
+            counts and the sample names.
+        """
+        return {
+            'memoryName': self._memory.name if self._memory else None,
+            'filename': self.filename,
+            'shape': self.counts.shape,
+            'names': self.names,
+        }
+
+    def __setstate__(self, state):
+        """
+        Attach an unpickled cohort to the counts of the cohort it was pickled
+        from. It does not own them, so closing it does not free them.
+
+        @param state: A C{dict}, as returned by C{__getstate__}.
+        """
+        self.names = state['names']
+        self.length = state['shape'][1]
+        self.filename = state['filename']
+        self._owner = False
+        self._memory = None
+        self.counts = _attach(state['memoryName'], state['filename'],
+                              state['shape'])
+
+    def close(self):
+        """
+        Release the counts. If this is the process that made the cohort, the
+        shared memory is freed, so workers must be done with it.
+        """
+        if self._owner:
+            # Drop the array before its buffer, which cannot be closed while
+            # it is exported.
+            self.counts = None
+            if self._memory:
+                self._memory.close()
+                self._memory.unlink()
+                self._memory = None
+
+    def sample(self, index):
+        """
+        Get a sample, sharing its counts with the cohort.
+
+        @param index: The C{int} index (or C{str} name) of a sample.
+        @raise ValueError: If C{index} is a name not in the cohort.
+        @return: A C{MinorVariantInfo} instance.
+        """
+        if isinstance(index, str):
+            try:
+                index = self.names.index(index)
+            except ValueError:
+                raise ValueError('Sample %r is not in the cohort.' % index)
+
+        mvi = MinorVariantInfo(baseCounts={'counts': self.counts[index]})
+        mvi.name = self.names[index]
+        return mvi
+
+    def map(self, function, *args, workers=None):
+        """
+        Call a function on every sample, in parallel worker processes that
+        share the counts instead of receiving a copy.
+
+        @param function: A (picklable, i.e., module-level) function that
+            takes a C{MinorVariantInfo} and C{args}, or the C{str} name of a
+            C{MinorVariantInfo} method (e.g., 'richness') to call with
+            C{args}.
+        @param args: Further arguments for C{function}.
+        @param workers: The C{int} number of worker processes, or C{None} to
+            use one per CPU. With 1, everything is computed in this process.
+        @return: A C{list} of what C{function} returns for each sample, in
+            the order of the samples.
+        """
+        indices = range(len(self.names))
+
+        if workers == 1:
+            return [_callOnSample(self, index, function, args)
+                    for index in indices]
+
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(
+                _callOnSample, [self] * len(indices), indices,
+                [function] * len(indices), [args] * len(indices),
+                chunksize=max(1, len(indices) // (4 * workers))))
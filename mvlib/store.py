@@ -0,0 +1,410 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import json
+import numpy as np
+import os
+from os.path import exists, join
+
+from mvlib.common import BASES
+from mvlib.functions import compressBytes, decompressBytes
+from mvlib.minorVariants import (VARIANT_TABLE_DTYPE, makeVariantTable,
+                                 minorVariantMask, shannonEntropies)
+
+# The version of the layout of a CohortStore directory.
+STORE_VERSION = 1
+
+# The default number of samples and of positions in each chunk of a
+# CohortStore. A chunk of int32 counts then takes 64 * 4096 * 6 * 4 bytes
+# (6 MiB) of memory.
+SAMPLE_CHUNK_SIZE = 64
+POSITION_CHUNK_SIZE = 4096
+
+# The name of the file holding the description of a CohortStore.
+_METADATA = 'store.json'
+
+
+class CohortStore():
+    """
+    An on-disk array of the base counts of a cohort of samples, of shape
+    (samples, positions, len(BASES)), for cohorts too large to hold in
+    memory.
+
+    The array is split into chunks of C{sampleChunkSize} samples by
+    C{positionChunkSize} positions, each compressed and stored in its own
+    file in C{directory}, next to a json file describing the store. Samples
+    are added with C{append}. Statistics and variant tables are computed one
+    chunk at a time, in parallel worker processes, so only a few chunks are
+    in memory at once.
+
+    @param directory: The C{str} directory of the store. It is created if it
+        does not exist.
+    @param sampleChunkSize: The C{int} number of samples in each chunk of a
+        new store.
+    @param positionChunkSize: The C{int} number of positions in each chunk
+        of a new store.
+    @param compression: The compression of the chunks of a new store, one of
+        'gzip', 'zstd' (which needs the zstandard package) or 'none'.
+    """
+    def __init__(self, directory, sampleChunkSize=SAMPLE_CHUNK_SIZE,
+                 positionChunkSize=POSITION_CHUNK_SIZE, compression='gzip'):
+        self.directory = directory
+        metadataFile = join(directory, _METADATA)
+
+        if exists(metadataFile):
+            with open(metadataFile) as fp:
+                metadata = json.load(fp)
+            if metadata['version'] != STORE_VERSION:
+                raise ValueError(
+                    'Unknown store version %r in %r. The known version is '
+                    '%d.' % (metadata['version'], directory, STORE_VERSION))
+            self.names = metadata['names']
+            self.length = metadata['length']
+            self.sampleChunkSize = metadata['sampleChunkSize']
+            self.positionChunkSize = metadata['positionChunkSize']
+            self.compression = metadata['compression']
+        else:
+            # Check the compression before anything is written.
+            compressBytes(b'', compression)
+            os.makedirs(directory, exist_ok=True)
+            self.names = []
+            self.length = None
+            self.sampleChunkSize = sampleChunkSize
+            self.positionChunkSize = positionChunkSize
+            self.compression = compression
+            self._writeMetadata()
+
+    def __len__(self):
+        """
+        Get the number of samples in the store.
+
+        @return: The C{int} number of samples.
+        """
+        return len(self.names)
+
+    def _writeMetadata(self):
+        """
+        Write the description of the store, replacing any earlier one at
+        once. It is written after the chunks, so an interrupted C{append}
+        leaves a store with the samples of the chunks written before.
+        """
+        metadataFile = join(self.directory, _METADATA)
+        tempFile = metadataFile + '.tmp'
+        with open(tempFile, 'w') as fp:
+            json.dump({
+                'version': STORE_VERSION,
+                'bases': ''.join(BASES),
+                'length': self.length,
+                'sampleChunkSize': self.sampleChunkSize,
+                'positionChunkSize': self.positionChunkSize,
+                'compression': self.compression,
+                'names': self.names,
+            }, fp)
+        os.replace(tempFile, metadataFile)
+
+    def _chunkFile(self, sampleChunk, positionChunk):
+        """
+        Get the name of the file of a chunk.
+
+        @param sampleChunk: The C{int} index of the chunk along samples.
+        @param positionChunk: The C{int} index of the chunk along positions.
+        @return: The C{str} file name.
+        """
+        return join(self.directory, '%d.%d' % (sampleChunk, positionChunk))
+
+    def _positionChunks(self):
+        """
+        Get the positions of the chunks along positions.
+
+        @return: A C{list} of (start, end) 0-based C{int} offsets.
+        """
+        return [(start, min(start + self.positionChunkSize, self.length))
+                for start in range(0, self.length or 0,
+                                   self.positionChunkSize)]
+
+    def nChunks(self):
+        """
+        Get the number of chunks along samples and along positions.
+
+        @return: A 2-C{tuple} of C{int}s.
+        """
+        return (-(-len(self.names) // self.sampleChunkSize),
+                len(self._positionChunks()))
+
+    def chunk(self, sampleChunk, positionChunk):
+        """
+        Read a chunk of the counts.
+
+        @param sampleChunk: The C{int} index of the chunk along samples.
+        @param positionChunk: The C{int} index of the chunk along positions.
+        @return: An C{int32} array of shape (samples in the chunk, positions
+            in the chunk, len(BASES)).
+        """
+        start, end = self._positionChunks()[positionChunk]
+        nSamples = min(self.sampleChunkSize,
+                       len(self.names) - sampleChunk * self.sampleChunkSize)
+
+        with open(self._chunkFile(sampleChunk, positionChunk), 'rb') as fp:
+            data = decompressBytes(fp.read(), self.compression)
+
+        # The file may hold more samples than the store if an append was
+        # interrupted after the chunk was written.
+        return np.frombuffer(data, dtype=np.int32).reshape(
+            -1, end - start, len(BASES))[:nSamples]
+
+    def _writeSampleChunk(self, sampleChunk, counts):
+        """
+        Write the chunks of a group of samples.
+
+        @param sampleChunk: The C{int} index of the chunk along samples.
+        @param counts: An C{int32} array of shape (samples,
+            C{self.length}, len(BASES)).
+        """
+        for positionChunk, (start, end) in enumerate(self._positionChunks()):
+            chunkFile = self._chunkFile(sampleChunk, positionChunk)
+            tempFile = chunkFile + '.tmp'
+            with open(tempFile, 'wb') as fp:
+                fp.write(compressBytes(
+                    np.ascontiguousarray(counts[:, start:end]).tobytes(),
+                    self.compression))
+            os.replace(tempFile, chunkFile)
+
+    def append(self, samples):
+        """
+        Add samples to the store. Only one chunk of samples is held in memory
+        at a time.
+
+        @param samples: An iterable of C{MinorVariantInfo} instances (or of
+            anything with a C{str} C{name} and an C{int} C{counts} array of
+            shape (length, len(BASES))).
+        @raise ValueError: If a sample has a different length from the
+            samples in the store, or its name is already in the store.
+        """
+        sampleChunk, nInChunk = divmod(len(self.names), self.sampleChunkSize)
+
+        if nInChunk:
+            # Fill up the last chunk of samples.
+            buffer = list(np.concatenate(
+                [self.chunk(sampleChunk, positionChunk)
+                 for positionChunk in range(self.nChunks()[1])], axis=1))
+        else:
+            buffer = []
+
+        # The names of the samples in the buffer that are not yet in the
+        # store.
+        newNames = []
+        known = set(self.names)
+
+        for sample in samples:
+            if self.length is None:
+                self.length = len(sample.counts)
+            elif len(sample.counts) != self.length:
+                raise ValueError(
+                    'Sample %r has length %d, but the samples in the store '
+                    'have length %d.' % (sample.name, len(sample.counts),
+                                         self.length))
+            if sample.name in known:
+                raise ValueError('Sample %r is already in the store.' %
+                                 sample.name)
+
+            known.add(sample.name)
+            newNames.append(sample.name)
+            buffer.append(np.asarray(sample.counts, dtype=np.int32))
+
+            if len(buffer) == self.sampleChunkSize:
+                self._writeSampleChunk(sampleChunk, np.stack(buffer))
+                self.names.extend(newNames)
+                self._writeMetadata()
+                sampleChunk += 1
+                buffer = []
+                newNames = []
+
+        if newNames:
+            self._writeSampleChunk(sampleChunk, np.stack(buffer))
+            self.names.extend(newNames)
+            self._writeMetadata()
+
+    def sampleCounts(self, name):
+        """
+        Read the counts of one sample.
+
+        @param name: The C{str} name of a sample in the store.
+        @raise ValueError: If C{name} is not in the store.
+        @return: An C{int32} array of shape (length, len(BASES)).
+        """
+        try:
+            index = self.names.index(name)
+        except ValueError:
+            raise ValueError('Sample %r is not in the store.' % name)
+
+        sampleChunk, offset = divmod(index, self.sampleChunkSize)
+        return np.concatenate(
+            [self.chunk(sampleChunk, positionChunk)[offset]
+             for positionChunk in range(self.nChunks()[1])])
+
+    def _map(self, function, chunks, args, workers):
+        """
+        Call a function on chunks of the store, in parallel worker processes,
+        with only as many chunks (times two) as there are workers in memory
+        at any time.
+
+        @param function: A function that takes the store directory, the
+            C{int} sample and position chunk indices and C{args}.
+        @param chunks: An iterable of (sample chunk, position chunk) C{int}
+            index C{tuple}s.
+        @param args: A C{tuple} of further arguments for C{function}.
+        @param workers: The C{int} number of worker processes, or C{None} to
+            use one per CPU. With 1, everything is computed in this process.
+        @return: A generator of ((sample chunk, position chunk), result)
+            C{tuple}s, in no particular order.
+        """
+        if workers == 1:
+            for sampleChunk, positionChunk in chunks:
+                yield ((sampleChunk, positionChunk),
+                       function(self.directory, sampleChunk, positionChunk,
+                                *args))
+            return
+
+        workers = workers or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            chunks = iter(chunks)
+            while True:
+                for key in chunks:
+                    pending[executor.submit(function, self.directory, *key,
+                                            *args)] = key
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+
+    def statistics(self, minCoverage=50, minFrequency=0.03, workers=None):
+        """
+        Calculate the statistics of all samples (as the C{MinorVariantInfo}
+        methods of the same names do), one chunk at a time.
+
+        @param minCoverage: The C{int} number of read coverage that needs to
+            be present at a position for it to be considered a minor
+            variant.
+        @param minFrequency: A C{float} minimum frequency with which at least
+            two nucleotides need to be present at a position for it to be
+            considered variable.
+        @param workers: The C{int} number of worker processes, or C{None} to
+            use one per CPU. With 1, everything is computed in this process.
+        @return: A C{dict} mapping each sample name to a C{dict} with its
+            'meanCoverage', 'richness', 'complexity' (NaN if it has no minor
+            variant positions) and 'distance'.
+        """
+        nSampleChunks, nPositionChunks = self.nChunks()
+        sums = np.zeros((len(self.names), 4))
+
+        for (sampleChunk, _), chunkSums in self._map(
+                _chunkStatistics,
+                ((i, j) for i in range(nSampleChunks)
+                 for j in range(nPositionChunks)),
+                (minCoverage, minFrequency), workers):
+            start = sampleChunk * self.sampleChunkSize
+            sums[start:start + len(chunkSums)] += chunkSums
+
+        coverage, richness, entropy, distance = sums.T
+        return {
+            name: {
+                'meanCoverage': float(coverage[index] / self.length),
+                'richness': int(richness[index]),
+                'complexity': (float(entropy[index] / richness[index])
+                               if richness[index] else np.nan),
+                'distance': float(distance[index]),
+            }
+            for index, name in enumerate(self.names)}
+
+    def variantTables(self, minCoverage=50, minFrequency=0.03,
+                      workers=None):
+        """
+        Make the table of minor variant positions of each sample (as
+        C{MinorVariantInfo.variantTable} does), one chunk of samples at a
+        time.
+
+        @param minCoverage: The C{int} number of read coverage that needs to
+            be present at a position for it to be considered a minor
+            variant.
+        @param minFrequency: A C{float} minimum frequency with which at least
+            two nucleotides need to be present at a position for it to be
+            considered variable.
+        @param workers: The C{int} number of worker processes, or C{None} to
+            use one per CPU. With 1, everything is computed in this process.
+        @return: A generator of (C{str} sample name, table) C{tuple}s, in the
+            order of the samples in the store, where the table is a NumPy
+            structured array with dtype C{VARIANT_TABLE_DTYPE}.
+        """
+        nSampleChunks, nPositionChunks = self.nChunks()
+
+        for sampleChunk in range(nSampleChunks):
+            tables = [None] * nPositionChunks
+            for (_, positionChunk), chunkTables in self._map(
+                    _chunkVariantTables,
+                    ((sampleChunk, j) for j in range(nPositionChunks)),
+                    (minCoverage, minFrequency), workers):
+                tables[positionChunk] = chunkTables
+
+            start = sampleChunk * self.sampleChunkSize
+            names = self.names[start:start + self.sampleChunkSize]
+            for index, name in enumerate(names):
+                yield name, np.concatenate(
+                    [chunkTables[index] for chunkTables in tables] or
+                    [np.empty(0, dtype=VARIANT_TABLE_DTYPE)])
+
+
+def _chunkStatistics(directory, sampleChunk, positionChunk, minCoverage,
+                     minFrequency):
+    """
+    Calculate the sums that make up the statistics of the samples in a
+    chunk.
+
+    @param directory: The C{str} directory of a C{CohortStore}.
+    @param sampleChunk: The C{int} index of the chunk along samples.
+    @param positionChunk: The C{int} index of the chunk along positions.
+    @param minCoverage: The C{int} minimum coverage of a minor variant.
+    @param minFrequency: The C{float} minimum frequency of a minor variant.
+    @return: A C{float} array of shape (samples in the chunk, 4) with the
+        total coverage, the number of minor variant positions, and the sums
+        of their entropies and minor base frequencies.
+    """
+    counts = CohortStore(directory).chunk(sampleChunk, positionChunk)
+    mask = minorVariantMask(counts, minCoverage, minFrequency)
+    coverage = counts.sum(axis=2)
+    frequencies = counts / np.maximum(coverage, 1)[..., np.newaxis]
+
+    return np.stack([
+        coverage.sum(axis=1),
+        mask.sum(axis=1),
+        (shannonEntropies(counts) * mask).sum(axis=1),
+        (np.sort(frequencies, axis=2)[..., -2] * mask).sum(axis=1),
+    ], axis=1)
+
+
+def _chunkVariantTables(directory, sampleChunk, positionChunk, minCoverage,
+                        minFrequency):
+    """
+    Make the minor variant tables of the samples in a chunk.
+
+    @param directory: The C{str} directory of a C{CohortStore}.
+    @param sampleChunk: The C{int} index of the chunk along samples.
+    @param positionChunk: The C{int} index of the chunk along positions.
+    @param minCoverage: The C{int} minimum coverage of a minor variant.
+    @param minFrequency: The C{float} minimum frequency of a minor variant.
+    @return: A C{list} with a table (see C{makeVariantTable}) for each
+        sample in the chunk, with genome positions.
+    """
+    store = CohortStore(directory)
+    counts = store.chunk(sampleChunk, positionChunk)
+    offset = positionChunk * store.positionChunkSize
+    tables = []
+
+    for sampleCounts in counts:
+        positions = np.flatnonzero(minorVariantMask(sampleCounts, minCoverage,
+                                                    minFrequency))
+        tables.append(makeVariantTable(sampleCounts[positions].astype(int),
+                                       positions + offset))
+
+    return tables
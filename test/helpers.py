@@ -0,0 +1,27 @@
+import numpy as np
+
+from mvlib.common import BASES
+from mvlib.minorVariants import MinorVariantInfo
+
+
+def randomCohort(nSamples=5, length=300, seed=0):
+    """
+    Make a cohort with random base counts. The first base is the most
+    common, and about a fifth of the positions are not covered.
+
+    @param nSamples: The C{int} number of samples.
+    @param length: The C{int} length of the samples.
+    @param seed: The C{int} random seed.
+    @return: A C{list} of C{MinorVariantInfo} instances, named 's0', 's1',
+        etc.
+    """
+    rng = np.random.default_rng(seed)
+    samples = []
+    for index in range(nSamples):
+        counts = rng.integers(0, 30, (length, len(BASES)))
+        counts[:, 0] += rng.integers(0, 200, length)
+        counts[rng.random(length) < 0.2] = 0
+        mvi = MinorVariantInfo(baseCounts={'counts': counts})
+        mvi.name = 's%d' % index
+        samples.append(mvi)
+    return samples
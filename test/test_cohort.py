@@ -0,0 +1,265 @@
+import allel
+import numpy as np
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from mvlib.cohort import MinorAlleleIndex, minorAlleles, pairwiseDistances
+from mvlib.common import DATADIR
+from mvlib.minorVariants import MinorVariantInfo
+
+from .helpers import randomCohort
+
+
+def _sample(name, frequenciesDict):
+    """
+    Make a named MinorVariantInfo instance from a frequencies dict.
+
+    @param name: The C{str} name of the sample.
+    @param frequenciesDict: A C{dict} of base counts, keyed by position.
+    @return: A C{MinorVariantInfo} instance.
+    """
+    mvi = MinorVariantInfo(frequenciesDict=frequenciesDict)
+    mvi.name = name
+    return mvi
+
+
+def _cohort():
+    """
+    Make a small cohort.
+
+    @return: A C{list} of C{MinorVariantInfo} instances.
+    """
+    return [
+        _sample('s1', {0: {'A': 90, 'C': 10}, 1: {'G': 50, 'T': 50},
+                       2: {'T': 100}}),
+        _sample('s2', {0: {'A': 80, 'C': 20}, 1: {'G': 100},
+                       2: {'T': 95, '-': 5}}),
+        _sample('s3', {0: {'A': 99, 'C': 1}, 1: {'G': 60, 'T': 40},
+                       2: {'T': 5, '-': 5}}),
+    ]
+
+
+class TestMinorAlleles(TestCase):
+    """
+    Tests for the minorAlleles function.
+    """
+    def testMinorAlleles(self):
+        """
+        Minor alleles must be the non-major bases above the frequency
+        threshold at positions with enough coverage. N is never an allele.
+        """
+        counts = np.array([
+            [90, 10, 0, 0, 0, 0],
+            [10, 90, 0, 0, 0, 0],
+            [5, 0, 0, 0, 0, 0],
+            [80, 0, 0, 0, 20, 0],
+            [80, 0, 0, 0, 0, 20],
+        ])
+        positions, bases, frequencies = minorAlleles(counts, 10, 0.05)
+        self.assertEqual([0, 1, 4], positions.tolist())
+        self.assertEqual([1, 0, 5], bases.tolist())
+        self.assertEqual([0.1, 0.1, 0.2], frequencies.tolist())
+
+
+class TestMinorAlleleIndex(TestCase):
+    """
+    Tests for the MinorAlleleIndex class.
+    """
+    def testNoSamplesOrIndexFile(self):
+        """
+        A ValueError must be raised if neither samples nor an index file are
+        given.
+        """
+        error = r'^Either samples or indexFile must be given\.$'
+        self.assertRaisesRegex(ValueError, error, MinorAlleleIndex)
+
+    def testEmptyCohort(self):
+        """
+        An empty cohort must have no alleles.
+        """
+        index = MinorAlleleIndex([])
+        self.assertEqual(0, len(index))
+        self.assertEqual([], index.carriers(0, 'C'))
+        self.assertEqual((0, 0), index.sharedAlleleCounts().shape)
+
+    def testCarriers(self):
+        """
+        The carriers of an allele must be the samples with it as a minor
+        allele, with their frequencies.
+        """
+        index = MinorAlleleIndex(_cohort(), minCoverage=10, minFrequency=0.03)
+        self.assertEqual(3, len(index))
+        self.assertEqual(['s1', 's2'],
+                         [name for name, _ in index.carriers(0, 'C')])
+        self.assertAlmostEqual(0.2, index.carriers(0, 'C')[1][1], places=6)
+        self.assertEqual(['s2', 's3'],
+                         [name for name, _ in index.carriers(2, '-')])
+        self.assertEqual([], index.carriers(2, 'A'))
+        self.assertEqual([], index.carriers(50, 'C'))
+
+    def testTiedMajorBase(self):
+        """
+        When bases are tied for the most common, only the first of them in
+        BASES must be taken as the major base.
+        """
+        index = MinorAlleleIndex(_cohort(), minCoverage=10, minFrequency=0.03)
+        self.assertEqual(['s1', 's3'],
+                         [name for name, _ in index.carriers(1, 'T')])
+        self.assertEqual([], index.carriers(1, 'G'))
+
+    def testSampleAlleles(self):
+        """
+        The alleles of a sample must be found.
+        """
+        index = MinorAlleleIndex(_cohort(), minCoverage=10, minFrequency=0.03)
+        self.assertEqual({(0, 'C'), (1, 'T')}, index.sampleAlleles('s1'))
+        self.assertEqual({(0, 'C'), (2, '-')}, index.sampleAlleles('s2'))
+        self.assertEqual({(1, 'T'), (2, '-')}, index.sampleAlleles('s3'))
+
+    def testSharedAlleleCounts(self):
+        """
+        The shared allele counts must be correct.
+        """
+        index = MinorAlleleIndex(_cohort(), minCoverage=10, minFrequency=0.03)
+        self.assertEqual([[2, 1, 1],
+                          [1, 2, 1],
+                          [1, 1, 2]],
+                         index.sharedAlleleCounts().tolist())
+
+    def testSharedAlleleCountsBlocks(self):
+        """
+        The shared allele counts must not depend on the block size.
+        """
+        samples = [MinorVariantInfo(bamFile=join(DATADIR, filename)) for
+                   filename in ('complete-coverage-sorted.bam',
+                                'complete-coverage-deletion-sorted.bam',
+                                'complete-coverage-insertion-sorted.bam')]
+        index = MinorAlleleIndex(samples, minCoverage=10, minFrequency=0.003)
+        expected = index.sharedAlleleCounts()
+        with patch('mvlib.cohort.SHARED_ALLELES_BLOCK_SIZE', 3):
+            self.assertEqual(expected.tolist(),
+                             index.sharedAlleleCounts().tolist())
+        for i, name in enumerate(index.names):
+            for j, other in enumerate(index.names):
+                self.assertEqual(
+                    len(index.sampleAlleles(name) &
+                        index.sampleAlleles(other)),
+                    expected[i, j])
+
+    def testSaveAndLoad(self):
+        """
+        A saved index must load to the same index.
+        """
+        index = MinorAlleleIndex(_cohort(), minCoverage=10, minFrequency=0.03)
+        with TemporaryDirectory() as tempDir:
+            filename = join(tempDir, 'index.npz')
+            index.save(filename)
+            loaded = MinorAlleleIndex(indexFile=filename)
+        self.assertEqual(index.names, loaded.names)
+        self.assertEqual(10, loaded.minCoverage)
+        self.assertEqual(0.03, loaded.minFrequency)
+        self.assertEqual(index.carriers(0, 'C'), loaded.carriers(0, 'C'))
+        self.assertEqual(index.sharedAlleleCounts().tolist(),
+                         loaded.sharedAlleleCounts().tolist())
+
+
+class TestPairwiseDistances(TestCase):
+    """
+    Tests for the pairwiseDistances function.
+    """
+    def _alleleCounts(self, sample, other, minCoverage):
+        """
+        Get the A, C, G, T and deletion counts of two samples at the positions
+        both of them cover.
+        """
+        counts = sample.counts[:, [0, 1, 2, 3, 5]]
+        otherCounts = other.counts[:, [0, 1, 2, 3, 5]]
+        coverage = counts.sum(axis=1)
+        otherCoverage = otherCounts.sum(axis=1)
+        joint = ((coverage >= minCoverage) & (coverage > 0) &
+                 (otherCoverage >= minCoverage) & (otherCoverage > 0))
+        return counts[joint], otherCounts[joint]
+
+    def testUnknownMetric(self):
+        """
+        A ValueError must be raised for an unknown metric.
+        """
+        error = r"^Unknown metric 'l2'\. Use one of 'l1', 'fst'\.$"
+        self.assertRaisesRegex(ValueError, error, pairwiseDistances,
+                               randomCohort(), 'l2')
+
+    def testDifferentLengths(self):
+        """
+        A ValueError must be raised if the samples differ in length.
+        """
+        samples = randomCohort(2, 10) + randomCohort(1, 11)
+        error = r'^All samples must have the same length \(10\), not 11\.$'
+        self.assertRaisesRegex(ValueError, error, pairwiseDistances,
+                               samples, workers=1)
+
+    def testNoSamples(self):
+        """
+        No samples must give an empty matrix.
+        """
+        self.assertEqual((0, 0), pairwiseDistances([], workers=1).shape)
+
+    def testNoJointCoverage(self):
+        """
+        Samples that cover no position in common must have a NaN distance.
+        """
+        samples = [_sample('s1', {0: {'A': 100}, 1: {'A': 0}}),
+                   _sample('s2', {0: {'A': 0}, 1: {'C': 100}})]
+        distances = pairwiseDistances(samples, minCoverage=10, workers=1)
+        self.assertEqual(0.0, distances[0, 0])
+        self.assertTrue(np.isnan(distances[0, 1]))
+        self.assertTrue(np.isnan(distances[1, 0]))
+
+    def testL1(self):
+        """
+        The L1 distances must be the mean L1 distances between frequencies at
+        the positions covered by both samples.
+        """
+        samples = randomCohort()
+        distances = pairwiseDistances(samples, 'l1', minCoverage=20,
+                                      chunkSize=64, workers=1)
+        for i, sample in enumerate(samples):
+            for j, other in enumerate(samples):
+                counts, otherCounts = self._alleleCounts(sample, other, 20)
+                expected = 0.0 if i == j else np.abs(
+                    counts / counts.sum(axis=1)[:, np.newaxis] -
+                    otherCounts / otherCounts.sum(axis=1)[:, np.newaxis]
+                ).sum(axis=1).mean()
+                self.assertAlmostEqual(expected, distances[i, j], places=5)
+
+    def testFst(self):
+        """
+        The Fst values must be those of allel.hudson_fst at the positions
+        covered by both samples.
+        """
+        samples = randomCohort()
+        distances = pairwiseDistances(samples, 'fst', minCoverage=20,
+                                      chunkSize=64, workers=1)
+        for i, sample in enumerate(samples):
+            for j, other in enumerate(samples):
+                if i != j:
+                    counts, otherCounts = self._alleleCounts(
+                        sample, other, 20)
+                    numerator, denominator = allel.hudson_fst(
+                        allel.AlleleCountsArray(counts),
+                        allel.AlleleCountsArray(otherCounts))
+                    self.assertAlmostEqual(
+                        numerator.sum() / denominator.sum(),
+                        distances[i, j])
+
+    def testWorkers(self):
+        """
+        Computing in worker processes must give the same result as computing
+        in this process.
+        """
+        samples = randomCohort()
+        for metric in 'l1', 'fst':
+            self.assertTrue(np.allclose(
+                pairwiseDistances(samples, metric, chunkSize=50, workers=1),
+                pairwiseDistances(samples, metric, chunkSize=50, workers=2)))
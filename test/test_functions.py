@@ -1,7 +1,75 @@
+from os.path import join
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 from collections import Counter
+import json
+import numpy as np
+import threading
+import time
+from unittest.mock import patch
 
-from mvlib.functions import isMinorVariantPosition
+from pysam import (AlignedSegment, AlignmentFile, AlignmentHeader, FDUP,
+                   FQCFAIL, FREVERSE, FSECONDARY, FSUPPLEMENTARY, FUNMAP,
+                   index)
+
+from mvlib.common import BASES, DATADIR, SARS2GENOME
+from mvlib.functions import (DEFAULT_FLAG_FILTER, DEFAULT_QUALITY_BINS,
+                             SparseCounts, alignmentFile, checkQualityBins,
+                             compressionFromFilename, countersToCounts,
+                             countsToCounters, dataFile, getBaseCounts,
+                             getBaseFrequencies, isMinorVariantPosition,
+                             parseRegions, pileupInsertion, pipelined,
+                             readEntries,
+                             readFilterFlags, readGroupSamples,
+                             writeReferenceFasta)
+from mvlib.minorVariants import MinorVariantInfo
+
+
+def writeCram(bamFile, cramFile, referenceFile, referenceLength=None):
+    """
+    Write the reads in a BAM file to an indexed CRAM file.
+
+    @param bamFile: The C{str} name of the BAM file to read.
+    @param cramFile: The C{str} name of the CRAM file to write.
+    @param referenceFile: The C{str} name of the reference FASTA file.
+    @param referenceLength: If not C{None}, an C{int} reference length to
+        put into the CRAM header.
+    """
+    with AlignmentFile(bamFile) as bam:
+        header = bam.header.to_dict()
+        if referenceLength:
+            header['SQ'][0]['LN'] = referenceLength
+        with AlignmentFile(cramFile, 'wc', header=header,
+                           reference_filename=referenceFile) as cram:
+            for read in bam:
+                cram.write(read)
+    index(cramFile)
+
+
+def writeReadGroupBam(bamFile, outFile, samples, readGroups=None):
+    """
+    Write the reads in a BAM file to an indexed BAM file with new sample
+    names in its read groups.
+
+    @param bamFile: The C{str} name of the BAM file to read.
+    @param outFile: The C{str} name of the BAM file to write.
+    @param samples: A C{list} with a C{str} sample name (or C{None} to leave
+        it out) for each read group in the header of C{bamFile}.
+    @param readGroups: If not C{None}, a C{set} of C{str} read group ids.
+        Only reads in these read groups are written.
+    """
+    with AlignmentFile(bamFile) as bam:
+        header = bam.header.to_dict()
+        for readGroup, sample in zip(header['RG'], samples):
+            if sample is None:
+                del readGroup['SM']
+            else:
+                readGroup['SM'] = sample
+        with AlignmentFile(outFile, 'wb', header=header) as out:
+            for read in bam:
+                if readGroups is None or read.get_tag('RG') in readGroups:
+                    out.write(read)
+    index(outFile)
 
 
 class TestIsMinorVariantPosition(TestCase):
@@ -44,3 +112,860 @@ class TestIsMinorVariantPosition(TestCase):
                          'C', 'C', 'C', 'C', 'C', 'C', 'C', 'C', 'C', 'C', 'C',
                          'C', 'C'])
         self.assertTrue(isMinorVariantPosition(bases, 10, 0.2))
+
+
+class TestReadFilterFlags(TestCase):
+    """
+    Tests for the readFilterFlags function.
+    """
+    def testDefault(self):
+        """
+        The default flags must be the ones pysam and samtools filter on.
+        """
+        self.assertEqual(DEFAULT_FLAG_FILTER, readFilterFlags())
+
+    def testKeepEverything(self):
+        """
+        If nothing is to be dropped, only unmapped reads must be filtered.
+        """
+        self.assertEqual(FUNMAP, readFilterFlags(dropSecondary=False,
+                                                 dropDuplicates=False,
+                                                 keepQCFailures=True))
+
+    def testDropAll(self):
+        """
+        If everything is to be dropped, all flags must be set.
+        """
+        self.assertEqual(
+            FUNMAP | FSECONDARY | FSUPPLEMENTARY | FDUP | FQCFAIL,
+            readFilterFlags(dropSupplementary=True))
+
+
+class TestGetBaseFrequencies(TestCase):
+    """
+    Tests for the getBaseFrequencies function.
+    """
+    def testUnknownReference(self):
+        """
+        Asking for a reference that is not in the BAM file must raise a
+        ValueError.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        error = "^Reference 'xxx' not present in SAM file "
+        self.assertRaisesRegex(ValueError, error, getBaseFrequencies,
+                               bamFile, referenceId='xxx')
+
+    def testFlagFilter(self):
+        """
+        Reads with a flag in the flag filter must not be counted.
+        """
+        bamFile = join(DATADIR, 'partial-coverage-sorted.bam')
+        # All reads in this file are on the reverse strand.
+        counts = getBaseFrequencies(
+            bamFile, flagFilter=DEFAULT_FLAG_FILTER | FREVERSE)
+        self.assertEqual(130, len(counts))
+        self.assertEqual(0, sum(sum(c.values()) for c in counts.values()))
+
+    def testMinReadLength(self):
+        """
+        Reads shorter than the minimum read length must not be counted.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        allCounts = getBaseFrequencies(bamFile)
+        longCounts = getBaseFrequencies(bamFile, minReadLength=76)
+        self.assertEqual(2, sum(allCounts[0].values()))
+        self.assertTrue(
+            all(sum(longCounts[position].values()) <=
+                sum(allCounts[position].values())
+                for position in allCounts))
+        self.assertLess(sum(sum(c.values()) for c in longCounts.values()),
+                        sum(sum(c.values()) for c in allCounts.values()))
+
+    def testThreads(self):
+        """
+        Using several decompression threads must give the same counts.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        self.assertEqual(getBaseFrequencies(bamFile),
+                         getBaseFrequencies(bamFile, threads=3))
+
+    def testCram(self):
+        """
+        Reading a CRAM file with a reference FASTA file must give the same
+        counts as reading the BAM file it was made from.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        with TemporaryDirectory() as tempdir:
+            fastaFile = join(tempdir, 'reference.fasta')
+            cramFile = join(tempdir, 'reads.cram')
+            with AlignmentFile(bamFile) as bam:
+                referenceId = bam.references[0]
+            with open(fastaFile, 'w') as fp:
+                print('>%s\n%s' % (referenceId, SARS2GENOME.sequence[:100]),
+                      file=fp)
+            writeCram(bamFile, cramFile, fastaFile)
+            self.assertEqual(getBaseFrequencies(bamFile),
+                             getBaseFrequencies(cramFile, threads=2,
+                                                reference=fastaFile))
+
+    def testCramEmbeddedGenome(self):
+        """
+        Reading a CRAM file using the embedded SARS2 genome must give the same
+        counts as reading the BAM file it was made from.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        with TemporaryDirectory() as tempdir:
+            fastaFile = join(tempdir, 'reference.fasta')
+            cramFile = join(tempdir, 'reads.cram')
+            with AlignmentFile(bamFile) as bam:
+                referenceId = bam.references[0]
+            writeReferenceFasta('SARS2', {referenceId: len(SARS2GENOME)},
+                                fastaFile)
+            writeCram(bamFile, cramFile, fastaFile,
+                      referenceLength=len(SARS2GENOME))
+            counts = getBaseFrequencies(cramFile, reference='SARS2')
+        self.assertEqual(len(SARS2GENOME), len(counts))
+        expected = getBaseFrequencies(bamFile)
+        self.assertEqual(expected, {position: counts[position]
+                                    for position in expected})
+
+
+class TestWriteReferenceFasta(TestCase):
+    """
+    Tests for the writeReferenceFasta function.
+    """
+    def testNoMatchingLength(self):
+        """
+        If no reference has the length of the genome, a ValueError must be
+        raised.
+        """
+        error = (r'^No reference \(ref\) has the length \(10862\) of '
+                 r'the YFV genome\.$')
+        self.assertRaisesRegex(ValueError, error, writeReferenceFasta, 'YFV',
+                               {'ref': 100}, 'unused.fasta')
+
+    def testMatchingLengths(self):
+        """
+        The genome must be written once for each reference id with the
+        genome's length.
+        """
+        with TemporaryDirectory() as tempdir:
+            fastaFile = join(tempdir, 'reference.fasta')
+            writeReferenceFasta('WNV', {'a': 100, 'b': 11013, 'c': 11013},
+                                fastaFile)
+            with open(fastaFile) as fp:
+                lines = fp.read().split()
+        self.assertEqual(['>b', '>c'], lines[::2])
+        self.assertEqual(lines[1], lines[3])
+
+
+class TestAlignmentFile(TestCase):
+    """
+    Tests for the alignmentFile function.
+    """
+    def testBuiltInReferenceFromStandardInput(self):
+        """
+        A built-in genome must not be usable as the reference of standard
+        input, which cannot be read twice.
+        """
+        error = (r'^The built-in SARS2 genome cannot be used as the reference '
+                 r'when reading standard input\. Give a FASTA file '
+                 r'instead\.$')
+        with self.assertRaisesRegex(ValueError, error):
+            with alignmentFile('-', reference='SARS2'):
+                pass
+
+
+class TestGetBaseCounts(TestCase):
+    """
+    Tests for the getBaseCounts function.
+    """
+    def testCounts(self):
+        """
+        The counts must match the ones returned by getBaseFrequencies.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-deletion-sorted.bam')
+        result = getBaseCounts(bamFile)
+        self.assertEqual((100, len(BASES)), result['counts'].shape)
+        self.assertNotIn('qualityBinCounts', result)
+        self.assertEqual(getBaseFrequencies(bamFile),
+                         countsToCounters(result['counts']))
+
+    def testQualityBinCounts(self):
+        """
+        The quality bin counts must add up to the counts, and the counts in
+        the bins at and above a bin edge must be the counts for that minimum
+        base quality.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-deletion-sorted.bam')
+        result = getBaseCounts(bamFile, qualityBins=DEFAULT_QUALITY_BINS)
+        qualityBinCounts = result['qualityBinCounts']
+        self.assertEqual((4, 100, len(BASES)), qualityBinCounts.shape)
+        self.assertTrue(
+            (result['counts'] == qualityBinCounts.sum(axis=0)).all())
+        highQuality = getBaseCounts(bamFile, minBaseQuality=20)['counts']
+        self.assertTrue(
+            (highQuality == qualityBinCounts[2:].sum(axis=0)).all())
+
+    def testInsertionCounts(self):
+        """
+        Reads with an insertion must be counted at the position before the
+        insertion.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-insertion-sorted.bam')
+        result = getBaseCounts(bamFile)
+        self.assertNotIn('insertionSequences', result)
+        self.assertEqual([91], result['insertionCounts'].nonzero()[0].tolist())
+        self.assertEqual(10, result['insertionCounts'][91])
+
+    def testInsertionSequences(self):
+        """
+        The inserted sequences must be counted in upper case.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-insertion-sorted.bam')
+        result = getBaseCounts(bamFile, insertionSequences=True)
+        self.assertEqual({91: Counter({'T': 10})},
+                         result['insertionSequences'])
+
+    def testNoInsertions(self):
+        """
+        If there are no insertions, the insertion counts must all be zero.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-deletion-sorted.bam')
+        result = getBaseCounts(bamFile, insertionSequences=True)
+        self.assertEqual(0, result['insertionCounts'].sum())
+        self.assertEqual({}, result['insertionSequences'])
+
+
+class TestParseRegions(TestCase):
+    """
+    Tests for the parseRegions function.
+    """
+    def testCoordinates(self):
+        """
+        1-based inclusive coordinates must be converted to 0-based offsets.
+        """
+        self.assertEqual([(23566, 23626)], parseRegions(['23567-23626']))
+
+    def testOffsets(self):
+        """
+        Offsets must be returned unchanged.
+        """
+        self.assertEqual([(10, 20)], parseRegions([(10, 20)]))
+
+    def testGene(self):
+        """
+        A gene name must be found in the offsets of the virus.
+        """
+        self.assertEqual([(21562, 25384)], parseRegions(['S'], 'SARS2'))
+
+    def testGeneWithoutVirus(self):
+        """
+        A ValueError must be raised for a gene name if no virus is given.
+        """
+        error = r"^The virus must be given to find the offsets of gene 'S'\.$"
+        self.assertRaisesRegex(ValueError, error, parseRegions, ['S'])
+
+    def testUnknownGene(self):
+        """
+        A ValueError must be raised for an unknown gene name.
+        """
+        error = r"^Unknown WNV gene 'S'\. Known genes are Polyprotein\.$"
+        self.assertRaisesRegex(ValueError, error, parseRegions, ['S'], 'WNV')
+
+    def testEmpty(self):
+        """
+        A ValueError must be raised for an empty region.
+        """
+        error = r"^Region '20-10' is empty or starts before the genome\.$"
+        self.assertRaisesRegex(ValueError, error, parseRegions, ['20-10'])
+
+    def testMerge(self):
+        """
+        Overlapping and adjacent regions must be merged, and the regions must
+        be sorted.
+        """
+        self.assertEqual([(0, 10), (30, 50)],
+                         parseRegions([(40, 50), (0, 5), (30, 45), (5, 10)]))
+
+
+class TestGetBaseCountsRegions(TestCase):
+    """
+    Tests for counting bases in regions with getBaseCounts and
+    getBaseFrequencies.
+    """
+    def testRegions(self):
+        """
+        The counts in the regions must be the same as when counting the whole
+        reference, and zero elsewhere.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-deletion-sorted.bam')
+        everything = getBaseCounts(bamFile, strand=True)
+        result = getBaseCounts(bamFile, strand=True,
+                               regions=['11-20', (50, 55)])
+        self.assertEqual([(10, 20), (50, 55)], result['regions'])
+        self.assertIsNone(everything['regions'])
+        inRegions = np.zeros(100, dtype=bool)
+        inRegions[10:20] = inRegions[50:55] = True
+        self.assertEqual(everything['counts'][inRegions].tolist(),
+                         result['counts'][inRegions].tolist())
+        self.assertEqual(everything['strandCounts'][:, inRegions].tolist(),
+                         result['strandCounts'][:, inRegions].tolist())
+        self.assertEqual(0, result['counts'][~inRegions].sum())
+
+    def testRegionBeyondReference(self):
+        """
+        A ValueError must be raised for a region beyond the end of the
+        reference.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        error = (r"^Region 90-110 extends beyond the end of reference "
+                 r"'BetaCoV/Wuhan-Hu-1/2019\|EPI_ISL_402125' \(length "
+                 r"100\)\.$")
+        self.assertRaisesRegex(ValueError, error, getBaseCounts, bamFile,
+                               regions=['90-110'])
+
+    def testFrequencies(self):
+        """
+        getBaseFrequencies must return all positions of the reference, with
+        counts only in the regions.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        everything = getBaseFrequencies(bamFile)
+        result = getBaseFrequencies(bamFile, regions=[(3, 5), (97, 100)])
+        self.assertEqual(list(range(100)), list(result))
+        for position in result:
+            if position in (3, 4, 97, 98, 99):
+                self.assertEqual(everything[position], result[position])
+            else:
+                self.assertEqual(0, sum(result[position].values()))
+
+    def testFrequenciesDict(self):
+        """
+        The frequencies of regions must be usable as the frequenciesDict of
+        a MinorVariantInfo.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        frequencies = getBaseFrequencies(bamFile, regions=[(20, 40)])
+        mvi = MinorVariantInfo(frequenciesDict=frequencies)
+        regional = MinorVariantInfo(bamFile=bamFile, regions=[(20, 40)])
+        self.assertEqual(100, mvi.length)
+        self.assertEqual(regional.counts.tolist(), mvi.counts.tolist())
+
+
+class TestReadEntries(TestCase):
+    """
+    Tests for the readEntries function.
+    """
+    def testEntries(self):
+        """
+        The bases, deletions and insertions of a read must be found at the
+        reference positions they are aligned to, skipping soft clipped bases.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        with AlignmentFile(bamFile) as sam:
+            read = AlignedSegment(sam.header)
+        read.reference_id = 0
+        read.reference_start = 10
+        read.query_sequence = 'TTACGaaCCGG'
+        read.query_qualities = [30, 30, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+        read.cigarstring = '2S3M2I2M2D2M'
+        positions, baseIndices, qualities, insertions = readEntries(read)
+        self.assertEqual([10, 11, 12, 13, 14, 15, 16, 17, 18],
+                         positions.tolist())
+        self.assertEqual('ACGCC--GG',
+                         ''.join(BASES[index] for index in baseIndices))
+        self.assertEqual([1, 2, 3, 6, 7, 8, 8, 8, 9], qualities.tolist())
+        self.assertEqual([(12, 3, 'AA')], insertions)
+
+    def testNoQualities(self):
+        """
+        A read without base qualities must have qualities of 255, as in a
+        pileup.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        with AlignmentFile(bamFile) as sam:
+            read = AlignedSegment(sam.header)
+        read.reference_id = 0
+        read.reference_start = 0
+        read.query_sequence = 'ACN'
+        read.cigarstring = '3M'
+        positions, baseIndices, qualities, insertions = readEntries(read)
+        self.assertEqual([255, 255, 255], qualities.tolist())
+        self.assertEqual([0, 1, 4], baseIndices.tolist())
+
+
+class TestPipelined(TestCase):
+    """
+    Tests for the pipelined function.
+    """
+    def testItems(self):
+        """
+        All items must be produced, in order.
+        """
+        self.assertEqual(list(range(1000)),
+                         list(pipelined(range(1000), batchSize=7)))
+
+    def testEmpty(self):
+        """
+        An empty iterable must give no items.
+        """
+        self.assertEqual([], list(pipelined([])))
+
+    def testError(self):
+        """
+        An exception raised while producing items must be raised to the
+        consumer, after the items produced before it.
+        """
+        def items():
+            yield 1
+            yield 2
+            raise ValueError('Oops.')
+
+        consumed = []
+        with self.assertRaisesRegex(ValueError, r'^Oops\.$'):
+            for item in pipelined(items(), batchSize=1):
+                consumed.append(item)
+        self.assertEqual([1, 2], consumed)
+
+    def testBackPressure(self):
+        """
+        The producer must not get more than the queue size ahead of the
+        consumer, and must stop when the consumer does.
+        """
+        produced = []
+
+        def items():
+            for item in range(1000):
+                produced.append(item)
+                yield item
+
+        generator = pipelined(items(), batchSize=10, queueSize=2)
+        self.assertEqual(0, next(generator))
+        time.sleep(0.2)
+        # One batch being consumed, two waiting and one being produced.
+        self.assertLessEqual(len(produced), 41)
+        generator.close()
+        self.assertLess(len(produced), 1000)
+
+
+class TestGetBaseCountsStream(TestCase):
+    """
+    Tests for getBaseCounts reading alignments as a stream.
+    """
+    def assertSameCounts(self, expected, result):
+        """
+        Check that two getBaseCounts results have the same counts.
+
+        @param expected: The C{dict} returned by C{getBaseCounts} for a
+            pileup.
+        @param result: The C{dict} returned by C{getBaseCounts} for a stream.
+        """
+        self.assertEqual(sorted(expected), sorted(result))
+        for key, value in expected.items():
+            if isinstance(value, np.ndarray):
+                self.assertEqual(value.tolist(), result[key].tolist())
+            else:
+                self.assertEqual(value, result[key])
+
+    def testSameAsPileup(self):
+        """
+        The counts of a stream must be the same as those of a pileup.
+        """
+        for filename in ('complete-coverage-sorted.bam',
+                         'complete-coverage-deletion-sorted.bam',
+                         'complete-coverage-insertion-sorted.bam',
+                         'partial-coverage-sorted.bam'):
+            bamFile = join(DATADIR, filename)
+            self.assertSameCounts(
+                getBaseCounts(bamFile, strand=True, insertionSequences=True),
+                getBaseCounts(bamFile, strand=True, insertionSequences=True,
+                              stream=True))
+
+    def testPipeline(self):
+        """
+        Reading in another thread must give the same counts, whether from a
+        pileup or a stream.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-insertion-sorted.bam')
+        for stream in False, True:
+            self.assertSameCounts(
+                getBaseCounts(bamFile, strand=True,
+                              qualityBins=DEFAULT_QUALITY_BINS,
+                              insertionSequences=True, stream=stream),
+                getBaseCounts(bamFile, strand=True,
+                              qualityBins=DEFAULT_QUALITY_BINS,
+                              insertionSequences=True, stream=stream,
+                              pipeline=True))
+
+    def testPipelineCountingError(self):
+        """
+        If counting fails, the reading thread must have stopped by the time
+        the error is raised (and the file is closed).
+        """
+        def slowPipelined(iterable):
+            # Keep the reading thread waiting on a full queue.
+            return pipelined(iterable, batchSize=1, queueSize=1)
+
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        threadCount = threading.active_count()
+        with patch('mvlib.functions.pipelined', slowPipelined):
+            with patch('mvlib.functions.pileupBaseIndex',
+                       side_effect=ValueError('Oops.')):
+                try:
+                    getBaseCounts(bamFile, pipeline=True)
+                except ValueError:
+                    self.assertEqual(threadCount, threading.active_count())
+                else:
+                    self.fail('ValueError not raised.')
+
+    def testMinMappingQuality(self):
+        """
+        Reads below the minimum mapping quality must not be counted.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        self.assertSameCounts(
+            getBaseCounts(bamFile, minMappingQuality=60),
+            getBaseCounts(bamFile, minMappingQuality=60, stream=True))
+
+    def testMinBaseQuality(self):
+        """
+        The bases of both overlapping mates must be counted, with their own
+        qualities, in a pileup as in a stream.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        expected = getBaseCounts(bamFile, minBaseQuality=30,
+                                 qualityBins=DEFAULT_QUALITY_BINS)
+        self.assertEqual(20228, expected['counts'].sum())
+        self.assertSameCounts(
+            expected,
+            getBaseCounts(bamFile, minBaseQuality=30,
+                          qualityBins=DEFAULT_QUALITY_BINS, stream=True))
+
+    def testRegions(self):
+        """
+        A stream must only be counted in the regions.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-deletion-sorted.bam')
+        self.assertSameCounts(
+            getBaseCounts(bamFile, regions=['11-20', (50, 55)]),
+            getBaseCounts(bamFile, regions=['11-20', (50, 55)], stream=True))
+
+    def testUnsortedSam(self):
+        """
+        Reads in an unsorted and unindexed SAM file must be counted.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-insertion-sorted.bam')
+        with AlignmentFile(bamFile) as sam:
+            header = sam.header
+            reads = list(sam)
+
+        with TemporaryDirectory() as tempDir:
+            samFile = join(tempDir, 'unsorted.sam')
+            with AlignmentFile(samFile, 'w', header=header) as sam:
+                for read in reversed(reads):
+                    sam.write(read)
+            result = getBaseCounts(samFile, insertionSequences=True,
+                                   stream=True)
+
+        self.assertSameCounts(
+            getBaseCounts(bamFile, insertionSequences=True), result)
+
+
+class TestReadGroupSamples(TestCase):
+    """
+    Tests for the readGroupSamples function.
+    """
+    def testSamples(self):
+        """
+        Read groups with the same sample name must share a sample, and a read
+        group without a sample name must be its own sample.
+        """
+        header = AlignmentHeader.from_dict({
+            'SQ': [{'SN': 'ref', 'LN': 10}],
+            'RG': [{'ID': 'rg1', 'SM': 's1'}, {'ID': 'rg2'},
+                   {'ID': 'rg3', 'SM': 's1'}]})
+        self.assertEqual((['s1', 'rg2'], {'rg1': 0, 'rg2': 1, 'rg3': 0}),
+                         readGroupSamples(header))
+
+    def testNoReadGroups(self):
+        """
+        A header without read groups must give no samples.
+        """
+        header = AlignmentHeader.from_dict({'SQ': [{'SN': 'ref', 'LN': 10}]})
+        self.assertEqual(([], {}), readGroupSamples(header))
+
+
+class TestGetBaseCountsReadGroups(TestCase):
+    """
+    Tests for counting the bases of each read group sample with
+    getBaseCounts.
+    """
+    def testSamples(self):
+        """
+        The counts of each sample must be those of its reads alone, and add
+        up to the overall counts, whether from a pileup or a stream.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-insertion-sorted.bam')
+        with AlignmentFile(bamFile) as sam:
+            readGroupIds = [readGroup['ID']
+                            for readGroup in sam.header.to_dict()['RG']]
+
+        with TemporaryDirectory() as tempDir:
+            samplesFile = join(tempDir, 'samples.bam')
+            writeReadGroupBam(bamFile, samplesFile, ['s1', 's2'])
+            expected = {}
+            for sample, readGroupId in zip(('s1', 's2'), readGroupIds):
+                sampleFile = join(tempDir, sample + '.bam')
+                writeReadGroupBam(bamFile, sampleFile, ['s1', 's2'],
+                                  {readGroupId})
+                expected[sample] = getBaseCounts(
+                    sampleFile, strand=True, insertionSequences=True)
+
+            for stream in False, True:
+                result = getBaseCounts(samplesFile, strand=True,
+                                       insertionSequences=True,
+                                       readGroups=True, stream=stream)
+                self.assertEqual(['s1', 's2'], list(result['samples']))
+                for sample, sampleResult in result['samples'].items():
+                    for key in ('counts', 'strandCounts', 'insertionCounts'):
+                        self.assertEqual(expected[sample][key].tolist(),
+                                         sampleResult[key].tolist())
+                    self.assertEqual(expected[sample]['insertionSequences'],
+                                     sampleResult['insertionSequences'])
+                self.assertEqual(
+                    result['counts'].tolist(),
+                    (result['samples']['s1']['counts'] +
+                     result['samples']['s2']['counts']).tolist())
+
+    def testSharedSample(self):
+        """
+        Read groups with the same sample name must be counted together.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        result = getBaseCounts(bamFile, qualityBins=DEFAULT_QUALITY_BINS,
+                               readGroups=True)
+        (sample, sampleResult), = result['samples'].items()
+        self.assertTrue(sample.startswith('D_200313_1_649_1_unknown_RNA'))
+        self.assertEqual(result['counts'].tolist(),
+                         sampleResult['counts'].tolist())
+        self.assertEqual(result['qualityBinCounts'].tolist(),
+                         sampleResult['qualityBinCounts'].tolist())
+
+    def testNoReadGroups(self):
+        """
+        A ValueError must be raised if the file header has no read groups.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        with AlignmentFile(bamFile) as bam:
+            header = bam.header.to_dict()
+            del header['RG']
+            reads = [read.to_dict() for read in bam]
+
+        with TemporaryDirectory() as tempDir:
+            samFile = join(tempDir, 'no-read-groups.sam')
+            with AlignmentFile(samFile, 'w', header=header) as sam:
+                for read in reads:
+                    sam.write(AlignedSegment.from_dict(read, sam.header))
+            error = r"^SAM file '.*' has no read groups\.$"
+            self.assertRaisesRegex(ValueError, error, getBaseCounts, samFile,
+                                   readGroups=True, stream=True)
+
+
+class TestPileupInsertion(TestCase):
+    """
+    Tests for the pileupInsertion function.
+    """
+    def testNoInsertion(self):
+        """
+        An entry without an insertion must give None.
+        """
+        self.assertIsNone(pileupInsertion('A'))
+        self.assertIsNone(pileupInsertion('C-2NN'))
+
+    def testInsertion(self):
+        """
+        An insertion must be returned in upper case.
+        """
+        self.assertEqual('ACG', pileupInsertion('t+3acg'))
+
+    def testLongInsertion(self):
+        """
+        An insertion with a length of more than one digit must be returned.
+        """
+        self.assertEqual('ACGTACGTACGT',
+                         pileupInsertion('T+12ACGTACGTACGT'))
+
+
+class TestCheckQualityBins(TestCase):
+    """
+    Tests for the checkQualityBins function.
+    """
+    def testNotStartingAtZero(self):
+        """
+        Quality bins that do not start at zero must raise a ValueError.
+        """
+        self.assertRaisesRegex(ValueError, r'^Quality bins \(10, 20\) must ',
+                               checkQualityBins, (10, 20))
+
+    def testNotIncreasing(self):
+        """
+        Quality bins that are not strictly increasing must raise a
+        ValueError.
+        """
+        self.assertRaisesRegex(ValueError, r'^Quality bins \[0, 20, 20\] ',
+                               checkQualityBins, [0, 20, 20])
+
+
+class TestCountsConversion(TestCase):
+    """
+    Tests for the countsToCounters and countersToCounts functions.
+    """
+    def testRoundTrip(self):
+        """
+        Converting counters to counts and back must give the original
+        counters.
+        """
+        countsPerBase = {
+            0: Counter({'A': 3, '-': 1}),
+            1: Counter({'A': 0, 'T': 0, 'G': 0, 'C': 0}),
+            2: Counter({'G': 5}),
+        }
+        self.assertEqual(countsPerBase,
+                         countsToCounters(countersToCounts(countsPerBase)))
+
+    def testUnknownBase(self):
+        """
+        Bases that are not in BASES must be counted as N.
+        """
+        counts = countersToCounts({0: {'R': 2, 'N': 1, 'A': 1}})
+        self.assertEqual([1, 0, 0, 0, 3, 0], counts[0].tolist())
+
+
+class TestSparseCounts(TestCase):
+    """
+    Tests for the SparseCounts class.
+    """
+    def testRoundTrip(self):
+        """
+        Converting counts to sparse counts and back must give the original
+        counts.
+        """
+        counts = np.array([
+            [3, 0, 0, 0, 0, 1],
+            [0, 0, 0, 0, 0, 0],
+            [0, 0, 5, 0, 0, 0],
+            [2, 2, 0, 1, 1, 0],
+        ])
+        sparse = SparseCounts(counts)
+        self.assertEqual(4, len(sparse))
+        self.assertEqual([0, 0, 2, 0], sparse.majorBases.tolist())
+        self.assertEqual([4, 0, 5, 6], sparse.depths.tolist())
+        self.assertEqual([0, 3, 3, 3], sparse.positions.tolist())
+        self.assertEqual(counts.tolist(), sparse.toCounts().tolist())
+
+    def testJsonRoundTrip(self):
+        """
+        Converting sparse counts to json and back must give the original
+        counts.
+        """
+        counts = np.array([
+            [3, 0, 0, 0, 0, 1],
+            [0, 0, 0, 0, 0, 0],
+            [0, 7, 0, 2, 0, 0],
+        ])
+        data = json.loads(json.dumps(SparseCounts(counts).toJson()))
+        self.assertEqual('AAC', data['majorBases'])
+        self.assertEqual('-T', data['bases'])
+        self.assertEqual(counts.tolist(),
+                         SparseCounts.fromJson(data).toCounts().tolist())
+
+    def testSmaller(self):
+        """
+        Sparse counts must take less memory than the dense counts when most
+        positions have a single base.
+        """
+        counts = np.zeros((1000, len(BASES)), dtype=int)
+        counts[:, 1] = 100
+        counts[::50, 5] = 3
+        sparse = SparseCounts(counts)
+        self.assertEqual(20, len(sparse.positions))
+        self.assertLess(sparse.nbytes * 5, counts.nbytes)
+
+
+class TestDataFile(TestCase):
+    """
+    Tests for the compressionFromFilename function and the dataFile context
+    manager.
+    """
+    def testCompressionFromFilename(self):
+        """
+        The compression must be found from the file name suffix.
+        """
+        self.assertEqual('gzip', compressionFromFilename('x.json.gz'))
+        self.assertEqual('zstd', compressionFromFilename('x.json.zst'))
+        self.assertIsNone(compressionFromFilename('x.json'))
+
+    def testUnknownMode(self):
+        """
+        A ValueError must be raised for an unknown mode.
+        """
+        error = r"^Unknown mode 'a'\. Use either 'r' or 'w'\.$"
+        with self.assertRaisesRegex(ValueError, error):
+            with dataFile('x.json', 'a'):
+                pass
+
+    def testUnknownCompression(self):
+        """
+        A ValueError must be raised for an unknown compression.
+        """
+        error = r"^Unknown compression 'bz2'\. "
+        with TemporaryDirectory() as tempdir:
+            with self.assertRaisesRegex(ValueError, error):
+                with dataFile(join(tempdir, 'x.json'), 'w', 'bz2'):
+                    pass
+
+    def testRoundTrip(self):
+        """
+        Text written to plain, gzip and zstd compressed files must be read
+        back, with the compression recognized from the file contents.
+        """
+        with TemporaryDirectory() as tempdir:
+            for filename, magic in (('x.json', b'{"a'),
+                                    ('x.json.gz', b'\x1f\x8b'),
+                                    ('x.json.zst', b'\x28\xb5\x2f\xfd')):
+                filename = join(tempdir, filename)
+                with dataFile(filename, 'w') as fp:
+                    fp.write('{"a": 1}')
+                with open(filename, 'rb') as fp:
+                    self.assertTrue(fp.read().startswith(magic))
+                with dataFile(filename) as fp:
+                    self.assertEqual('{"a": 1}', fp.read())
+
+    def testExplicitCompression(self):
+        """
+        An explicit compression must be used whatever the file name.
+        """
+        with TemporaryDirectory() as tempdir:
+            filename = join(tempdir, 'x.json')
+            with dataFile(filename, 'w', 'gzip') as fp:
+                fp.write('hello')
+            with open(filename, 'rb') as fp:
+                self.assertEqual(b'\x1f\x8b', fp.read(2))
+            with dataFile(filename) as fp:
+                self.assertEqual('hello', fp.read())
+
+    def testFileObject(self):
+        """
+        A binary file object must be written to and not be closed.
+        """
+        with TemporaryDirectory() as tempdir:
+            filename = join(tempdir, 'x.json')
+            with open(filename, 'wb') as raw:
+                with dataFile(raw, 'w', 'gzip') as fp:
+                    fp.write('hello')
+                self.assertFalse(raw.closed)
+            with open(filename, 'rb') as raw:
+                with dataFile(raw) as fp:
+                    self.assertEqual('hello', fp.read())
+                self.assertFalse(raw.closed)
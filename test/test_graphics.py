@@ -0,0 +1,211 @@
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import numpy as np
+
+from mvlib.common import DATADIR
+from mvlib.graphics import (decimate, plotCohortCoverage, plotCoverage,
+                            plotFrequencies, plotFrequenciesBatch,
+                            plotMinorVariantHeatmap, plt)
+from mvlib.minorVariants import MinorVariantInfo
+
+
+class TestPlotFrequencies(TestCase):
+    """
+    Tests for the plotFrequencies function.
+    """
+    def testOneBarCallPerBase(self):
+        """
+        There must be one set of bars per base, each with a bar per position,
+        and the stacked bars must add up to one at covered positions.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        fig, ax = plt.subplots()
+        plotFrequencies(mvi, list(range(1, 61)), ax=ax)
+        self.assertEqual(4, len(ax.containers))
+        self.assertTrue(all(len(bars) == 60 for bars in ax.containers))
+        top = ax.containers[-1][0]
+        self.assertAlmostEqual(1.0, top.get_y() + top.get_height())
+        plt.close(fig)
+
+    def testUncoveredPositions(self):
+        """
+        Positions without coverage must have empty bars.
+        """
+        bamFile = join(DATADIR, 'partial-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        fig, ax = plt.subplots()
+        plotFrequencies(mvi, [50, 51], ax=ax, plotFurinAAs=False)
+        self.assertEqual(
+            [0.0, 0.0],
+            [bar.get_height() for bars in ax.containers for bar in bars][:2])
+        plt.close(fig)
+
+
+class TestPlotFrequenciesBatch(TestCase):
+    """
+    Tests for the plotFrequenciesBatch function.
+    """
+    def testFilesWritten(self):
+        """
+        A plot must be written for each sample, named after the sample.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        with TemporaryDirectory() as tempdir:
+            jsonFiles = []
+            for name in 'sample1', 'sample2':
+                jsonFiles.append(join(tempdir, name + '.json'))
+                mvi.save(jsonFiles[-1])
+            outFiles = plotFrequenciesBatch(jsonFiles, list(range(1, 61)),
+                                            tempdir, workers=2)
+            self.assertEqual([join(tempdir, 'sample1.png'),
+                              join(tempdir, 'sample2.png')], outFiles)
+            self.assertTrue(all(exists(outFile) for outFile in outFiles))
+
+
+class TestDecimate(TestCase):
+    """
+    Tests for the decimate function.
+    """
+    def testBins(self):
+        """
+        The minimum, mean and maximum of each bin must be correct.
+        """
+        starts, mins, means, maxs = decimate([1, 2, 3, 4, 5], 2)
+        self.assertEqual([0, 2], starts.tolist())
+        self.assertEqual([[1.0, 3.0]], mins.tolist())
+        self.assertEqual([[1.5, 4.0]], means.tolist())
+        self.assertEqual([[2.0, 5.0]], maxs.tolist())
+
+    def testMoreBinsThanPositions(self):
+        """
+        If there are more bins than positions, each position must be its own
+        bin.
+        """
+        starts, mins, means, maxs = decimate([3, 1], 10)
+        self.assertEqual([0, 1], starts.tolist())
+        self.assertEqual([[3.0, 1.0]], means.tolist())
+
+    def testSeveralTracks(self):
+        """
+        Each row of a 2-d array must be decimated separately.
+        """
+        values = np.arange(12).reshape((2, 6))
+        starts, mins, means, maxs = decimate(values, 3)
+        self.assertEqual([[0, 2, 4], [6, 8, 10]], mins.tolist())
+        self.assertEqual([[1, 3, 5], [7, 9, 11]], maxs.tolist())
+
+
+class TestPlotCoverage(TestCase):
+    """
+    Tests for the plotCoverage and plotCohortCoverage functions.
+    """
+    def testPlotCoverage(self):
+        """
+        The mean coverage must be drawn with a point per bin (and one to end
+        the last step).
+        """
+        bamFile = join(DATADIR, 'partial-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        fig, ax = plt.subplots()
+        plotCoverage(mvi, ax=ax, nBins=10)
+        self.assertEqual(11, len(ax.lines[0].get_xdata()))
+        self.assertAlmostEqual(np.mean(mvi.coveragePerBase[:13]),
+                               ax.lines[0].get_ydata()[0])
+        plt.close(fig)
+
+    def testCohortOverlay(self):
+        """
+        An overlay must draw all samples as one collection of lines.
+        """
+        coverage = np.random.default_rng(1).poisson(100, size=(20, 5000))
+        fig = plotCohortCoverage(coverage, nBins=50)
+        ax = fig.axes[0]
+        self.assertEqual(20, len(ax.collections[-1].get_segments()))
+        self.assertEqual(50, len(ax.collections[-1].get_segments()[0]))
+        plt.close(fig)
+
+    def testCohortSmallMultiples(self):
+        """
+        Small multiples must have one visible subplot per sample, titled
+        with the sample names.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        fig = plotCohortCoverage([mvi] * 3, smallMultiples=True, ncols=2)
+        visible = [ax for ax in fig.axes if ax.get_visible()]
+        self.assertEqual(3, len(visible))
+        self.assertEqual('complete-coverage-sorted', visible[0].get_title())
+        plt.close(fig)
+
+
+class TestPlotMinorVariantHeatmap(TestCase):
+    """
+    Tests for the plotMinorVariantHeatmap function.
+    """
+    def testImageShape(self):
+        """
+        The image must have a row per sample and a column per bin, keeping
+        the highest value in each bin.
+        """
+        values = np.zeros((3, 1000))
+        values[1, 10] = 0.4
+        fig, ax = plt.subplots()
+        image = plotMinorVariantHeatmap(values, nBins=100, ax=ax)
+        data = image.get_array()
+        self.assertEqual((3, 100), data.shape)
+        self.assertAlmostEqual(0.4, data[1, 1])
+        self.assertEqual(1, (data > 0).sum())
+        plt.close(fig)
+
+    def testMask(self):
+        """
+        Plotting the minor variant mask must show the minor variant
+        positions.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        fig, ax = plt.subplots()
+        image = plotMinorVariantHeatmap([mvi, mvi], mask=True, minCoverage=10,
+                                        minFrequency=0.003, nBins=100,
+                                        ax=ax, virus=None)
+        data = image.get_array()
+        self.assertEqual(2 * mvi.richness(10, 0.003), data.sum())
+        self.assertEqual(['complete-coverage-sorted'] * 2,
+                         [label.get_text() for label in
+                          ax.get_yticklabels()])
+        plt.close(fig)
+
+    def testLowCoverageMasked(self):
+        """
+        Positions with coverage below the minimum must not be shown.
+        """
+        bamFile = join(DATADIR, 'partial-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        fig, ax = plt.subplots()
+        image = plotMinorVariantHeatmap([mvi], minCoverage=1, nBins=130,
+                                        ax=ax)
+        self.assertEqual(67, image.get_array().mask.sum())
+        plt.close(fig)
+
+    def testDifferentLengths(self):
+        """
+        Samples of different lengths must raise a ValueError.
+        """
+        fig, ax = plt.subplots()
+        error = r'^All samples must have the same length \(10\), not 5\.$'
+        self.assertRaisesRegex(ValueError, error, plotMinorVariantHeatmap,
+                               [np.zeros(10), np.zeros(5)], ax=ax)
+        plt.close(fig)
+
+    def testNoSamples(self):
+        """
+        No samples must raise a ValueError, whether given as a list, an
+        empty array or a generator.
+        """
+        for samples in [], np.zeros((0, 10)), (sample for sample in []):
+            self.assertRaisesRegex(ValueError, r'^No samples were given\.$',
+                                   plotMinorVariantHeatmap, samples)
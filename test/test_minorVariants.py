@@ -1,8 +1,37 @@
+from io import StringIO
+from math import isnan
+import json
+import numpy as np
 from os.path import join
+from tempfile import TemporaryDirectory
 from unittest import TestCase
+from unittest.mock import patch
 
-from mvlib.minorVariants import MinorVariantInfo
-from mvlib.common import DATADIR
+from mvlib.minorVariants import (GENE_STATISTICS_DTYPE, JSON_VERSION,
+                                 MinorVariantInfo, PNPS_DTYPE,
+                                 REFERENCE_DIFFERENCE_DTYPE,
+                                 VARIANT_TABLE_DTYPE, consensusCodes,
+                                 minorAllelePNPS, readGroupInfos,
+                                 writeConsensusFasta)
+from mvlib.common import BASES, DATADIR, SARS2OFFSETS
+from mvlib.functions import (DEFAULT_QUALITY_BINS, dataFile,
+                             isMinorVariantPosition)
+from mvlib.sars2features import VI, isNS
+
+
+def _referenceCounts(virus, depth=100):
+    """
+    Make base counts with only the reference base at every position.
+
+    @param virus: One of 'SARS2', 'WNV' or 'YFV'.
+    @param depth: The C{int} count of the reference base.
+    @return: An C{int} array of shape (genome length, len(BASES)).
+    """
+    genome = VI[virus]['g'].sequence
+    counts = np.zeros((len(genome), len(BASES)), dtype=int)
+    counts[np.arange(len(genome)),
+           [BASES.index(base) for base in genome]] = depth
+    return counts
 
 
 class TestMinorVariantInfo(TestCase):
@@ -163,3 +192,865 @@ class TestMinorVariantInfo(TestCase):
         bamFile = join(DATADIR, 'partial-coverage-sorted.bam')
         mvi = MinorVariantInfo(bamFile=bamFile)
         self.assertEqual(1.0692307692307692, mvi.meanCoverage())
+
+    def testSaveAndLoadSparse(self):
+        """
+        Counts saved in the sparse form must load to the same counts and
+        countsPerBase.
+        """
+        bamFile = join(DATADIR, 'partial-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        with TemporaryDirectory() as tempdir:
+            jsonFile = join(tempdir, 'sample.json')
+            mvi.save(jsonFile, sparse=True)
+            with open(jsonFile) as fp:
+                self.assertNotIn('countsPerBase', json.load(fp))
+            loaded = MinorVariantInfo(jsonFile=jsonFile)
+        self.assertEqual(mvi.counts.tolist(), loaded.counts.tolist())
+        self.assertEqual(mvi.countsPerBase, loaded.countsPerBase)
+        self.assertEqual(mvi.coveragePerBase, loaded.coveragePerBase)
+
+    def testSaveAndLoadCompressed(self):
+        """
+        Counts saved to gzip and zstd compressed files must be loaded.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile, strand=True)
+        with TemporaryDirectory() as tempdir:
+            for filename in 'sample.json.gz', 'sample.json.zst':
+                jsonFile = join(tempdir, filename)
+                mvi.save(jsonFile)
+                loaded = MinorVariantInfo(jsonFile=jsonFile)
+                self.assertEqual('sample', loaded.name)
+                self.assertEqual(mvi.counts.tolist(), loaded.counts.tolist())
+                self.assertEqual(mvi.strandCounts.tolist(),
+                                 loaded.strandCounts.tolist())
+
+    def testSaveToStdout(self):
+        """
+        Saving without a file name must write json to standard output.
+        """
+        bamFile = join(DATADIR, 'partial-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile, qualityBins=(0, 30))
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            mvi.save()
+        data = json.loads(stdout.getvalue())
+        self.assertEqual(5, data['counts']['G'][0])
+        self.assertEqual(mvi.qualityBinCounts.tolist(),
+                         data['qualityBinCounts'])
+
+    def testSaveInBlocks(self):
+        """
+        Arrays written in blocks of rows must be saved correctly.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile, strand=True)
+        with patch('mvlib.minorVariants._JSON_ROWS', 7):
+            with TemporaryDirectory() as tempdir:
+                jsonFile = join(tempdir, 'sample.json')
+                mvi.save(jsonFile)
+                loaded = MinorVariantInfo(jsonFile=jsonFile)
+        self.assertEqual(mvi.strandCounts.tolist(),
+                         loaded.strandCounts.tolist())
+
+    def testRegions(self):
+        """
+        Only the positions in the regions must be counted, and the regions
+        must be saved and loaded.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        regional = MinorVariantInfo(bamFile=bamFile, regions=['21-30'])
+        self.assertEqual([(20, 30)], regional.regions)
+        self.assertEqual(100, regional.length)
+        self.assertEqual(mvi.coveragePerBase[20:30],
+                         regional.coveragePerBase[20:30])
+        self.assertEqual(0, sum(regional.coveragePerBase[:20]))
+        with TemporaryDirectory() as tempdir:
+            jsonFile = join(tempdir, 'sample.json')
+            regional.save(jsonFile)
+            loaded = MinorVariantInfo(jsonFile=jsonFile)
+        self.assertEqual([(20, 30)], loaded.regions)
+        self.assertIsNone(mvi.regions)
+
+
+class TestMinorVariantInfoJsonVersions(TestCase):
+    """
+    Tests for saving and loading the versions of the json format.
+    """
+    def testVersion2(self):
+        """
+        Version 2 json must have a version, and a list of counts for each
+        base, and load to the same counts.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-deletion-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        with TemporaryDirectory() as tempdir:
+            jsonFile = join(tempdir, 'sample.json')
+            mvi.save(jsonFile)
+            with open(jsonFile) as fp:
+                data = json.load(fp)
+            loaded = MinorVariantInfo(jsonFile=jsonFile)
+        self.assertEqual(JSON_VERSION, data['version'])
+        self.assertNotIn('countsPerBase', data)
+        self.assertEqual(mvi.counts[:, 5].tolist(), data['counts']['-'])
+        self.assertEqual(mvi.counts.tolist(), loaded.counts.tolist())
+        self.assertEqual(mvi.countsPerBase, loaded.countsPerBase)
+
+    def testVersion1(self):
+        """
+        Version 1 json must have countsPerBase and no version, and load to
+        the same counts.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-deletion-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        with TemporaryDirectory() as tempdir:
+            jsonFile = join(tempdir, 'sample.json')
+            mvi.save(jsonFile, version=1)
+            with open(jsonFile) as fp:
+                data = json.load(fp)
+            loaded = MinorVariantInfo(jsonFile=jsonFile)
+        self.assertNotIn('version', data)
+        self.assertIn('countsPerBase', data)
+        self.assertEqual(mvi.counts.tolist(), loaded.counts.tolist())
+
+    def testUnknownBase(self):
+        """
+        Counts of bases that are not in BASES must be loaded as N.
+        """
+        with TemporaryDirectory() as tempdir:
+            jsonFile = join(tempdir, 'sample.json')
+            with open(jsonFile, 'w') as fp:
+                json.dump({'version': 2,
+                           'parameters': {'sequencingTech': None,
+                                          'minBaseQuality': 0,
+                                          'minMappingQuality': 0},
+                           'counts': {'A': [3, 0], 'R': [1, 2]}}, fp)
+            loaded = MinorVariantInfo(jsonFile=jsonFile)
+        self.assertEqual([[3, 0, 0, 0, 1, 0], [0, 0, 0, 0, 2, 0]],
+                         loaded.counts.tolist())
+
+    def testSaveUnknownVersion(self):
+        """
+        A ValueError must be raised when saving an unknown version.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={0: {'A': 3}})
+        error = r'^Unknown json version 3\. Known versions are 1, 2\.$'
+        self.assertRaisesRegex(ValueError, error, mvi.save, 'x.json',
+                               version=3)
+
+    def testSaveSparseVersion1(self):
+        """
+        A ValueError must be raised when saving sparse counts as version 1.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={0: {'A': 3}})
+        error = r'^Sparse counts need json version 2\.$'
+        self.assertRaisesRegex(ValueError, error, mvi.save, 'x.json',
+                               sparse=True, version=1)
+
+    def testLoadUnknownVersion(self):
+        """
+        A ValueError must be raised when loading an unknown version.
+        """
+        with TemporaryDirectory() as tempdir:
+            jsonFile = join(tempdir, 'sample.json')
+            with open(jsonFile, 'w') as fp:
+                json.dump({'version': 3}, fp)
+            error = r"^Unknown json version 3 in '.*sample\.json'\. "
+            self.assertRaisesRegex(ValueError, error, MinorVariantInfo,
+                                   jsonFile=jsonFile)
+
+
+class TestMinorVariantInfoQualityBins(TestCase):
+    """
+    Tests for the quality bin counts of the MinorVariantInfo class.
+    """
+    def testAtMinBaseQuality(self):
+        """
+        Counts re-derived for a minimum base quality must be the same as
+        those read from the BAM file with that minimum base quality.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-deletion-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile,
+                               qualityBins=DEFAULT_QUALITY_BINS)
+        for minBaseQuality in DEFAULT_QUALITY_BINS:
+            expected = MinorVariantInfo(bamFile=bamFile,
+                                        minBaseQuality=minBaseQuality)
+            derived = mvi.atMinBaseQuality(minBaseQuality)
+            self.assertEqual(expected.counts.tolist(), derived.counts.tolist())
+            self.assertEqual(expected.coveragePerBase,
+                             derived.coveragePerBase)
+            self.assertEqual(expected.maxFreqPerBase, derived.maxFreqPerBase)
+            self.assertEqual(minBaseQuality, derived.minBaseQuality)
+
+    def testAtMinBaseQualityAfterSave(self):
+        """
+        Counts for a minimum base quality must be derivable from a saved
+        json file.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile,
+                               qualityBins=DEFAULT_QUALITY_BINS)
+        with TemporaryDirectory() as tempdir:
+            jsonFile = join(tempdir, 'sample.json')
+            mvi.save(jsonFile)
+            loaded = MinorVariantInfo(jsonFile=jsonFile)
+        self.assertEqual(list(DEFAULT_QUALITY_BINS), loaded.qualityBins)
+        self.assertEqual(mvi.atMinBaseQuality(30).coveragePerBase,
+                         loaded.atMinBaseQuality(30).coveragePerBase)
+
+    def testAtMinBaseQualityNotABinEdge(self):
+        """
+        Asking for a minimum base quality that is not a bin edge must raise
+        a ValueError.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile,
+                               qualityBins=DEFAULT_QUALITY_BINS)
+        error = (r'^Minimum base quality 25 must be one of the quality bins '
+                 r'\(0, 10, 20, 30\) and at least 0\.$')
+        self.assertRaisesRegex(ValueError, error, mvi.atMinBaseQuality, 25)
+
+    def testAtMinBaseQualityWithoutBins(self):
+        """
+        Asking for a minimum base quality without quality bins must raise a
+        ValueError.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        error = '^No quality bin counts are available. '
+        self.assertRaisesRegex(ValueError, error, mvi.atMinBaseQuality, 30)
+
+
+class TestMinorVariantInfoStrand(TestCase):
+    """
+    Tests for the strand counts of the MinorVariantInfo class.
+    """
+    def testStrandCounts(self):
+        """
+        The strand counts must add up to the counts.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile, strand=True)
+        self.assertEqual((2, 100, 6), mvi.strandCounts.shape)
+        self.assertTrue((mvi.counts == mvi.strandCounts.sum(axis=0)).all())
+
+    def testOneStrandOnly(self):
+        """
+        If all reads are on the reverse strand, there must be no forward
+        counts and the strand bias must be nan.
+        """
+        bamFile = join(DATADIR, 'partial-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile, strand=True)
+        self.assertEqual(0, mvi.strandCounts[0].sum())
+        self.assertTrue(all(isnan(bias) for bias in
+                            mvi.strandBias().flatten().tolist()))
+
+    def testStrandBias(self):
+        """
+        The strand bias must be the difference between the frequencies of a
+        base on the two strands.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile, strand=True)
+        forward, reverse = mvi.strandCounts[:, 63].tolist()
+        expected = [abs(f / sum(forward) - r / sum(reverse))
+                    for f, r in zip(forward, reverse)]
+        self.assertEqual(expected, mvi.strandBias()[63].tolist())
+
+    def testStrandBiasWithoutStrandCounts(self):
+        """
+        Asking for the strand bias without strand counts must raise a
+        ValueError.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        error = '^No strand counts are available. '
+        self.assertRaisesRegex(ValueError, error, mvi.strandBias)
+
+    def testMaxStrandBias(self):
+        """
+        A maximum strand bias of 1.0 must not change the richness, except
+        for positions that are not covered on both strands.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile, strand=True)
+        self.assertEqual(mvi.richness(10, 0.003),
+                         mvi.richness(10, 0.003, maxStrandBias=1.0))
+        self.assertEqual(0, mvi.richness(10, 0.003, maxStrandBias=0.0))
+
+    def testSaveAndLoad(self):
+        """
+        Strand counts must be saved and loaded.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile, strand=True)
+        with TemporaryDirectory() as tempdir:
+            jsonFile = join(tempdir, 'sample.json')
+            mvi.save(jsonFile)
+            loaded = MinorVariantInfo(jsonFile=jsonFile)
+        self.assertTrue((mvi.strandCounts == loaded.strandCounts).all())
+
+
+class TestMinorVariantInfoStatistics(TestCase):
+    """
+    Tests for the richness, complexity and distance of the MinorVariantInfo
+    class.
+    """
+    def testMinorVariantMask(self):
+        """
+        The minor variant mask must agree with isMinorVariantPosition.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        mask = mvi.minorVariantMask(10, 0.003)
+        self.assertEqual(
+            [isMinorVariantPosition(mvi.countsPerBase[position], 10, 0.003)
+             for position in range(mvi.length)],
+            mask.tolist())
+
+    def testMinorFrequencies(self):
+        """
+        The minor allele frequencies must be the second highest base
+        frequencies, and zero where there is no coverage.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={
+            0: {'A': 6, 'C': 3, 'G': 1},
+            1: {'A': 0, 'T': 0, 'G': 0, 'C': 0},
+            2: {'T': 4},
+        })
+        self.assertEqual([0.3, 0.0, 0.0], mvi.minorFrequencies().tolist())
+
+    def testRichness(self):
+        """
+        The richness must be correct.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        self.assertEqual(23, mvi.richness(10, 0.003))
+        self.assertEqual(0, mvi.richness())
+
+    def testComplexity(self):
+        """
+        The complexity must be correct.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        self.assertAlmostEqual(0.03253622261120291, mvi.complexity(10, 0.003))
+
+    def testDistance(self):
+        """
+        The distance must be correct.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        self.assertAlmostEqual(0.1015691808693116, mvi.distance(10, 0.003))
+
+
+class TestMinorVariantInfoIndels(TestCase):
+    """
+    Tests for the insertion counts and indel statistics of the
+    MinorVariantInfo class.
+    """
+    def testInsertionFrequencies(self):
+        """
+        The insertion frequencies must be the fraction of reads with an
+        insertion after a position.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-insertion-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        frequencies = mvi.insertionFrequencies()
+        self.assertEqual(10 / mvi.coveragePerBase[91], frequencies[91])
+        self.assertEqual(0.0, frequencies[90])
+
+    def testInsertionFrequenciesWithoutCounts(self):
+        """
+        Asking for insertion frequencies without insertion counts must raise
+        a ValueError.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={0: {'A': 3}})
+        error = '^No insertion counts are available. '
+        self.assertRaisesRegex(ValueError, error, mvi.insertionFrequencies)
+
+    def testIndelRichnessDeletions(self):
+        """
+        Deletions found together with a base must be indel minor variants.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-deletion-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        self.assertEqual([55, 63, 72, 73],
+                         mvi.indelMask(1, 0.001).nonzero()[0].tolist())
+        self.assertEqual(4, mvi.indelRichness(1, 0.001))
+        self.assertEqual(0, mvi.indelRichness())
+
+    def testSaveAndLoad(self):
+        """
+        Insertion counts and sequences must be saved and loaded.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-insertion-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile, insertionSequences=True)
+        with TemporaryDirectory() as tempdir:
+            jsonFile = join(tempdir, 'sample.json')
+            mvi.save(jsonFile)
+            loaded = MinorVariantInfo(jsonFile=jsonFile)
+        self.assertEqual(mvi.insertionCounts.tolist(),
+                         loaded.insertionCounts.tolist())
+        self.assertEqual({91: {'T': 10}}, loaded.insertionSequences)
+
+
+class TestMinorVariantInfoVariantTable(TestCase):
+    """
+    Tests for the MinorVariantInfo.variantTable method.
+    """
+    def testRows(self):
+        """
+        The table must have the right values for each minor variant.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={
+            0: {'A': 60, 'C': 30, 'G': 10},
+            1: {'A': 0, 'T': 0, 'G': 0, 'C': 0},
+            2: {'T': 100},
+            3: {'G': 50, '-': 50},
+        })
+        table = mvi.variantTable(minCoverage=10, minFrequency=0.05)
+        self.assertEqual(VARIANT_TABLE_DTYPE, table.dtype)
+        self.assertEqual([0, 3], table['position'].tolist())
+        self.assertEqual([100, 100], table['depth'].tolist())
+        self.assertEqual(['A', 'G'], table['majorBase'].tolist())
+        self.assertEqual([0.6, 0.5], table['majorFrequency'].tolist())
+        self.assertEqual(['C', '-'], table['minorBase'].tolist())
+        self.assertEqual([0.3, 0.5], table['minorFrequency'].tolist())
+        self.assertAlmostEqual(np.log(2), table['entropy'][1])
+
+    def testAgreesWithRichness(self):
+        """
+        The table must have a row per minor variant position, and its mean
+        entropy must be the complexity.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        table = mvi.variantTable(10, 0.003)
+        self.assertEqual(mvi.richness(10, 0.003), len(table))
+        self.assertAlmostEqual(mvi.complexity(10, 0.003),
+                               table['entropy'].mean())
+        self.assertAlmostEqual(mvi.distance(10, 0.003),
+                               table['minorFrequency'].sum())
+
+    def testNoVariants(self):
+        """
+        If there are no minor variants, the table must be empty.
+        """
+        bamFile = join(DATADIR, 'partial-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        self.assertEqual(0, len(mvi.variantTable()))
+
+    def testDataFrame(self):
+        """
+        A DataFrame must have the columns of the structured array.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        try:
+            df = mvi.variantTable(10, 0.003, dataFrame=True)
+        except ImportError:
+            self.skipTest('pandas is not installed.')
+        self.assertEqual(list(VARIANT_TABLE_DTYPE.names), list(df.columns))
+        self.assertEqual(mvi.richness(10, 0.003), len(df))
+
+
+class TestMinorVariantInfoGeneStatistics(TestCase):
+    """
+    Tests for the MinorVariantInfo.geneStatistics method.
+    """
+    def testAgreesWithStatistics(self):
+        """
+        The statistics of each gene, including overlapping genes, must be
+        those of the positions of the gene.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        mvi = MinorVariantInfo(bamFile=bamFile)
+        genes = {'a': (0, 50), 'b': (40, 100), 'c': (45, 46)}
+        table = mvi.geneStatistics(genes, 10, 0.003)
+        self.assertEqual(GENE_STATISTICS_DTYPE, table.dtype)
+        self.assertEqual(['a', 'b', 'c'], table['gene'].tolist())
+        for row, (start, stop) in zip(table, genes.values()):
+            gene = MinorVariantInfo(
+                baseCounts={'counts': mvi.counts[start:stop]})
+            self.assertEqual((start, stop), (row['start'], row['stop']))
+            self.assertAlmostEqual(gene.meanCoverage(), row['meanCoverage'])
+            self.assertEqual(gene.richness(10, 0.003), row['richness'])
+            self.assertAlmostEqual(gene.distance(10, 0.003), row['distance'])
+            if row['richness']:
+                self.assertAlmostEqual(gene.complexity(10, 0.003),
+                                       row['complexity'])
+            else:
+                self.assertTrue(isnan(row['complexity']))
+            # nucleotideDiversity includes the end offset.
+            self.assertAlmostEqual(
+                mvi.nucleotideDiversity(offsets=(start, stop - 1)),
+                row['pi'])
+
+    def testValues(self):
+        """
+        The statistics must have the right values.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={
+            0: {'A': 60, 'C': 40},
+            1: {'T': 100},
+            2: {'G': 50, '-': 50},
+            3: {},
+        })
+        table = mvi.geneStatistics({'x': (0, 4), 'y': (1, 2)}, 10, 0.05)
+        self.assertEqual([75.0, 100.0], table['meanCoverage'].tolist())
+        self.assertEqual([2, 0], table['richness'].tolist())
+        self.assertAlmostEqual(0.9, table['distance'][0])
+        self.assertAlmostEqual(
+            (-0.6 * np.log(0.6) - 0.4 * np.log(0.4) + np.log(2)) / 2,
+            table['complexity'][0])
+        self.assertTrue(isnan(table['complexity'][1]))
+        # The deletions at position 2 are not nucleotides.
+        self.assertAlmostEqual(60 * 40 / (100 * 99 / 2) / 4, table['pi'][0])
+        self.assertEqual(0.0, table['pi'][1])
+
+    def testVirus(self):
+        """
+        A virus name must give the statistics of its genes.
+        """
+        counts = np.zeros((29903, 6), dtype=int)
+        counts[:, 0] = 100
+        counts[21562, 1] = 50
+        mvi = MinorVariantInfo(baseCounts={'counts': counts})
+        table = mvi.geneStatistics('SARS2')
+        self.assertEqual(list(SARS2OFFSETS), table['gene'].tolist())
+        self.assertEqual(
+            dict.fromkeys(SARS2OFFSETS, 0) | {'S': 1},
+            dict(zip(table['gene'].tolist(), table['richness'].tolist())))
+
+    def testUnknownVirus(self):
+        """
+        A ValueError must be raised for an unknown virus.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={0: {'A': 1}})
+        error = r"^Unknown virus 'HIV'\. Known viruses are SARS2, WNV, YFV\.$"
+        self.assertRaisesRegex(ValueError, error, mvi.geneStatistics, 'HIV')
+
+    def testOffsetsOutsideGenome(self):
+        """
+        A ValueError must be raised for a gene that is empty or not within
+        the genome.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={0: {'A': 1}, 1: {'C': 1}})
+        for offsets in (1, 1), (0, 3), (-1, 1):
+            error = (r"^Gene 'x' offsets \(-?\d, \d\) are empty or not "
+                     r"within the genome of length 2\.$")
+            self.assertRaisesRegex(ValueError, error, mvi.geneStatistics,
+                                   {'x': offsets})
+
+    def testDataFrame(self):
+        """
+        A DataFrame must have the columns of the structured array.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={0: {'A': 1}, 1: {'C': 1}})
+        try:
+            df = mvi.geneStatistics({'x': (0, 2)}, dataFrame=True)
+        except ImportError:
+            self.skipTest('pandas is not installed.')
+        self.assertEqual(list(GENE_STATISTICS_DTYPE.names), list(df.columns))
+
+
+class TestMinorVariantInfoPNPS(TestCase):
+    """
+    Tests for the MinorVariantInfo.pnps method and the minorAllelePNPS
+    function.
+    """
+    # A synonymous and a non-synonymous change in S (found with isNS).
+    SYNONYMOUS = (21567, 'C')
+    NON_SYNONYMOUS = (21563, 'C')
+
+    def testChanges(self):
+        """
+        The changes must be those of isNS, from a reference base.
+        """
+        genome = VI['SARS2']['g'].sequence
+        for position, base in self.SYNONYMOUS, self.NON_SYNONYMOUS:
+            self.assertNotEqual(genome[position], base)
+        self.assertFalse(isNS(*self.SYNONYMOUS, 'SARS2')[0])
+        self.assertTrue(isNS(*self.NON_SYNONYMOUS, 'SARS2')[0])
+
+    def testNoMinorAlleles(self):
+        """
+        Without minor alleles, pN and pS must be zero and the sites of each
+        position must add up to one.
+        """
+        mvi = MinorVariantInfo(
+            baseCounts={'counts': _referenceCounts('SARS2')})
+        table = mvi.pnps('SARS2', cacheDir=None)
+        self.assertEqual(PNPS_DTYPE, table.dtype)
+        self.assertEqual(list(SARS2OFFSETS), table['gene'].tolist())
+        self.assertEqual(
+            [stop - start for start, stop in SARS2OFFSETS.values()],
+            (table['nonSynonymousSites'] +
+             table['synonymousSites']).tolist())
+        self.assertEqual(0.0, table['pN'].sum() + table['pS'].sum())
+        self.assertTrue(np.isnan(table['pNpS']).all())
+
+    def testMinorAlleles(self):
+        """
+        The minor allele frequencies must be counted for the right gene and
+        change.
+        """
+        counts = _referenceCounts('SARS2')
+        counts[self.SYNONYMOUS[0], BASES.index(self.SYNONYMOUS[1])] = 25
+        position, base = self.NON_SYNONYMOUS
+        counts[position] *= 3
+        counts[position, BASES.index(base)] = 100
+        # A minor allele below the minimum frequency.
+        counts[21600, BASES.index('-')] = 1
+        mvi = MinorVariantInfo(baseCounts={'counts': counts})
+        table = mvi.pnps('SARS2', minCoverage=10, minFrequency=0.05,
+                         genes=['E', 'S'], cacheDir=None)
+        self.assertEqual(['E', 'S'], table['gene'].tolist())
+        self.assertEqual([0.0, 0.25], table['nonSynonymous'].tolist())
+        self.assertEqual([0.0, 0.2], table['synonymous'].tolist())
+        s = table[1]
+        self.assertAlmostEqual(0.25 / s['nonSynonymousSites'], s['pN'])
+        self.assertAlmostEqual(0.2 / s['synonymousSites'], s['pS'])
+        self.assertAlmostEqual(s['pN'] / s['pS'], s['pNpS'])
+
+    def testMinorReferenceBase(self):
+        """
+        A minor allele that is the reference base must be classified by the
+        change to the most common base.
+        """
+        position, base = self.NON_SYNONYMOUS
+        counts = _referenceCounts('SARS2')
+        counts[position] = 0
+        counts[position, BASES.index(base)] = 80
+        counts[position, BASES.index(VI['SARS2']['g'].sequence[position])] = 20
+        mvi = MinorVariantInfo(baseCounts={'counts': counts})
+        table = mvi.pnps('SARS2', minCoverage=10, minFrequency=0.05,
+                         genes=['S'], cacheDir=None)
+        self.assertEqual([0.2], table['nonSynonymous'].tolist())
+        self.assertEqual([0.0], table['synonymous'].tolist())
+
+    def testSeveralSamples(self):
+        """
+        The table of several samples must hold the table of each sample.
+        """
+        # Position 503 has synonymous changes.
+        first = _referenceCounts('WNV')
+        first[503, BASES.index('C')] = 30
+        second = _referenceCounts('WNV')
+        second[500, BASES.index('A')] = 50
+        second[503, BASES.index('T')] = 20
+        counts = np.stack([first, second])
+        table = minorAllelePNPS(counts, 'WNV', cacheDir=None)
+        self.assertEqual((2, 1), table.shape)
+        for sample, sampleCounts in zip(table, counts):
+            mvi = MinorVariantInfo(baseCounts={'counts': sampleCounts})
+            self.assertEqual(mvi.pnps('WNV', cacheDir=None).tolist(),
+                             sample.tolist())
+
+    def testUnknownGene(self):
+        """
+        A ValueError must be raised for an unknown gene.
+        """
+        mvi = MinorVariantInfo(baseCounts={'counts': _referenceCounts('YFV')})
+        error = (r"^Unknown YFV gene\(s\): 'S'\. Known genes are "
+                 r"Polyprotein\.$")
+        self.assertRaisesRegex(ValueError, error, mvi.pnps, 'YFV',
+                               genes=['S'], cacheDir=None)
+
+    def testWrongLength(self):
+        """
+        A ValueError must be raised if the counts do not have the length of
+        the genome.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={0: {'A': 1}})
+        error = (r"^The counts have length 1, but the YFV genome has length "
+                 r"10862\.$")
+        self.assertRaisesRegex(ValueError, error, mvi.pnps, 'YFV',
+                               cacheDir=None)
+
+
+class TestMinorVariantInfoConsensus(TestCase):
+    """
+    Tests for the MinorVariantInfo.consensus method and the consensusCodes
+    function.
+    """
+    def _mvi(self):
+        """
+        Make a sample with an ambiguous position, a position below the
+        minimum depth, a deletion, a position whose Ns are not counted and
+        an uncovered position.
+
+        @return: A C{MinorVariantInfo} instance.
+        """
+        return MinorVariantInfo(frequenciesDict={
+            0: {'A': 60, 'C': 40},
+            1: {'T': 5},
+            2: {'G': 50, '-': 60},
+            3: {'A': 30, 'G': 30, 'T': 30, 'N': 100},
+            4: {},
+        })
+
+    def testMostCommonBase(self):
+        """
+        Without ambiguity codes, the most common base must be called.
+        """
+        self.assertEqual('AN-AN', self._mvi().consensus())
+
+    def testAmbiguityCodes(self):
+        """
+        Nucleotides at or above the ambiguity frequency must give an IUPAC
+        code.
+        """
+        mvi = self._mvi()
+        self.assertEqual('MN-DN', mvi.consensus(ambiguityFrequency=0.2))
+        self.assertEqual('AN-AN', mvi.consensus(ambiguityFrequency=0.5))
+
+    def testMinDepth(self):
+        """
+        Positions below the minimum depth must be N.
+        """
+        mvi = self._mvi()
+        self.assertEqual('AT-AN', mvi.consensus(minDepth=1))
+        self.assertEqual('AN-NN', mvi.consensus(minDepth=100))
+
+    def testNoGaps(self):
+        """
+        Deletions must be left out if gaps are not kept.
+        """
+        self.assertEqual('ANAN', self._mvi().consensus(keepGaps=False))
+
+    def testSeveralSamples(self):
+        """
+        The codes of several samples must be those of each sample.
+        """
+        first = self._mvi()
+        second = MinorVariantInfo(frequenciesDict={
+            position: {'C': 20, 'T': 20} for position in range(5)})
+        codes = consensusCodes(np.stack([first.counts, second.counts]),
+                               ambiguityFrequency=0.2)
+        self.assertEqual(['MN-DN', 'YYYYY'],
+                         [row.tobytes().decode() for row in codes])
+
+
+class TestMinorVariantInfoReferenceDifferences(TestCase):
+    """
+    Tests for the MinorVariantInfo.referenceDifferences method.
+    """
+    def testDifferences(self):
+        """
+        Positions whose most common base is not the reference base must be
+        found.
+        """
+        genome = VI['SARS2']['g'].sequence
+        counts = _referenceCounts('SARS2')
+        other = 'C' if genome[100] != 'C' else 'A'
+        counts[100, BASES.index(other)] = 300
+        counts[200, BASES.index('-')] = 101
+        # Too few reads to call a base.
+        counts[300] = 0
+        counts[300, BASES.index(other)] = 5
+        # A minor variant only.
+        counts[400, BASES.index(other)] = 40
+        mvi = MinorVariantInfo(baseCounts={'counts': counts})
+        table = mvi.referenceDifferences('SARS2')
+        self.assertEqual(REFERENCE_DIFFERENCE_DTYPE, table.dtype)
+        self.assertEqual([100, 200], table['position'].tolist())
+        self.assertEqual([400, 201], table['depth'].tolist())
+        self.assertEqual([genome[100], genome[200]],
+                         table['referenceBase'].tolist())
+        self.assertEqual([other, '-'], table['majorBase'].tolist())
+        self.assertEqual([0.75, 101 / 201],
+                         table['majorFrequency'].tolist())
+
+    def testNoDifferences(self):
+        """
+        A sample with the reference bases must have no differences.
+        """
+        mvi = MinorVariantInfo(baseCounts={'counts': _referenceCounts('WNV')})
+        self.assertEqual(0, len(mvi.referenceDifferences('WNV')))
+
+    def testUnknownVirus(self):
+        """
+        A ValueError must be raised for an unknown virus.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={0: {'A': 1}})
+        error = r"^Unknown virus 'HIV'\. Known viruses are SARS2, WNV, YFV\.$"
+        self.assertRaisesRegex(ValueError, error, mvi.referenceDifferences,
+                               'HIV')
+
+    def testWrongLength(self):
+        """
+        A ValueError must be raised if the counts do not have the length of
+        the genome.
+        """
+        mvi = MinorVariantInfo(frequenciesDict={0: {'A': 1}})
+        error = (r"^The counts have length 1, but the WNV genome has length "
+                 r"11013\.$")
+        self.assertRaisesRegex(ValueError, error, mvi.referenceDifferences,
+                               'WNV')
+
+
+class TestWriteConsensusFasta(TestCase):
+    """
+    Tests for the writeConsensusFasta function.
+    """
+    def testWrite(self):
+        """
+        The consensus of each sample must be written, named after the
+        sample, also to a compressed file.
+        """
+        samples = []
+        for name, base in ('s1', 'A'), ('s2', 'G'):
+            mvi = MinorVariantInfo(frequenciesDict={
+                position: {base: 20} for position in range(3)})
+            mvi.name = name
+            samples.append(mvi)
+
+        with TemporaryDirectory() as tempDir:
+            for filename in 'cohort.fasta', 'cohort.fasta.gz':
+                filename = join(tempDir, filename)
+                self.assertEqual(2, writeConsensusFasta(iter(samples),
+                                                        filename))
+                with dataFile(filename) as fp:
+                    self.assertEqual('>s1\nAAA\n>s2\nGGG\n', fp.read())
+
+
+class TestReadGroupInfos(TestCase):
+    """
+    Tests for the readGroupInfos function.
+    """
+    def testInfos(self):
+        """
+        There must be a MinorVariantInfo for each read group sample, named
+        after it and with the counts of its reads.
+        """
+        bamFile = join(DATADIR, 'partial-coverage-sorted.bam')
+        infos = readGroupInfos(bamFile, minBaseQuality=10, strand=True)
+        self.assertEqual(['partial-for-testing'], list(infos))
+        mvi = infos['partial-for-testing']
+        expected = MinorVariantInfo(bamFile=bamFile, minBaseQuality=10,
+                                    strand=True)
+        self.assertEqual('partial-for-testing', mvi.name)
+        self.assertEqual(10, mvi.minBaseQuality)
+        self.assertEqual(expected.counts.tolist(), mvi.counts.tolist())
+        self.assertEqual(expected.strandCounts.tolist(),
+                         mvi.strandCounts.tolist())
+        self.assertIsNone(mvi.regions)
+
+    def testSave(self):
+        """
+        A MinorVariantInfo made for a read group sample must be saved and
+        read back.
+        """
+        bamFile = join(DATADIR, 'complete-coverage-sorted.bam')
+        (mvi,) = readGroupInfos(bamFile, regions=['11-20']).values()
+        with TemporaryDirectory() as tempDir:
+            filename = join(tempDir, 'sample.json')
+            mvi.save(filename)
+            loaded = MinorVariantInfo(jsonFile=filename)
+        self.assertEqual(mvi.counts.tolist(), loaded.counts.tolist())
+        self.assertEqual([(10, 20)], loaded.regions)
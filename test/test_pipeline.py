@@ -0,0 +1,224 @@
+import json
+import os
+from os.path import exists, join
+from tempfile import TemporaryDirectory
+import time
+from unittest import TestCase
+
+from mvlib.common import DATADIR
+from mvlib.minorVariants import MinorVariantInfo
+from mvlib.pipeline import (STAGES, atomicOutput, readManifest, runPipeline,
+                            stageOutputs)
+
+BAMFILES = [join(DATADIR, name) for name in (
+    'complete-coverage-sorted.bam', 'partial-coverage-sorted.bam')]
+
+# Plot only a few positions of the short test references, to be quick.
+POSITIONS = [10, 11, 12]
+
+
+def _run(outDir, bamFiles=BAMFILES, **kwargs):
+    """
+    Run the pipeline on test BAM files.
+
+    @param outDir: The C{str} output directory.
+    @param bamFiles: A C{list} of C{str} BAM file names.
+    @param kwargs: Further keyword arguments for C{runPipeline}.
+    @return: The result of C{runPipeline}.
+    """
+    kwargs.setdefault('workers', 1)
+    return runPipeline(bamFiles, outDir, plotPositions=POSITIONS, **kwargs)
+
+
+class TestAtomicOutput(TestCase):
+    """
+    Tests for the atomicOutput function.
+    """
+    def testWrite(self):
+        """
+        What is written to the temporary file must end up in the output.
+        """
+        with TemporaryDirectory() as tempDir:
+            filename = join(tempDir, 'sub', 'out.txt')
+            with atomicOutput(filename) as tempFile:
+                self.assertFalse(exists(filename))
+                with open(tempFile, 'w') as fp:
+                    fp.write('hello')
+            with open(filename) as fp:
+                self.assertEqual('hello', fp.read())
+            self.assertEqual(['out.txt'], os.listdir(join(tempDir, 'sub')))
+
+    def testError(self):
+        """
+        If an error is raised, the output must be left as it was and the
+        temporary file removed.
+        """
+        with TemporaryDirectory() as tempDir:
+            filename = join(tempDir, 'out.txt')
+            with open(filename, 'w') as fp:
+                fp.write('old')
+            with self.assertRaisesRegex(RuntimeError, '^Oops$'):
+                with atomicOutput(filename) as tempFile:
+                    with open(tempFile, 'w') as fp:
+                        fp.write('new')
+                    raise RuntimeError('Oops')
+            with open(filename) as fp:
+                self.assertEqual('old', fp.read())
+            self.assertEqual(['out.txt'], os.listdir(tempDir))
+
+
+class TestRunPipeline(TestCase):
+    """
+    Tests for the runPipeline function.
+    """
+    def testOutputs(self):
+        """
+        Running the pipeline must make all outputs of all samples and record
+        them in the manifest, whether samples are run in this process or in
+        worker processes.
+        """
+        for workers in 1, 2:
+            with TemporaryDirectory() as tempDir:
+                result = _run(tempDir, workers=workers)
+                expected = dict.fromkeys(STAGES, 'done')
+                expected['error'] = None
+                self.assertEqual({'complete-coverage-sorted': expected,
+                                  'partial-coverage-sorted': expected},
+                                 result)
+                manifest = readManifest(tempDir)
+                for name in result:
+                    for stage, output in stageOutputs(tempDir, name).items():
+                        self.assertTrue(exists(output))
+                        self.assertEqual(stage, manifest[output]['stage'])
+                        self.assertEqual(name, manifest[output]['sample'])
+
+    def testCountsAndStatistics(self):
+        """
+        The saved counts and statistics must be those of the BAM file.
+        """
+        with TemporaryDirectory() as tempDir:
+            _run(tempDir, minCoverage=10, minFrequency=0.05)
+            bamFile = BAMFILES[0]
+            expected = MinorVariantInfo(bamFile=bamFile)
+            outputs = stageOutputs(tempDir, 'complete-coverage-sorted')
+            mvi = MinorVariantInfo(jsonFile=outputs['counts'])
+            self.assertEqual(expected.counts.tolist(), mvi.counts.tolist())
+            with open(outputs['statistics']) as fp:
+                statistics = json.load(fp)
+            self.assertEqual(expected.richness(10, 0.05),
+                             statistics['richness'])
+            self.assertAlmostEqual(expected.distance(10, 0.05),
+                                   statistics['distance'])
+            self.assertAlmostEqual(expected.meanCoverage(),
+                                   statistics['meanCoverage'])
+
+    def testSkipUpToDate(self):
+        """
+        Running again must not make any output again.
+        """
+        with TemporaryDirectory() as tempDir:
+            _run(tempDir)
+            result = _run(tempDir)
+            for name in result:
+                self.assertEqual(dict.fromkeys(STAGES, 'skipped'),
+                                 {stage: result[name][stage]
+                                  for stage in STAGES})
+
+    def testForce(self):
+        """
+        Running again with force must make all outputs again.
+        """
+        with TemporaryDirectory() as tempDir:
+            _run(tempDir)
+            result = _run(tempDir, force=True)
+            for name in result:
+                self.assertEqual('done', result[name]['counts'])
+
+    def testChangedParameters(self):
+        """
+        Changing the statistics parameters must only make the statistics
+        again. Options that do not change the counts must not make anything
+        again.
+        """
+        with TemporaryDirectory() as tempDir:
+            _run(tempDir)
+            result = _run(tempDir, minCoverage=10, threads=2)
+            for name in result:
+                self.assertEqual({'counts': 'skipped', 'statistics': 'done',
+                                  'plot': 'skipped', 'error': None},
+                                 result[name])
+
+    def testChangedCountParameters(self):
+        """
+        Changing the counting parameters must make all outputs again.
+        """
+        with TemporaryDirectory() as tempDir:
+            _run(tempDir)
+            result = _run(tempDir, countParams={'minBaseQuality': 30})
+            for name in result:
+                self.assertEqual(dict.fromkeys(STAGES, 'done'),
+                                 {stage: result[name][stage]
+                                  for stage in STAGES})
+
+    def testNewerInput(self):
+        """
+        An output older than its input must be made again, along with the
+        outputs made from it.
+        """
+        with TemporaryDirectory() as tempDir:
+            _run(tempDir)
+            outputs = stageOutputs(tempDir, 'partial-coverage-sorted')
+            # Make the counts look newer than the outputs made from them.
+            future = time.time() + 60
+            os.utime(outputs['counts'], (future, future))
+            result = _run(tempDir)
+            self.assertEqual({'counts': 'skipped', 'statistics': 'done',
+                              'plot': 'done', 'error': None},
+                             result['partial-coverage-sorted'])
+            self.assertEqual(dict.fromkeys(STAGES, 'skipped'),
+                             {stage: result['complete-coverage-sorted'][stage]
+                              for stage in STAGES})
+
+    def testMissingOutput(self):
+        """
+        A missing output must be made again.
+        """
+        with TemporaryDirectory() as tempDir:
+            _run(tempDir)
+            outputs = stageOutputs(tempDir, 'complete-coverage-sorted')
+            os.unlink(outputs['plot'])
+            result = _run(tempDir)
+            self.assertEqual({'counts': 'skipped', 'statistics': 'skipped',
+                              'plot': 'done', 'error': None},
+                             result['complete-coverage-sorted'])
+            self.assertTrue(exists(outputs['plot']))
+
+    def testFailedSample(self):
+        """
+        A sample that fails must be reported, without stopping the other
+        samples or leaving partial outputs.
+        """
+        with TemporaryDirectory() as tempDir:
+            bamFiles = [join(tempDir, 'missing.bam')] + BAMFILES
+            for workers in 1, 2:
+                result = _run(tempDir, bamFiles=bamFiles, workers=workers)
+                self.assertRegex(result['missing']['error'],
+                                 '^FileNotFoundError: ')
+                self.assertNotIn('counts', result['missing'])
+                self.assertIsNone(result['partial-coverage-sorted']['error'])
+            self.assertEqual([], [filename for filename in
+                                  os.listdir(join(tempDir, 'counts'))
+                                  if filename.startswith('missing')])
+            self.assertEqual(['counts', 'manifest.json', 'plots',
+                              'statistics'], sorted(os.listdir(tempDir)))
+
+    def testDuplicateNames(self):
+        """
+        A ValueError must be raised if two BAM files have the same sample
+        name.
+        """
+        with TemporaryDirectory() as tempDir:
+            error = (r"^Several BAM files have the same sample name: "
+                     r"'partial-coverage-sorted'\.$")
+            self.assertRaisesRegex(ValueError, error, runPipeline,
+                                   BAMFILES + BAMFILES[1:], tempDir)
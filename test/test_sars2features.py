@@ -1,6 +1,12 @@
+import os
+from tempfile import TemporaryDirectory
 from unittest import TestCase
+from unittest.mock import patch
 
-from mvlib.sars2features import getGene, getCodonAtPosition, isNS
+from mvlib import sars2features
+from mvlib.sars2features import (NO_CHANGE, NON_SYNONYMOUS, SYNONYMOUS, VI,
+                                 geneSubstitutions, getGene,
+                                 getCodonAtPosition, isNS, substitutionTables)
 
 
 class TestSARS2FeaturesGetGene(TestCase):
@@ -136,3 +142,103 @@ class TestSARS2FeaturesIsNS(TestCase):
         If a mutation is synonymous, return correctly
         """
         self.assertEqual([False, False, 1], isNS(265, 'A', 'SARS2'))
+
+
+class TestSARS2FeaturesGeneSubstitutions(TestCase):
+    """
+    Tests for the sars2features.geneSubstitutions function.
+    """
+    def testValues(self):
+        """
+        Each base change must be classified correctly.
+        """
+        # ATG (start) CTT (L).
+        table = geneSubstitutions('ATGCTT')
+        self.assertEqual(
+            [[NO_CHANGE, NON_SYNONYMOUS, NON_SYNONYMOUS, NON_SYNONYMOUS],
+             [NON_SYNONYMOUS, NON_SYNONYMOUS, NON_SYNONYMOUS, NO_CHANGE],
+             [NON_SYNONYMOUS, NON_SYNONYMOUS, NO_CHANGE, NON_SYNONYMOUS],
+             [NON_SYNONYMOUS, NO_CHANGE, NON_SYNONYMOUS, NON_SYNONYMOUS],
+             [NON_SYNONYMOUS, NON_SYNONYMOUS, NON_SYNONYMOUS, NO_CHANGE],
+             [SYNONYMOUS, SYNONYMOUS, SYNONYMOUS, NO_CHANGE]],
+            table.tolist())
+
+    def testBadLength(self):
+        """
+        A ValueError must be raised if the length of the sequence is not a
+        multiple of three.
+        """
+        error = (r'^The length of a coding sequence \(4\) must be a multiple '
+                 r'of three\.$')
+        self.assertRaisesRegex(ValueError, error, geneSubstitutions, 'ATGC')
+
+    def testBadBase(self):
+        """
+        A ValueError must be raised if the sequence has a base that is not a
+        nucleotide.
+        """
+        error = r'^Sequence has a base that is not one of A, C, G, T\.$'
+        self.assertRaisesRegex(ValueError, error, geneSubstitutions, 'ATN')
+
+
+class TestSARS2FeaturesSubstitutionTables(TestCase):
+    """
+    Tests for the sars2features.substitutionTables function.
+    """
+    def testAgreesWithIsNS(self):
+        """
+        The tables must agree with isNS for positions in only one gene.
+        """
+        for virus in VI:
+            tables = substitutionTables(virus, cacheDir=None)
+            genome = VI[virus]['g'].sequence
+            for gene, (start, stop) in VI[virus]['o'].items():
+                for position in range(start, stop, (stop - start) // 20):
+                    if getGene(position, virus) != gene:
+                        continue
+                    for index, base in enumerate('ACGT'):
+                        if base == genome[position]:
+                            expected = NO_CHANGE
+                        elif isNS(position, base, virus)[0] is False:
+                            expected = SYNONYMOUS
+                        else:
+                            expected = NON_SYNONYMOUS
+                        self.assertEqual(
+                            expected, tables[gene][position - start, index])
+
+    def testOverlappingGenes(self):
+        """
+        Positions in overlapping genes must be classified in the frame of
+        each gene.
+        """
+        tables = substitutionTables('SARS2', cacheDir=None)
+        genome = VI['SARS2']['g'].sequence
+        for gene in 'ORF7a', 'ORF7b':
+            start, stop = VI['SARS2']['o'][gene]
+            self.assertEqual(
+                geneSubstitutions(genome[start:stop]).tolist(),
+                tables[gene].tolist())
+
+    def testCache(self):
+        """
+        The tables must be written to the cache directory and read from it
+        in a new process.
+        """
+        with TemporaryDirectory() as tempDir:
+            with patch.dict(sars2features._SUBSTITUTION_TABLES, clear=True):
+                expected = substitutionTables('WNV', cacheDir=tempDir)
+            [filename] = os.listdir(tempDir)
+            self.assertRegex(filename, r'^WNV-substitutions-\w+\.npz$')
+            with patch.dict(sars2features._SUBSTITUTION_TABLES, clear=True):
+                with patch.object(sars2features, 'geneSubstitutions') as mock:
+                    tables = substitutionTables('WNV', cacheDir=tempDir)
+                    mock.assert_not_called()
+            self.assertEqual(expected['Polyprotein'].tolist(),
+                             tables['Polyprotein'].tolist())
+
+    def testUnknownVirus(self):
+        """
+        A ValueError must be raised for an unknown virus.
+        """
+        error = r"^Unknown virus 'HIV'\. Known viruses are SARS2, WNV, YFV\.$"
+        self.assertRaisesRegex(ValueError, error, substitutionTables, 'HIV')
@@ -0,0 +1,251 @@
+import asyncio
+import json
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from mvlib.common import DATADIR
+from mvlib.minorVariants import MinorVariantInfo
+from mvlib.service import CohortService, sendQuery
+
+
+def _service():
+    """
+    Make a service for the samples in the test BAM files.
+
+    @return: A C{CohortService} instance.
+    """
+    return CohortService(
+        MinorVariantInfo(bamFile=join(DATADIR, filename)) for filename in
+        ('complete-coverage-sorted.bam', 'partial-coverage-sorted.bam'))
+
+
+class TestCohortService(TestCase):
+    """
+    Tests for the CohortService class.
+    """
+    def testSamples(self):
+        """
+        The 'samples' query must give the names of the samples, filtered by
+        mean coverage.
+        """
+        service = _service()
+        self.assertEqual(
+            ['complete-coverage-sorted', 'partial-coverage-sorted'],
+            service.handle({'query': 'samples'})['result'])
+        self.assertEqual(
+            {'result': ['complete-coverage-sorted']},
+            service.handle({'query': 'samples', 'minMeanCoverage': 10}))
+
+    def testRichness(self):
+        """
+        The 'richness' query must give the richness of the selected samples.
+        """
+        service = _service()
+        mvi = service.samples['complete-coverage-sorted']
+        self.assertEqual(
+            {'result': {'complete-coverage-sorted':
+                        mvi.richness(10, 0.003)}},
+            service.handle({'query': 'richness',
+                            'samples': ['complete-coverage-sorted'],
+                            'params': {'minCoverage': 10,
+                                       'minFrequency': 0.003}}))
+
+    def testVariantTable(self):
+        """
+        The 'variantTable' query must give the rows of the table as dicts.
+        """
+        service = _service()
+        mvi = service.samples['complete-coverage-sorted']
+        table = mvi.variantTable(10, 0.003)
+        result = service.handle({'query': 'variantTable',
+                                 'samples': ['complete-coverage-sorted'],
+                                 'params': {'minCoverage': 10,
+                                            'minFrequency': 0.003}})
+        rows = result['result']['complete-coverage-sorted']
+        self.assertEqual(len(table), len(rows))
+        self.assertEqual(table[0]['position'], rows[0]['position'])
+        self.assertEqual(table[0]['minorBase'], rows[0]['minorBase'])
+        json.dumps(result)
+
+    def testNucleotideDiversityWindow(self):
+        """
+        The 'nucleotideDiversity' query must accept offsets as a list.
+        """
+        service = _service()
+        mvi = service.samples['complete-coverage-sorted']
+        result = service.handle({'query': 'nucleotideDiversity',
+                                 'samples': ['complete-coverage-sorted'],
+                                 'params': {'offsets': [10, 50]}})
+        self.assertAlmostEqual(
+            mvi.nucleotideDiversity(offsets=(10, 50)),
+            result['result']['complete-coverage-sorted'])
+
+    def testGeneStatistics(self):
+        """
+        The 'geneStatistics' query must accept gene offsets as a json
+        object.
+        """
+        service = _service()
+        mvi = service.samples['complete-coverage-sorted']
+        table = mvi.geneStatistics({'a': (0, 50), 'b': (40, 100)}, 10, 0.003)
+        result = service.handle({'query': 'geneStatistics',
+                                 'samples': ['complete-coverage-sorted'],
+                                 'params': {'genes': {'a': [0, 50],
+                                                      'b': [40, 100]},
+                                            'minCoverage': 10,
+                                            'minFrequency': 0.003}})
+        rows = result['result']['complete-coverage-sorted']
+        self.assertEqual(['a', 'b'], [row['gene'] for row in rows])
+        self.assertEqual(table['richness'].tolist(),
+                         [row['richness'] for row in rows])
+        self.assertEqual(table['pi'].tolist(), [row['pi'] for row in rows])
+
+    def testCache(self):
+        """
+        Repeated queries must be answered from the cache, whatever the order
+        of their parameters.
+        """
+        service = _service()
+        service.handle({'query': 'complexity', 'minMeanCoverage': 10,
+                        'params': {'minCoverage': 10, 'minFrequency': 0.003}})
+        service.handle({'query': 'complexity', 'minMeanCoverage': 10,
+                        'params': {'minFrequency': 0.003, 'minCoverage': 10}})
+        info = service.cacheInfo()
+        self.assertEqual(1, info.hits)
+        self.assertEqual(1, info.misses)
+
+    def testUnknownQuery(self):
+        """
+        An unknown query must give an error.
+        """
+        self.assertEqual({'error': "ValueError: Unknown query 'save'."},
+                         _service().handle({'query': 'save'}))
+
+    def testUnknownSample(self):
+        """
+        An unknown sample must give an error.
+        """
+        self.assertEqual({'error': "ValueError: Unknown sample(s): 'xxx'."},
+                         _service().handle({'query': 'richness',
+                                            'samples': ['xxx']}))
+
+    def testBadParameter(self):
+        """
+        An unknown parameter must give an error.
+        """
+        response = _service().handle({'query': 'richness',
+                                      'params': {'xxx': 3}})
+        self.assertIn('xxx', response['error'])
+
+    def testDataFrame(self):
+        """
+        A query result that cannot be sent as json must give an error.
+        """
+        response = _service().handle({'query': 'geneStatistics',
+                                      'params': {'genes': {'a': [0, 50]},
+                                                 'dataFrame': True}})
+        self.assertEqual(
+            {'error': 'TypeError: A query result of type DataFrame cannot be '
+                      'sent as JSON.'},
+            response)
+
+    def testUnexpectedError(self):
+        """
+        Any other exception raised by a query must give an error.
+        """
+        service = _service()
+        with patch.object(MinorVariantInfo, 'richness',
+                          side_effect=KeyError('xxx')):
+            response = service.handle({'query': 'richness'})
+        self.assertEqual({'error': "KeyError: 'xxx'"}, response)
+
+    def testSocket(self):
+        """
+        Requests sent over a Unix socket must be answered.
+        """
+        service = _service()
+
+        async def run(socketPath):
+            server = await service.start(socketPath=socketPath)
+            async with server:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    None, sendQuery, {'query': 'samples',
+                                      'minMeanCoverage': 10}, socketPath)
+
+        with TemporaryDirectory() as tempDir:
+            response = asyncio.run(run(join(tempDir, 'socket')))
+
+        self.assertEqual({'result': ['complete-coverage-sorted']}, response)
+
+    def testTCP(self):
+        """
+        Requests sent over a localhost TCP port must be answered, and
+        unparseable requests must give an error.
+        """
+        service = _service()
+
+        async def run():
+            server = await service.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            async with server:
+                reader, writer = await asyncio.open_connection(
+                    '127.0.0.1', port)
+                writer.write(b'not json\n')
+                await writer.drain()
+                error = json.loads(await reader.readline())
+                writer.close()
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(
+                    None, lambda: sendQuery({'query': 'samples'}, port=port))
+                return error, result
+
+        error, result = asyncio.run(run())
+        self.assertTrue(error['error'].startswith('Could not parse request'))
+        self.assertEqual(
+            ['complete-coverage-sorted', 'partial-coverage-sorted'],
+            result['result'])
+
+    def testManySamples(self):
+        """
+        A request listing many thousands of samples must be answered.
+        """
+        service = _service()
+        names = ['partial-coverage-sorted'] * 10000
+
+        async def run(socketPath):
+            server = await service.start(socketPath=socketPath)
+            async with server:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    None, sendQuery, {'query': 'samples', 'samples': names},
+                    socketPath)
+
+        with TemporaryDirectory() as tempDir:
+            response = asyncio.run(run(join(tempDir, 'socket')))
+
+        self.assertEqual({'result': names}, response)
+
+    def testRequestTooLong(self):
+        """
+        A request longer than the limit must be answered with an error.
+        """
+        service = _service()
+        names = ['partial-coverage-sorted'] * 100
+
+        async def run(socketPath):
+            server = await service.start(socketPath=socketPath, limit=1000)
+            async with server:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    None, sendQuery, {'query': 'samples', 'samples': names},
+                    socketPath)
+
+        with TemporaryDirectory() as tempDir:
+            response = asyncio.run(run(join(tempDir, 'socket')))
+
+        self.assertEqual(['error'], list(response))
+        self.assertTrue(response['error'].startswith('Could not read '
+                                                     'request: '))
@@ -0,0 +1,127 @@
+import numpy as np
+from os.path import exists, join
+import pickle
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from mvlib.shared import SharedCohort
+
+from .helpers import randomCohort
+
+
+def _nameAndCoverage(sample, offset):
+    """
+    Get the name of a sample and its coverage at a position, for testing
+    SharedCohort.map.
+
+    @param sample: A C{MinorVariantInfo} instance.
+    @param offset: The C{int} position.
+    @return: A (name, coverage) C{tuple}.
+    """
+    return sample.name, sample.coveragePerBase[offset]
+
+
+class TestSharedCohort(TestCase):
+    """
+    Tests for the SharedCohort class.
+    """
+    def testCounts(self):
+        """
+        The counts of the samples must be in the cohort.
+        """
+        samples = randomCohort()
+        with SharedCohort(samples) as cohort:
+            self.assertEqual(5, len(cohort))
+            self.assertEqual(['s0', 's1', 's2', 's3', 's4'], cohort.names)
+            self.assertEqual(300, cohort.length)
+            self.assertEqual(np.int32, cohort.counts.dtype)
+            self.assertEqual([sample.counts.tolist() for sample in samples],
+                             cohort.counts.tolist())
+
+    def testSample(self):
+        """
+        A sample must be found by index or name, with its counts.
+        """
+        samples = randomCohort()
+        with SharedCohort(samples) as cohort:
+            for index in 2, 's2':
+                sample = cohort.sample(index)
+                self.assertEqual('s2', sample.name)
+                self.assertEqual(samples[2].counts.tolist(),
+                                 sample.counts.tolist())
+                self.assertEqual(samples[2].richness(100, 0.05),
+                                 sample.richness(100, 0.05))
+
+    def testUnknownSample(self):
+        """
+        A ValueError must be raised for a sample name not in the cohort.
+        """
+        with SharedCohort(randomCohort()) as cohort:
+            error = r"^Sample 'xxx' is not in the cohort\.$"
+            self.assertRaisesRegex(ValueError, error, cohort.sample, 'xxx')
+
+    def testDifferentLengths(self):
+        """
+        A ValueError must be raised if the samples differ in length.
+        """
+        samples = (randomCohort(nSamples=1) +
+                   randomCohort(nSamples=1, length=200))
+        error = r'^All samples must have the same length \(300\), not 200\.$'
+        self.assertRaisesRegex(ValueError, error, SharedCohort, samples)
+
+    def testPickle(self):
+        """
+        A pickled cohort must only hold a reference to its counts, and must
+        give read-only counts when unpickled.
+        """
+        samples = randomCohort(length=3000)
+        with SharedCohort(samples) as cohort:
+            data = pickle.dumps(cohort)
+            self.assertLess(len(data), 1000)
+            unpickled = pickle.loads(data)
+            self.assertEqual(cohort.names, unpickled.names)
+            self.assertEqual(cohort.counts.tolist(),
+                             unpickled.counts.tolist())
+            self.assertFalse(unpickled.counts.flags.writeable)
+
+    def testMap(self):
+        """
+        Calling a method or a function on every sample must give the results
+        in sample order, in this process or in worker processes.
+        """
+        samples = randomCohort()
+        expected = [sample.richness(100, 0.05) for sample in samples]
+        with SharedCohort(samples) as cohort:
+            for workers in 1, 2:
+                self.assertEqual(
+                    expected,
+                    cohort.map('richness', 100, 0.05, workers=workers))
+                self.assertEqual(
+                    [(sample.name, sample.coveragePerBase[10])
+                     for sample in samples],
+                    cohort.map(_nameAndCoverage, 10, workers=workers))
+
+    def testMemoryMappedFile(self):
+        """
+        The counts may be held in a memory-mapped file, which is kept when
+        the cohort is closed.
+        """
+        samples = randomCohort()
+        expected = [sample.complexity(100, 0.05) for sample in samples]
+        with TemporaryDirectory() as tempDir:
+            filename = join(tempDir, 'cohort.npy')
+            with SharedCohort(samples, filename=filename) as cohort:
+                self.assertEqual(
+                    expected,
+                    cohort.map('complexity', 100, 0.05, workers=2))
+            self.assertTrue(exists(filename))
+            self.assertEqual([sample.counts.tolist() for sample in samples],
+                             np.load(filename).tolist())
+
+    def testEmpty(self):
+        """
+        A cohort may have no samples.
+        """
+        with SharedCohort([]) as cohort:
+            self.assertEqual(0, len(cohort))
+            self.assertEqual([], cohort.map('richness', workers=2))
@@ -0,0 +1,196 @@
+import json
+import numpy as np
+from os.path import join
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from mvlib.store import CohortStore
+
+from .helpers import randomCohort
+
+
+class TestCohortStore(TestCase):
+    """
+    Tests for the CohortStore class.
+    """
+    def testEmpty(self):
+        """
+        A new store must have no samples or chunks.
+        """
+        with TemporaryDirectory() as tempDir:
+            store = CohortStore(join(tempDir, 'store'))
+            self.assertEqual(0, len(store))
+            self.assertEqual((0, 0), store.nChunks())
+            self.assertEqual({}, store.statistics(workers=1))
+            self.assertEqual([], list(store.variantTables(workers=1)))
+
+    def testAppend(self):
+        """
+        Samples appended in several calls, filling up partial chunks, must be
+        read back, also when the store is opened again.
+        """
+        samples = randomCohort(nSamples=7)
+        with TemporaryDirectory() as tempDir:
+            store = CohortStore(tempDir, sampleChunkSize=3,
+                                positionChunkSize=128)
+            store.append(samples[:2])
+            store.append(samples[2:6])
+            store.append(samples[6:])
+            self.assertEqual((3, 3), store.nChunks())
+
+            store = CohortStore(tempDir)
+            self.assertEqual([sample.name for sample in samples], store.names)
+            self.assertEqual(300, store.length)
+            for sample in samples:
+                self.assertEqual(sample.counts.tolist(),
+                                 store.sampleCounts(sample.name).tolist())
+            self.assertEqual((1, 44, 6), store.chunk(2, 2).shape)
+
+    def testCompression(self):
+        """
+        The chunks must be written with the compression of the store.
+        """
+        samples = randomCohort(nSamples=2)
+        for compression in 'gzip', 'zstd', 'none':
+            with TemporaryDirectory() as tempDir:
+                try:
+                    store = CohortStore(tempDir, compression=compression)
+                except ValueError:
+                    self.skipTest('zstandard is not installed.')
+                store.append(samples)
+                store = CohortStore(tempDir)
+                self.assertEqual(compression, store.compression)
+                self.assertEqual(samples[1].counts.tolist(),
+                                 store.sampleCounts('s1').tolist())
+
+    def testUnknownCompression(self):
+        """
+        A ValueError must be raised for an unknown compression.
+        """
+        with TemporaryDirectory() as tempDir:
+            error = r"^Unknown compression 'bzip2'\."
+            self.assertRaisesRegex(ValueError, error, CohortStore, tempDir,
+                                   compression='bzip2')
+
+    def testUnknownVersion(self):
+        """
+        A ValueError must be raised when opening a store of an unknown
+        version.
+        """
+        with TemporaryDirectory() as tempDir:
+            CohortStore(tempDir)
+            with open(join(tempDir, 'store.json')) as fp:
+                metadata = json.load(fp)
+            metadata['version'] = 7
+            with open(join(tempDir, 'store.json'), 'w') as fp:
+                json.dump(metadata, fp)
+            error = r"^Unknown store version 7 in '.*'\. The known version "
+            self.assertRaisesRegex(ValueError, error, CohortStore, tempDir)
+
+    def testWrongLength(self):
+        """
+        A ValueError must be raised when appending a sample of a different
+        length.
+        """
+        with TemporaryDirectory() as tempDir:
+            store = CohortStore(tempDir)
+            store.append(randomCohort(nSamples=1))
+            error = (r"^Sample 's0' has length 200, but the samples in the "
+                     r"store have length 300\.$")
+            self.assertRaisesRegex(ValueError, error, store.append,
+                                   randomCohort(nSamples=1, length=200))
+
+    def testDuplicateName(self):
+        """
+        A ValueError must be raised when appending a sample whose name is
+        already in the store.
+        """
+        with TemporaryDirectory() as tempDir:
+            store = CohortStore(tempDir)
+            store.append(randomCohort(nSamples=2))
+            error = r"^Sample 's0' is already in the store\.$"
+            self.assertRaisesRegex(ValueError, error, store.append,
+                                   randomCohort(nSamples=2, seed=1))
+
+    def testUnknownSample(self):
+        """
+        A ValueError must be raised when reading a sample that is not in the
+        store.
+        """
+        with TemporaryDirectory() as tempDir:
+            store = CohortStore(tempDir)
+            error = r"^Sample 'xxx' is not in the store\.$"
+            self.assertRaisesRegex(ValueError, error, store.sampleCounts,
+                                   'xxx')
+
+    def testInterruptedAppend(self):
+        """
+        A chunk file holding more samples than the store (as left by an
+        interrupted append) must only give the samples of the store.
+        """
+        samples = randomCohort(nSamples=3)
+        with TemporaryDirectory() as tempDir:
+            store = CohortStore(tempDir, sampleChunkSize=4)
+            store.append(samples[:2])
+            with open(join(tempDir, 'store.json')) as fp:
+                metadata = json.load(fp)
+            store.append(samples[2:])
+            with open(join(tempDir, 'store.json'), 'w') as fp:
+                json.dump(metadata, fp)
+            store = CohortStore(tempDir)
+            self.assertEqual(['s0', 's1'], store.names)
+            self.assertEqual((2, 300, 6), store.chunk(0, 0).shape)
+
+    def testStatistics(self):
+        """
+        The statistics of the samples must be those of MinorVariantInfo,
+        whether computed in this process or in worker processes.
+        """
+        samples = randomCohort(nSamples=7)
+        with TemporaryDirectory() as tempDir:
+            store = CohortStore(tempDir, sampleChunkSize=3,
+                                positionChunkSize=128)
+            store.append(samples)
+            for workers in 1, 2:
+                statistics = store.statistics(100, 0.05, workers=workers)
+                for sample in samples:
+                    result = statistics[sample.name]
+                    self.assertAlmostEqual(sample.meanCoverage(),
+                                           result['meanCoverage'])
+                    self.assertEqual(sample.richness(100, 0.05),
+                                     result['richness'])
+                    self.assertAlmostEqual(sample.complexity(100, 0.05),
+                                           result['complexity'])
+                    self.assertAlmostEqual(sample.distance(100, 0.05),
+                                           result['distance'])
+
+    def testNoMinorVariants(self):
+        """
+        The complexity of a sample without minor variant positions must be
+        NaN.
+        """
+        with TemporaryDirectory() as tempDir:
+            store = CohortStore(tempDir)
+            store.append(randomCohort(nSamples=1))
+            result = store.statistics(100000, workers=1)['s0']
+            self.assertEqual(0, result['richness'])
+            self.assertTrue(np.isnan(result['complexity']))
+
+    def testVariantTables(self):
+        """
+        The variant table of each sample must be that of MinorVariantInfo,
+        with the samples in store order.
+        """
+        samples = randomCohort(nSamples=7)
+        with TemporaryDirectory() as tempDir:
+            store = CohortStore(tempDir, sampleChunkSize=3,
+                                positionChunkSize=128)
+            store.append(samples)
+            for workers in 1, 2:
+                tables = list(store.variantTables(100, 0.05,
+                                                  workers=workers))
+                self.assertEqual([sample.name for sample in samples],
+                                 [name for name, _ in tables])
+                for sample, (_, table) in zip(samples, tables):
+                    expected = sample.variantTable(100, 0.05)
+                    self.assertEqual(expected.tolist(), table.tolist())